@@ -0,0 +1,189 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mt.core.connector import ReplicationSet
+from mt.core.profile_table import DatabaseView
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# member state codes of replSetGetStatus
+member_state_codes = {'STARTUP': 0, 'PRIMARY': 1, 'SECONDARY': 2, 'RECOVERING': 3, 'STARTUP2': 5, 'UNKNOWN': 6,
+                      'ARBITER': 7, 'DOWN': 8, 'ROLLBACK': 9, 'REMOVED': 10}
+
+
+def escape_label_value(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if value != value:
+        return 'NaN'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricFamily:
+    """
+    one metric family of the exposition, the line of every series is rendered when its value changes
+    and the text of the family is joined again only if one of its series changed
+    """
+    __slots__ = ['name', 'help', 'type', 'series', 'dirty', 'text']
+
+    def __init__(self, name: str, help_text: str, metric_type: str = 'gauge'):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        # labels -> (value, rendered line)
+        self.series: Dict[Labels, Tuple[float, str]] = {}
+        self.dirty = True
+        self.text = ''
+
+    def render_line(self, labels: Labels, value: float) -> str:
+        if not labels:
+            return f'{self.name} {format_value(value)}\n'
+        label_text = ','.join(f'{x}="{escape_label_value(y)}"' for x, y in labels)
+        return f'{self.name}{{{label_text}}} {format_value(value)}\n'
+
+    def set(self, labels: Labels, value: float):
+        current = self.series.get(labels)
+        if current is not None and (current[0] == value or (current[0] != current[0] and value != value)):
+            return
+        self.series.update({labels: (value, self.render_line(labels, value))})
+        self.dirty = True
+
+    def replace(self, samples: Dict[Labels, float]):
+        """
+        set all series of the family, series not in samples are removed
+        """
+        for labels in [x for x in self.series if x not in samples]:
+            self.series.pop(labels)
+            self.dirty = True
+        for labels, value in samples.items():
+            self.set(labels, value)
+
+    def render(self) -> str:
+        if self.dirty:
+            self.text = f'# HELP {self.name} {self.help}\n# TYPE {self.name} {self.type}\n' + \
+                        ''.join(x[1] for x in self.series.values()) if self.series else ''
+            self.dirty = False
+        return self.text
+
+
+class PrometheusExporter:
+    """
+    prometheus text exposition of the cluster snapshot
+    the body is only joined again if a series changed since the last scrape, unchanged families keep their text
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.families: Dict[str, MetricFamily] = {}
+        self._body: Optional[bytes] = None
+        self._lock = threading.Lock()
+        for name, help_text in [
+            ('mongodb_replication_lag_seconds', 'seconds the member is behind the primary'),
+            ('mongodb_oplog_window_hours', 'hours of operations kept in the oplog of the primary'),
+            ('mongodb_oplog_size_megabytes', 'configured size of the oplog'),
+            ('mongodb_oplog_used_megabytes', 'used size of the oplog'),
+            ('mongodb_member_state', 'replSetGetStatus state code of the member'),
+            ('mongodb_member_health', '1 if the member is reachable'),
+            ('mongodb_member_heartbeat_rtt_milliseconds', 'heartbeat round trip time of the member seen by the driver'),
+            ('mongodb_collection_storage_megabytes', 'storage size of the collection on the shard'),
+            ('mongodb_collection_index_megabytes', 'total index size of the collection on the shard'),
+            ('mongodb_collection_reusable_megabytes', 'file bytes available for reuse of the collection on the shard'),
+            ('mongodb_collection_documents', 'document count of the collection on the shard'),
+            ('mongodb_active_sessions', 'active logical sessions reported by mongos'),
+        ]:
+            self.families.update({name: MetricFamily(name, help_text)})
+        self.families.update({'mongodb_elections_total': MetricFamily(
+            'mongodb_elections_total', 'elections seen by driver monitoring since the process started', 'counter')})
+
+    def replace(self, family_name: str, samples: Dict[Labels, float]):
+        with self._lock:
+            self.families[family_name].replace(samples)
+
+    def update_replication_sets(self, replication_sets: Dict[str, ReplicationSet]) -> Dict[str, str]:
+        """
+        series of a replication set whose status can not be queried are left out
+        :return: {group: error} of those replication sets
+        """
+        families = ['mongodb_replication_lag_seconds', 'mongodb_oplog_window_hours', 'mongodb_oplog_size_megabytes',
+                    'mongodb_oplog_used_megabytes', 'mongodb_member_state', 'mongodb_member_health',
+                    'mongodb_member_heartbeat_rtt_milliseconds', 'mongodb_elections_total']
+        samples = {x: {} for x in families}
+        errors = {}
+        for group, replication in replication_sets.items():
+            try:
+                replication_samples = self.replication_samples(group, replication)
+            except Exception as e:
+                errors.update({group: str(e)})
+                continue
+            for family_name, family_samples in replication_samples.items():
+                samples[family_name].update(family_samples)
+        for family_name in families:
+            self.replace(family_name, samples[family_name])
+        return errors
+
+    @staticmethod
+    def replication_samples(group: str, replication: ReplicationSet) -> Dict[str, Dict[Labels, float]]:
+        lag, window, size, used, state, health, rtt = {}, {}, {}, {}, {}, {}, {}
+        replication_labels = (('replication', replication.name), ('group', group))
+        for member in replication.members:
+            if member.rtt_ms is not None:
+                rtt.update({replication_labels + (('member', member.address),): member.rtt_ms})
+        oplog_info = replication.oplog_info
+        if oplog_info is not None:
+            window.update({replication_labels: (oplog_info.oplog_ends - oplog_info.oplog_starts).total_seconds()
+                           / 3600})
+            size.update({replication_labels: oplog_info.max_log_size_mb})
+            used.update({replication_labels: oplog_info.used_log_size_mb})
+        for member in replication.replication_member_set.member_set:
+            member_labels = replication_labels + (('member', f'{member.address.ip}:{member.address.port}'),)
+            state.update({member_labels: member_state_codes.get(member.role, member_state_codes['DOWN'])})
+            health.update({member_labels: member.status or 0})
+        if replication.oplog_lag_info is not None:
+            for diff in replication.oplog_lag_info.diff_info:
+                if diff.get('diff_seconds') is None:
+                    continue
+                lag.update({replication_labels + (('member', diff.get('source')),): diff.get('diff_seconds')})
+        return {'mongodb_replication_lag_seconds': lag, 'mongodb_oplog_window_hours': window,
+                'mongodb_oplog_size_megabytes': size, 'mongodb_oplog_used_megabytes': used,
+                'mongodb_member_state': state, 'mongodb_member_health': health,
+                'mongodb_member_heartbeat_rtt_milliseconds': rtt,
+                'mongodb_elections_total': {replication_labels: replication.election_count}}
+
+    def update_collections(self, database_profile: Iterable[DatabaseView]):
+        storage, index, reusable, documents = {}, {}, {}, {}
+        for database in database_profile:
+            for collection in database.collections:
+                size_infos = collection.sharding_detail.items() or [('', collection.basic_size_info)]
+                for shard_name, size_info in size_infos:
+                    labels = (('database', database.database_name), ('collection', collection.name or ''),
+                              ('shard', shard_name))
+                    storage.update({labels: size_info.storage_size})
+                    index.update({labels: size_info.total_index_size})
+                    reusable.update({labels: size_info.reuse_size})
+                    documents.update({labels: size_info.count or 0})
+        for family_name, samples in [('mongodb_collection_storage_megabytes', storage),
+                                     ('mongodb_collection_index_megabytes', index),
+                                     ('mongodb_collection_reusable_megabytes', reusable),
+                                     ('mongodb_collection_documents', documents)]:
+            self.replace(family_name, samples)
+
+    def update_active_sessions(self, active_sessions: int):
+        self.replace('mongodb_active_sessions', {(): active_sessions} if active_sessions >= 0 else {})
+
+    def render(self) -> Tuple[bytes, bool]:
+        """
+        :return: exposition body and whether it was joined again
+        """
+        with self._lock:
+            if self._body is not None and not any(x.dirty for x in self.families.values()):
+                return self._body, False
+            self._body = ''.join(x.render() for x in self.families.values()).encode('utf-8')
+            return self._body, True
+
+    def family_sizes(self) -> List[Tuple[str, int]]:
+        with self._lock:
+            return [(x.name, len(x.series)) for x in self.families.values()]
@@ -0,0 +1,130 @@
+import asyncio
+from http import HTTPStatus
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from rich.console import Console
+
+from mt.api.snapshot import SnapshotRefresher, Resource, dump_json
+
+console = Console()
+
+_max_header_bytes = 64 * 1024
+
+
+class ApiServer:
+    """
+    read only http/1.1 api over asyncio streams, every response is a resource already encoded by the refresher
+    supports keep-alive, ETag with If-None-Match and gzip content encoding
+    """
+
+    def __init__(self, refresher: SnapshotRefresher, host: str = '0.0.0.0', port: int = 8080,
+                 keepalive_timeout: float = 30):
+        self.refresher = refresher
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+
+    def route(self, path: str, query: Dict[str, list]) -> Tuple[HTTPStatus, Optional[Resource]]:
+        if path == '/metrics':
+            return HTTPStatus.OK, self.refresher.metrics_resource()
+        if path == '/metrics/series':
+            return HTTPStatus.OK, self.refresher.metric_series()
+        if path == '/metrics/history':
+            node, metric = query.get('node', [None])[0], query.get('metric', [None])[0]
+            if not node or not metric:
+                return HTTPStatus.BAD_REQUEST, Resource(dump_json({'error': 'node and metric are required'}))
+            try:
+                tier = int(query.get('tier', ['0'])[0])
+                since = float(query.get('since')[0]) if 'since' in query else None
+                return HTTPStatus.OK, self.refresher.metric_history(node, metric, tier, since)
+            except (ValueError, IndexError) as e:
+                return HTTPStatus.BAD_REQUEST, Resource(dump_json({'error': str(e)}))
+        if path == '/':
+            return HTTPStatus.OK, Resource(dump_json(sorted(list(self.refresher.resources) +
+                                                            ['/metrics', '/metrics/series', '/metrics/history'])))
+        resource = self.refresher.resources.get(path)
+        if resource is None:
+            return HTTPStatus.NOT_FOUND, Resource(dump_json({'error': f'{path} not found'}))
+        return HTTPStatus.OK, resource
+
+    @staticmethod
+    def parse_request(head: bytes) -> Tuple[str, str, str, Dict[str, str]]:
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(':')
+            headers.update({name.strip().lower(): value.strip()})
+        return method, target, version, headers
+
+    @staticmethod
+    def build_response(status: HTTPStatus, resource: Optional[Resource], headers: Dict[str, str],
+                       keep_alive: bool, head_only: bool = False) -> bytes:
+        response_headers = [('Connection', 'keep-alive' if keep_alive else 'close')]
+        body = b''
+        if resource is not None:
+            response_headers.append(('ETag', resource.etag))
+            response_headers.append(('Cache-Control', 'no-cache'))
+            response_headers.append(('Vary', 'Accept-Encoding'))
+            if status == HTTPStatus.OK and resource.etag in [x.strip() for x in
+                                                               headers.get('if-none-match', '').split(',')]:
+                status = HTTPStatus.NOT_MODIFIED
+            elif 'gzip' in headers.get('accept-encoding', ''):
+                body = resource.gzip_body
+                response_headers.append(('Content-Encoding', 'gzip'))
+            else:
+                body = resource.body
+            if status != HTTPStatus.NOT_MODIFIED:
+                response_headers.append(('Content-Type', resource.content_type))
+        if status != HTTPStatus.NOT_MODIFIED:
+            response_headers.append(('Content-Length', str(len(body))))
+        head = f'HTTP/1.1 {status.value} {status.phrase}\r\n' + \
+               ''.join(f'{x}: {y}\r\n' for x, y in response_headers) + '\r\n'
+        return head.encode('latin-1') + (b'' if head_only else body)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.LimitOverrunError):
+                    break
+                try:
+                    method, target, version, headers = self.parse_request(head)
+                except ValueError:
+                    writer.write(self.build_response(HTTPStatus.BAD_REQUEST, None, {}, False))
+                    break
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                if method not in ('GET', 'HEAD'):
+                    writer.write(self.build_response(HTTPStatus.METHOD_NOT_ALLOWED, None, headers, False))
+                    break
+                url = urlsplit(target)
+                status, resource = self.route(url.path.rstrip('/') or '/', parse_qs(url.query))
+                writer.write(self.build_response(status, resource, headers, keep_alive, method == 'HEAD'))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        return await asyncio.start_server(self.handle_connection, self.host, self.port, limit=_max_header_bytes)
+
+    def serve_forever(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(self.start())
+        console.print(f'mt api listening on {self.host}:{self.port}', style='bold green')
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
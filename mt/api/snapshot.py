@@ -0,0 +1,254 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from rich.console import Console
+
+from mt.api.exporter import PrometheusExporter
+from mt.core.common import format_timestamp, run_bounded
+from mt.core.connector import ShardingCluster, ReplicationSet
+from mt.core.counter_rate import CounterRates
+from mt.core.topology_model import topology_model
+from mt.cron.store import MetricStore
+from mt.profiler.replicateset.OplogEstimator import OplogEstimator
+from mt.profiler.replicateset.ReplicationProfile import ReplicationProfile
+from mt.profiler.sharding.ShardProfile import ShardProfile
+
+console = Console()
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return format_timestamp(value)
+    return str(value)
+
+
+def dump_json(content) -> bytes:
+    return json.dumps(content, default=_json_default, ensure_ascii=False, sort_keys=True).encode('utf-8')
+
+
+class Resource:
+    """
+    encoded response body with its gzip form and etag, built once and served many times
+    """
+    __slots__ = ['body', 'gzip_body', 'etag', 'updated_at', 'content_type']
+
+    def __init__(self, body: bytes, content_type: str = 'application/json; charset=utf-8'):
+        self.body = body
+        self.content_type = content_type
+        self.gzip_body = gzip.compress(body, compresslevel=6)
+        self.etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        self.updated_at = time.time()
+
+    def __repr__(self):
+        return f'Resource(etag={self.etag}, size={len(self.body)}, gzip_size={len(self.gzip_body)})'
+
+
+def topology_of_replication(replication: Optional[ReplicationSet]) -> Optional[dict]:
+    if replication is None:
+        return None
+    try:
+        member_set = replication.replication_member_set
+    except Exception as e:
+        # the status of one replication set is queried lazily, its failure is reported with it
+        return {'name': replication.name, 'error': str(e)}
+    members = sorted(member_set.member_set, key=lambda x: (x.address.ip, int(x.address.port)))
+    return {
+        'name': replication.name,
+        'primary': '{}:{}'.format(*replication.primary_info) if replication.primary_info else None,
+        'members': [{'host': f'{x.address.ip}:{x.address.port}', 'role': x.role, 'priority': x.priority,
+                     'health': x.status} for x in members]
+    }
+
+
+class SnapshotRefresher:
+    """
+    keep an in-memory snapshot of the cluster as ready to send resources,
+    every refresh_interval seconds replication status and shard load are queried again,
+    collection stats are refreshed incrementally every profile_interval seconds,
+    http handlers only read the published resources and never query mongo
+    """
+
+    def __init__(self, cluster: ShardingCluster, refresh_interval: float = 30, profile_interval: float = 600,
+                 metric_store: MetricStore = None, max_in_flight: int = 8, index_usage_time_budget: float = 60):
+        self.cluster = cluster
+        self.refresh_interval = refresh_interval
+        self.profile_interval = profile_interval
+        self.metric_store = metric_store
+        self.max_in_flight = max_in_flight
+        # seconds one $indexStats sweep may take within a refresh
+        self.index_usage_time_budget = index_usage_time_budget
+        self.shard_profile: ShardProfile = None
+        self.resources: Dict[str, Resource] = {}
+        self.errors: Dict[str, str] = {}
+        self.refreshed_at = None
+        self.exporter = PrometheusExporter()
+        self.oplog_estimator = OplogEstimator.from_config(cluster)
+        self._metrics_resource: Resource = None
+        self._profiled_at = 0.0
+        self._stopped = threading.Event()
+
+    def publish(self, path: str, content):
+        body = dump_json(content)
+        resource = self.resources.get(path)
+        if resource is not None and resource.body == body:
+            # unchanged content keeps its etag and the already compressed body
+            return
+        self.resources.update({path: Resource(body)})
+
+    def _guarded(self, name: str, func: Callable) -> bool:
+        """
+        run one step of a refresh, its error is kept in the status document under name until it succeeds again
+        """
+        try:
+            func()
+            self.errors.pop(name, None)
+            return True
+        except Exception as e:
+            self.errors.update({name: str(e)})
+            console.print(f'refresh {name} failed # {e}', style='bold red')
+            return False
+
+    def _build(self, path: str, builder: Callable):
+        self._guarded(path, lambda: self.publish(path, builder()))
+
+    def _replication_sets(self) -> Dict[str, ReplicationSet]:
+        replication_sets = {x: y for x, y in self.cluster.shards.items() if y is not None}
+        if self.cluster.config_server is not None:
+            replication_sets.update({'config': self.cluster.config_server})
+        return replication_sets
+
+    def refresh_replication_sets(self) -> Dict[str, dict]:
+        summaries = {}
+        for replication, _, error in run_bounded(lambda x: x.refresh(), list(self._replication_sets().values()),
+                                                 self.max_in_flight):
+            if error:
+                self.errors.update({f'replication:{replication.name}': str(error)})
+            else:
+                self.errors.pop(f'replication:{replication.name}', None)
+        for name, replication in self._replication_sets().items():
+            try:
+                summaries.update({name: ReplicationProfile(replication).analyze_summary()})
+            except Exception as e:
+                summaries.update({name: {'error': str(e)}})
+        metric_errors = self.exporter.update_replication_sets(self._replication_sets())
+        for name in self._replication_sets():
+            if name in metric_errors:
+                self.errors.update({f'metrics:{name}': metric_errors.get(name)})
+            else:
+                self.errors.pop(f'metrics:{name}', None)
+        return summaries
+
+    def topology(self) -> dict:
+        return {
+            'mongos': sorted(f'{x}:{y}' for x, y in self.cluster.basic_connection.nodes),
+            'config_server': topology_of_replication(self.cluster.config_server),
+            'shards': {x: topology_of_replication(y) for x, y in self.cluster.shards.items()},
+            'failed_shards': self.cluster.failed_shards,
+            'config_server_error': self.cluster.config_server_error,
+            'monitoring': topology_model.describe()
+        }
+
+    def refresh(self):
+        now = time.time()
+        self._build('/replications', self.refresh_replication_sets)
+        self._build('/topology', self.topology)
+        self._build('/replications/oplog', self.estimate_oplog)
+        profiled = False
+        if self.shard_profile is None:
+            self.shard_profile = ShardProfile(self.cluster)
+            profiled = self._guarded('profile', self.shard_profile.ensure_profiled)
+        elif now - self._profiled_at >= self.profile_interval:
+            # the first profile may have failed, then the incremental one profiles everything
+            profiled = self._guarded('profile', self.shard_profile.refresh_profile)
+        if profiled:
+            self._profiled_at = now
+            self._guarded('/metrics', lambda: self.exporter.update_collections(self.cluster.database_profile))
+        # one serverStatus sample of every node per refresh, shared by the status and the load of the shards
+        rates = self.counter_rates()
+        if rates is not None:
+            self._build('/shards/status', lambda: self.shard_profile.shard_status(rates=rates))
+            self._build('/shards/load', lambda: self.shard_profile.analyze_cluster_load(rates=rates))
+        self._build('/shards/databases', self.shard_profile.analyze_database_of_shard)
+        self._build('/shards/balance', self.shard_profile.analyze_data_balance_of_shard)
+        self._build('/shards/chunks', self.shard_profile.analyze_collection_of_shard)
+        if profiled:
+            self._build('/shards/skew', self.shard_profile.analyze_balance_skew)
+            self._build('/shards/indexes', lambda: self.shard_profile.analyze_index_usage(
+                time_budget=self.index_usage_time_budget))
+        self._build('/shards/sessions', self.active_sessions)
+        self._build('/shards/operations', self.shard_profile.analyze_active_operations)
+        self.publish_metrics()
+        self.refreshed_at = time.time()
+        self.publish('/status', {'refreshed_at': datetime.fromtimestamp(self.refreshed_at),
+                                 'refresh_seconds': round(self.refreshed_at - now, 3), 'errors': self.errors})
+
+    def counter_rates(self) -> Optional[CounterRates]:
+        try:
+            rates = self.shard_profile.refresh_counter_rates()
+            self.errors.pop('counter_rates', None)
+            return rates
+        except Exception as e:
+            self.errors.update({'counter_rates': str(e)})
+            console.print(f'refresh counter rates failed # {e}', style='bold red')
+            return None
+
+    def estimate_oplog(self) -> dict:
+        self.oplog_estimator.sample()
+        return {'estimates': self.oplog_estimator.estimate_all(), 'errors': self.oplog_estimator.errors,
+                'safe_window_hours': self.oplog_estimator.safe_window_hours}
+
+    def active_sessions(self) -> dict:
+        active_sessions = self.shard_profile.analyze_active_session_of_shard()
+        self.exporter.update_active_sessions(active_sessions)
+        return {'active_sessions': active_sessions}
+
+    def publish_metrics(self):
+        """
+        prometheus exposition, encoded again only if a series changed since the last refresh
+        """
+        body, rebuilt = self.exporter.render()
+        if rebuilt or self._metrics_resource is None:
+            self._metrics_resource = Resource(body, PrometheusExporter.content_type)
+
+    def metrics_resource(self) -> Resource:
+        if self._metrics_resource is None:
+            return Resource(b'', PrometheusExporter.content_type)
+        return self._metrics_resource
+
+    def run_forever(self):
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            try:
+                self.refresh()
+            except Exception as e:
+                console.print(f'refresh snapshot failed # {e}', style='bold red')
+            self._stopped.wait(max(0.0, self.refresh_interval - (time.monotonic() - started)))
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run_forever, name='mt-api-refresher', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        if self.shard_profile is not None:
+            self.shard_profile.close()
+
+    def metric_series(self) -> Resource:
+        keys = self.metric_store.keys() if self.metric_store else []
+        return Resource(dump_json([{'node': x, 'metric': y} for x, y in sorted(keys)]))
+
+    def metric_history(self, node: str, metric: str, tier: int = 0, since: float = None) -> Resource:
+        points = []
+        if self.metric_store:
+            for timestamps, values in self.metric_store.read(node, metric, tier, since):
+                points.extend(zip(timestamps.tolist(), values.tolist()))
+        return Resource(dump_json({'node': node, 'metric': metric, 'tier': tier, 'points': points}))
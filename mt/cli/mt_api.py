@@ -0,0 +1,46 @@
+import click as click
+
+from mt.api.server import ApiServer
+from mt.api.snapshot import SnapshotRefresher
+from mt.conf.parser import refresh_global_config, global_config
+from mt.core.connector import ShardingCluster
+from mt.cron.collector import MetricsCollector
+from mt.cron.store import MetricStore
+
+
+@click.command()
+@click.option("--conf", '-f', type=str, default='./mt.yaml', help="mt yaml config path", required=True)
+def cluster_api(conf: str):
+    """
+    serve mongo cluster info over http
+    """
+    refresh_global_config(conf)
+
+    mongo_cluster_config = global_config.get('mongo_cluster_config', {})
+    mongo_uri = mongo_cluster_config.get('mongo_uri')
+    if not mongo_uri:
+        print('no available mongo uri')
+        exit(1)
+    c = ShardingCluster(mongo_uri, max_workers=mongo_cluster_config.get('init_workers', 8),
+                        shard_timeout=mongo_cluster_config.get('init_timeout', 120))
+
+    api_config = global_config.get('api_config', {})
+    store = MetricStore.from_config()
+    collector = MetricsCollector.from_config(c, on_sample=store.record_sample)
+    refresher = SnapshotRefresher(c, refresh_interval=api_config.get('refresh_interval', 30),
+                                  profile_interval=api_config.get('profile_interval', 600), metric_store=store,
+                                  index_usage_time_budget=api_config.get('index_usage_time_budget', 60))
+    collector.start()
+    refresher.start()
+    try:
+        ApiServer(refresher, api_config.get('host', '0.0.0.0'), api_config.get('port', 8080)).serve_forever()
+    finally:
+        refresher.stop()
+        refresher.close()
+        collector.stop()
+        store.close()
+        c.close()
+
+
+if __name__ == '__main__':
+    cluster_api()
@@ -5,6 +5,7 @@ import click as click
 from mt.conf.parser import refresh_global_config, global_config, refresh_mongo_cmd_lines
 from mt.core.connector import ShardingCluster
 from mt.operation.reboot.cluster import save_cmd_lines_of_shards, reboot_cluster_shards
+from mt.operation.reboot.common import ssh_connection_pool
 
 
 @click.command()
@@ -15,18 +16,28 @@ def cluster_reboot(conf: str):
     """
     refresh_global_config(conf)
 
-    mongo_uri = global_config.get('mongo_cluster_config', {}).get('mongo_uri')
+    mongo_cluster_config = global_config.get('mongo_cluster_config', {})
+    mongo_uri = mongo_cluster_config.get('mongo_uri')
     if not mongo_uri:
         print('no available mongo uri')
         exit(1)
-    c = ShardingCluster(mongo_uri)
+    c = ShardingCluster(mongo_uri, max_workers=mongo_cluster_config.get('init_workers', 8),
+                        shard_timeout=mongo_cluster_config.get('init_timeout', 120))
+    if c.failed_shards:
+        print(f'init failed, reboot abort: {c.failed_shards}')
+        exit(1)
     save_cmd_lines_of_shards(c)
 
     cmd_save_path = global_config.get('cmd_save_path')
 
     refresh_mongo_cmd_lines(cmd_save_path)
 
-    reboot_cluster_shards(c)
+    failed = reboot_cluster_shards(c)
+    ssh_connection_pool.close_all()
+    c.close()
+    if failed:
+        print(f'reboot failed: {failed}')
+        exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+import time
+
+from rich.console import Console
+from rich.table import Table
+
+from mt.core.client_registry import client_registry
+from mt.core.extend_cmd import create_extend_cmd, ShellJsonify
+
+console = Console()
+
+_extend_cmd_queries = ['get_replication_status', 'get_replication_conf', 'get_primary_replication_info',
+                       'get_slave_replication_info']
+
+
+def benchmark_extend_cmd_backends(mongo_uri: str, rounds: int = 5) -> dict:
+    """
+    wall-clock time of every ExtendCmd query on the primary of a replication set, shell backend vs driver backend
+    :return: {backend: {query: average seconds}}
+    """
+    client = client_registry.acquire(mongo_uri)
+    try:
+        host, port = client.primary
+        result = {}
+        for backend in ['shell', 'driver']:
+            extend_cmd = create_extend_cmd(host, port, client=client, backend=backend)
+            cost = {}
+            try:
+                for query in _extend_cmd_queries:
+                    start = time.perf_counter()
+                    for _ in range(rounds):
+                        getattr(extend_cmd, query)()
+                    cost.update({query: (time.perf_counter() - start) / rounds})
+            finally:
+                extend_cmd.close()
+            result.update({backend: cost})
+    finally:
+        client_registry.release(client)
+
+    table = Table(title=f'ExtendCmd backends on {host}:{port}, {rounds} rounds')
+    table.add_column('query')
+    table.add_column('shell (ms)', justify='right')
+    table.add_column('driver (ms)', justify='right')
+    table.add_column('speedup', justify='right')
+    for query in _extend_cmd_queries + ['total']:
+        if query == 'total':
+            shell_cost, driver_cost = sum(result['shell'].values()), sum(result['driver'].values())
+        else:
+            shell_cost, driver_cost = result['shell'][query], result['driver'][query]
+        table.add_row(query, f'{shell_cost * 1000:.1f}', f'{driver_cost * 1000:.1f}',
+                      f'{shell_cost / driver_cost:.1f}x')
+    console.print(table)
+    return result
+
+
+def synthetic_replication_status(member_count: int) -> str:
+    """
+    rs.status() like shell output with member_count members, about 1KB per member
+    """
+    members = []
+    for index in range(member_count):
+        seconds = 1638172800 + index
+        members.append(f"""
+        {{
+            "_id" : {index},
+            "name" : "192.168.{index // 250}.{index % 250}:27001",
+            "health" : 1,
+            "state" : 2,
+            "stateStr" : "SECONDARY",
+            "uptime" : NumberLong({seconds}),
+            "optime" : {{
+                "ts" : Timestamp({seconds}, {index}),
+                "t" : NumberLong(12)
+            }},
+            "optimeDurable" : {{
+                "ts" : Timestamp({seconds}, {index}),
+                "t" : NumberLong(12)
+            }},
+            "optimeDate" : ISODate("2021-11-29T08:{index // 60 % 60:02d}:{index % 60:02d}Z"),
+            "optimeDurableDate" : ISODate("2021-11-29T08:{index // 60 % 60:02d}:{index % 60:02d}Z"),
+            "lastHeartbeat" : ISODate("2021-11-29T09:00:00.{index % 1000:03d}Z"),
+            "syncingTo" : "192.168.0.1:27001",
+            "infoMessage" : "sync source (re)selected, see ISODate(\\"...\\") for details",
+            "configVersion" : 3,
+            "replicaSetId" : ObjectId("61a48e8e0a0b0c0d0e0f{index % 65536:04x}"),
+            "keyId" : BinData(0,"AAAAAAAAAAAAAAAAAAAAAAAAAAA=")
+        }}""")
+    return '{\n    "set" : "rs0",\n    "ok" : 1,\n    "members" : [' + ','.join(members) + '\n    ]\n}'
+
+
+def benchmark_shell_jsonify(max_mb: int = 16, rounds: int = 3) -> dict:
+    """
+    time of ShellJsonify on synthetic rs.status() outputs of doubling size, time per MB should stay flat
+    :return: {size in MB: average seconds}
+    """
+    member_size = len(synthetic_replication_status(1))
+    result = {}
+    table = Table(title='ShellJsonify on synthetic rs.status() output')
+    table.add_column('size (MB)', justify='right')
+    table.add_column('members', justify='right')
+    table.add_column('seconds', justify='right')
+    table.add_column('seconds per MB', justify='right')
+    size_mb = 1
+    while size_mb <= max_mb:
+        member_count = size_mb * 1024 * 1024 // member_size
+        shell_output = synthetic_replication_status(member_count)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            ShellJsonify(shell_output).loads()
+        cost = (time.perf_counter() - start) / rounds
+        real_size_mb = len(shell_output) / 1024 / 1024
+        result.update({size_mb: cost})
+        table.add_row(f'{real_size_mb:.1f}', str(member_count), f'{cost:.3f}', f'{cost / real_size_mb:.3f}')
+        size_mb *= 2
+    console.print(table)
+    return result
+
+
+if __name__ == '__main__':
+    benchmark_shell_jsonify()
+    benchmark_extend_cmd_backends("mongodb://192.168.20.120:27001,192.168.20.170:27001,192.168.20.183:27001")
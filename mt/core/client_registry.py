@@ -0,0 +1,93 @@
+import atexit
+import threading
+from typing import Dict, Tuple
+
+from pymongo import MongoClient
+from pymongo.uri_parser import parse_uri
+
+from mt.conf.parser import global_config
+from mt.core.topology_model import topology_listener
+from mt.errors.errors import MongoURIException
+
+
+class MongoClientRegistry:
+    """
+    one MongoClient per normalized seed list and options for the whole process,
+    every acquire must be paired with a release, the client is closed when nobody holds it anymore
+    pool options are read from mongo_client_options of global config unless given explicitly
+    event_listeners are registered on every client unless event_listeners are given explicitly
+    """
+
+    def __init__(self, event_listeners: list = None):
+        self.event_listeners = event_listeners or []
+        self._clients: Dict[tuple, MongoClient] = {}
+        self._ref_counts: Dict[tuple, int] = {}
+        self._client_keys: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(mongo_uri: str, options: dict) -> Tuple[tuple, dict]:
+        """
+        :return: registry key and options passed to MongoClient
+        """
+        if not mongo_uri.startswith('mongodb://'):
+            raise MongoURIException()
+        parsed_uri = parse_uri(mongo_uri)
+        client_options = {x: y for x, y in global_config.get('mongo_client_options', {}).items()}
+        client_options.update(options)
+        seeds = tuple(sorted(f'{x.lower()}:{y}' for x, y in parsed_uri.get('nodelist')))
+        merged_options = {x.lower(): str(y) for x, y in parsed_uri.get('options').items()}
+        merged_options.update({x.lower(): str(y) for x, y in client_options.items()})
+        key = (seeds, parsed_uri.get('username'), parsed_uri.get('password'), parsed_uri.get('database'),
+               tuple(sorted(merged_options.items())))
+        return key, client_options
+
+    def acquire(self, mongo_uri: str, **options) -> MongoClient:
+        key, client_options = self.normalize(mongo_uri, options)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                if self.event_listeners and 'event_listeners' not in client_options:
+                    client_options.update({'event_listeners': self.event_listeners})
+                client = MongoClient(mongo_uri, **client_options)
+                self._clients.update({key: client})
+                self._client_keys.update({id(client): key})
+            self._ref_counts.update({key: self._ref_counts.get(key, 0) + 1})
+            return client
+
+    def acquire_direct(self, host: str, port: int, **options) -> MongoClient:
+        """
+        client connected to host:port only, without discovering the rest of the topology
+        """
+        options.update({'directConnection': True})
+        return self.acquire(f'mongodb://{host}:{port}', **options)
+
+    def release(self, client: MongoClient):
+        with self._lock:
+            key = self._client_keys.get(id(client))
+            if key is None:
+                return
+            ref_count = self._ref_counts.get(key) - 1
+            if ref_count > 0:
+                self._ref_counts.update({key: ref_count})
+                return
+            self._ref_counts.pop(key)
+            self._clients.pop(key)
+            self._client_keys.pop(id(client))
+        client.close()
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._ref_counts.clear()
+            self._client_keys.clear()
+        for client in clients:
+            client.close()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+client_registry = MongoClientRegistry([topology_listener])
+atexit.register(client_registry.close_all)
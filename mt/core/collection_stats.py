@@ -0,0 +1,110 @@
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+from mt.core.common import run_bounded
+
+Namespace = Tuple[str, str]
+
+
+def merge_collection_stats(shard_stats: List[dict], sharded: bool = False) -> dict:
+    """
+    merge storageStats of every shard returned by $collStats into the shape of collstats command,
+    like collstats the shards section is only there for sharded collections
+    """
+    reuse_bytes = 0
+    stats = {'count': 0, 'storageSize': 0, 'totalIndexSize': 0, 'indexSizes': {}, 'capped': False,
+             'sharded': sharded}
+    if sharded:
+        stats.update({'shards': {}})
+    for shard_stat in shard_stats:
+        storage_stats = shard_stat.get('storageStats', {})
+        if sharded:
+            stats['shards'].update({shard_stat.get('shard'): storage_stats})
+        stats['count'] += storage_stats.get('count', 0)
+        stats['storageSize'] += storage_stats.get('storageSize', 0)
+        stats['totalIndexSize'] += storage_stats.get('totalIndexSize', 0)
+        stats['capped'] = stats['capped'] or storage_stats.get('capped', False)
+        for index_name, index_size in storage_stats.get('indexSizes', {}).items():
+            stats['indexSizes'].update({index_name: stats['indexSizes'].get(index_name, 0) + index_size})
+        reuse_bytes += storage_stats.get('wiredTiger', {}).get('block-manager', {}).get(
+            'file bytes available for reuse', 0)
+    stats.update({'wiredTiger': {'block-manager': {'file bytes available for reuse': reuse_bytes}}})
+    return stats
+
+
+_size_keys = ['count', 'storageSize', 'totalIndexSize', 'indexSizes', 'capped']
+
+
+def trim_collection_stats(stats: dict) -> dict:
+    """
+    keep only the fields read by the profile table
+    """
+    trimmed = {x: stats.get(x) for x in _size_keys + ['name', 'sharded'] if x in stats}
+    reuse_bytes = stats.get('wiredTiger', {}).get('block-manager', {}).get('file bytes available for reuse', 0)
+    trimmed.update({'wiredTiger': {'block-manager': {'file bytes available for reuse': reuse_bytes}}})
+    if 'shards' in stats:
+        trimmed.update({'shards': {x: trim_collection_stats(y) for x, y in stats.get('shards').items()}})
+    return trimmed
+
+
+class CollectionStatsCollector:
+    """
+    collect collstats of many collections through mongos concurrently,
+    $collStats with storageStats is used if the server supports it, collstats command otherwise
+    """
+
+    def __init__(self, client: MongoClient, max_in_flight: int = 16, use_aggregation: Optional[bool] = None):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        if use_aggregation is None:
+            # shard field of $collStats output is available since 3.6
+            use_aggregation = client.server_info().get('versionArray', [0])[:2] >= [3, 6]
+        self.use_aggregation = use_aggregation
+        self._sharded_namespaces = None
+        self._sharded_namespaces_lock = threading.Lock()
+
+    @property
+    def sharded_namespaces(self) -> set:
+        with self._sharded_namespaces_lock:
+            if self._sharded_namespaces is None:
+                sharded_collections = self.client.get_database('config').get_collection('collections').find(
+                    {'dropped': {'$ne': True}}, {'_id': 1})
+                self._sharded_namespaces = {x.get('_id') for x in sharded_collections}
+            return self._sharded_namespaces
+
+    def list_namespaces(self, database_names: List[str]) -> List[Namespace]:
+        """
+        :return: namespaces of every database, in the order of database_names
+        """
+        collection_names = {}
+        for database_name, names, error in run_bounded(
+                lambda x: self.client.get_database(x).list_collection_names(), database_names, self.max_in_flight):
+            if error:
+                raise error
+            collection_names.update({database_name: names})
+        return [(x, y) for x in database_names for y in collection_names[x]]
+
+    def collect(self, namespace: Namespace) -> dict:
+        database_name, collection_name = namespace
+        database = self.client.get_database(database_name)
+        if self.use_aggregation:
+            try:
+                shard_stats = list(database.get_collection(collection_name).aggregate(
+                    [{'$collStats': {'storageStats': {}}}]))
+                stats = merge_collection_stats(
+                    shard_stats, f'{database_name}.{collection_name}' in self.sharded_namespaces)
+            except OperationFailure:
+                stats = database.command('collstats', collection_name)
+        else:
+            stats = database.command('collstats', collection_name)
+        stats.update({'name': collection_name})
+        return trim_collection_stats(stats)
+
+    def collect_many(self, namespaces: Iterable[Namespace]) -> Iterator[tuple]:
+        """
+        :return: (namespace, stats, error) in completion order
+        """
+        return run_bounded(self.collect, namespaces, self.max_in_flight)
@@ -1,9 +1,17 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from enum import Enum
+from typing import Callable, Iterable, Iterator, Optional
+
+
+def format_timestamp(timestamp: datetime) -> str:
+    return timestamp.astimezone().strftime('%Y-%m-%d %H:%M:%S')
 
 
 def convert_timestamp_to_str(timestamp: datetime) -> str:
-    timestamp_str = timestamp.astimezone().strftime('%Y-%m-%d %H:%M:%S')
+    timestamp_str = format_timestamp(timestamp)
     return f'"{timestamp_str}"'
 
 
@@ -11,3 +19,58 @@ class ReplicationRole(Enum):
     PRIMARY = 'PRIMARY'
     SECONDARY = 'SECONDARY'
     OFFLINE = '(not reachable/healthy)'
+
+
+def run_bounded(func, items: Iterable, max_in_flight: int) -> Iterator[tuple]:
+    """
+    call func on every item with at most max_in_flight calls running at the same time
+    :return: (item, result, error) in completion order
+    """
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        future_items = {executor.submit(func, item): item for item in items}
+        for future in as_completed(future_items):
+            item = future_items[future]
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+
+class CachedValue:
+    """
+    value loaded by loader on first get, loaded again on get once older than ttl seconds,
+    ttl None keeps it until refresh or invalidate
+    """
+
+    def __init__(self, loader: Callable, ttl: Optional[float] = None):
+        self.loader = loader
+        self.ttl = ttl
+        self._value = None
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    def _is_fresh(self) -> bool:
+        return self._loaded_at is not None and (self.ttl is None or time.monotonic() - self._loaded_at < self.ttl)
+
+    def get(self):
+        with self._lock:
+            if not self._is_fresh():
+                self._load()
+            return self._value
+
+    def refresh(self):
+        with self._lock:
+            self._load()
+            return self._value
+
+    def _load(self):
+        self._value = self.loader()
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
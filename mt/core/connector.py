@@ -1,148 +1,444 @@
+import queue
+import threading
+import time
 from collections import namedtuple
 from copy import deepcopy
 from datetime import datetime
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set, Tuple
 
-from pymongo import MongoClient
 from rich.console import Console
-from rich.progress import track
-
-from mt.core.common import ReplicationRole
-from mt.core.extend_cmd import ExtendCmd, ReplicationStatus, ReplicationConf, PrimaryOplogInfo, OplogDiffInfo
+from rich.progress import track, Progress
+
+from mt.conf.parser import global_config
+from mt.core.client_registry import client_registry
+from mt.core.collection_stats import CollectionStatsCollector
+from mt.core.common import CachedValue, ReplicationRole
+from mt.core.extend_cmd import create_extend_cmd, ReplicationStatus, ReplicationConf, PrimaryOplogInfo, OplogDiffInfo
+from mt.core.profile_snapshot import ProfileSnapshotStore
+from mt.core.profile_table import ProfileTable, DatabaseView
+from mt.core.stats_cache import CollectionStatsCache
+from mt.core.topology_model import topology_model, Election, MemberState
 from mt.errors.errors import MongoURIException, NotSharingException, NotReplicationException
 
 console = Console()
 
 Address = namedtuple('Address', ['ip', 'port'])
 
+# seconds a queried topology value is kept before it is queried again on access
+default_topology_ttl = {
+    'server_status': 10,
+    'shard_hosts': 300,
+    'replication_status': 10,
+    'replication_conf': 300,
+    'oplog_info': 30,
+    'oplog_lag_info': 10
+}
+
+
+def topology_ttl(name: str) -> float:
+    return global_config.get('topology_ttl', {}).get(name, default_topology_ttl.get(name))
+
 
 class ShardingCluster:
     """
     try to connect to mongos of a mongo cluster
+    config server and shards are connected on first access of them, mongos server status and the shard list
+    are queried on first access and cached for their ttl
+    config server and shards are initialized by at most max_workers threads,
+    a shard not initialized within shard_timeout seconds is recorded in failed_shards,
+    an error of the config server in config_server_error
     """
 
-    def __init__(self, mongo_uri: str):
+    def __init__(self, mongo_uri: str, max_workers: int = 8, shard_timeout: float = 120):
         if not mongo_uri.startswith('mongodb://'):
             raise MongoURIException()
-        self.basic_connection = MongoClient(mongo_uri)
+        self.basic_connection = client_registry.acquire(mongo_uri)
         is_mongos = self.basic_connection.is_mongos
         if not is_mongos:
+            client_registry.release(self.basic_connection)
             raise NotSharingException()
-        self._server_status = self.refresh_cluster_server_status()
+        self._server_status = CachedValue(lambda: self.basic_connection.get_database('test').command('serverStatus'),
+                                          topology_ttl('server_status'))
+        self._shard_hosts = CachedValue(self.discover_shards, topology_ttl('shard_hosts'))
         self._config_server = None
         self._shards = {}
-        self._database_profile: List[DatabaseInfo] = []
-        console.print("START INIT SHARDING CLUSTER", style="bold green blink")
-        self.init_sharding_cluster()
-        console.print("SHARDING CLUSTER INIT SUCCESS", style="bold green blink")
+        self._failed_shards = {}
+        self._config_server_error: Optional[str] = None
+        self.max_workers = max_workers
+        self.shard_timeout = shard_timeout
+        self._database_profile: List[DatabaseView] = []
+        self._profile_table: ProfileTable = None
+        self.stats_cache: CollectionStatsCache = None
+        self._hydrated = False
+        self._hydrate_lock = threading.Lock()
+
+    def hydrate(self):
+        """
+        connect to the config server and all shards on first access of them
+        """
+        if self._hydrated:
+            return
+        with self._hydrate_lock:
+            if self._hydrated:
+                return
+            console.print("START INIT SHARDING CLUSTER", style="bold green blink")
+            self.init_sharding_cluster()
+            console.print("SHARDING CLUSTER INIT SUCCESS", style="bold green blink")
+            self._hydrated = True
 
     @property
     def config_server(self):
+        self.hydrate()
         return self._config_server
 
     @property
     def shards(self):
+        self.hydrate()
         return self._shards
 
+    @property
+    def failed_shards(self):
+        self.hydrate()
+        return self._failed_shards
+
+    @property
+    def config_server_error(self) -> Optional[str]:
+        self.hydrate()
+        return self._config_server_error
+
     @property
     def server_status(self):
-        return self._server_status
+        return self._server_status.get()
+
+    @property
+    def shard_hosts(self) -> Dict[str, dict]:
+        return self._shard_hosts.get()
 
     @property
     def database_profile(self):
         return self._database_profile
 
-    def refresh_cluster_server_status(self):
-        server_status = self.basic_connection.get_database('test').command('serverStatus')
-        return server_status
-
-    def init_config_server(self):
-        config_server_info = self.server_status.get('sharding', {})
-        connection_str = config_server_info.get('configsvrConnectionString').replace('cfgset/', 'mongodb://')
-        self._config_server = ConfigServer(connection_str)
+    @property
+    def profile_table(self):
+        return self._profile_table
+
+    def close(self):
+        """
+        release clients of mongos, config server and all shards
+        """
+        if self._config_server is not None:
+            self._config_server.close()
+        for shard in self._shards.values():
+            if shard is not None:
+                shard.close()
+        client_registry.release(self.basic_connection)
 
-    def init_sharding(self):
-        config_database = self.basic_connection.get_database('config')
-        for shard_info in track(list(config_database.get_collection('shards').find()), description="Init shard..."):
+    def refresh_cluster_server_status(self):
+        return self._server_status.refresh()
+
+    def discover_shards(self) -> Dict[str, dict]:
+        """
+        shards from config.shards without connecting to them
+        :return: {shard id: {'uri', 'state'}} in the order of config.shards
+        """
+        shard_hosts = {}
+        for shard_info in self.basic_connection.get_database('config').get_collection('shards').find():
             host = shard_info.get('host')
-            shard_id = shard_info.get('_id')
-            shard_status = shard_info.get('state')
-            connection_str = f'mongodb://{host.split("/")[1]}'
-            if shard_status == 1:
-                shard_server = Shard(connection_str)
-            else:
-                shard_server = None
-            self._shards.update({shard_id: shard_server})
+            shard_hosts.update({shard_info.get('_id'): {'uri': f'mongodb://{host.split("/")[1]}',
+                                                        'state': shard_info.get('state')}})
+        return shard_hosts
+
+    def refresh(self):
+        """
+        query mongos server status and shard list again, replication sets already connected are refreshed too
+        """
+        self._server_status.refresh()
+        self._shard_hosts.refresh()
+        if self._hydrated:
+            replication_sets = [self._config_server] + list(self._shards.values())
+            for replication_set in replication_sets:
+                if replication_set is not None:
+                    replication_set.refresh()
+
+    def get_config_server_uri(self) -> str:
+        config_server_info = self.server_status.get('sharding', {})
+        _, hosts = config_server_info.get('configsvrConnectionString').split('/', 1)
+        return f'mongodb://{hosts}'
 
-    def profile_databases(self):
+    def init_config_server(self):
+        self._config_server = ConfigServer(self.get_config_server_uri())
+
+    def init_sharding(self, with_config_server: bool = False):
+        init_jobs = []
+        if with_config_server:
+            init_jobs.append(('config server', ConfigServer, self.get_config_server_uri()))
+        for shard_id, shard_host in self.shard_hosts.items():
+            # keep the order of config.shards
+            self._shards.update({shard_id: None})
+            if shard_host.get('state') == 1:
+                init_jobs.append((shard_id, Shard, shard_host.get('uri')))
+        initialized, failed = self.init_replication_sets(init_jobs, description="Init shard...")
+        if with_config_server:
+            self._config_server = initialized.pop('config server', None)
+            self._config_server_error = failed.pop('config server', None)
+        self._shards.update(initialized)
+        self._failed_shards.update(failed)
+
+    def init_replication_sets(self, init_jobs: list, description: str) -> Tuple[dict, dict]:
+        """
+        build replication sets concurrently with at most max_workers daemon threads,
+        every job is (name, replication set class, mongo uri)
+        a job not finished within shard_timeout seconds is given up, its thread keeps running in the background
+        without blocking interpreter exit, and a replication set it creates later is closed right away
+        :return: {name: replication set} of the jobs finished in time, {name: error} of the others
+        """
+        initialized, failed = {}, {}
+        started_at = {}
+        results = queue.Queue()
+        jobs = queue.Queue()
+        for job in init_jobs:
+            jobs.put(job)
+        given_up = set()
+        lock = threading.Lock()
+
+        def init_worker():
+            while True:
+                try:
+                    name, replication_class, mongo_uri = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                with lock:
+                    started_at.update({name: time.monotonic()})
+                try:
+                    replication_set, error = replication_class(mongo_uri), None
+                except Exception as e:
+                    replication_set, error = None, e
+                with lock:
+                    late = name in given_up
+                    if not late:
+                        results.put((name, replication_set, error))
+                if late and replication_set is not None:
+                    replication_set.close()
+
+        for _ in range(min(self.max_workers, len(init_jobs))):
+            threading.Thread(target=init_worker, daemon=True).start()
+        pending = {x[0] for x in init_jobs}
+        with Progress(console=console) as progress:
+            task = progress.add_task(description, total=len(pending))
+            while pending:
+                try:
+                    name, replication_set, error = results.get(timeout=1)
+                except queue.Empty:
+                    name = None
+                if name is not None and name in given_up:
+                    # queued before its job was given up and read after, it is reported failed already
+                    if replication_set is not None:
+                        replication_set.close()
+                elif name is not None:
+                    pending.discard(name)
+                    if error is None:
+                        initialized.update({name: replication_set})
+                    else:
+                        failed.update({name: str(error)})
+                        console.print(f'init {name} failed # {error}', style='red')
+                    progress.advance(task)
+                now = time.monotonic()
+                with lock:
+                    for name in list(pending):
+                        if name in started_at and now - started_at[name] > self.shard_timeout:
+                            pending.discard(name)
+                            given_up.add(name)
+                            failed.update({name: f'init timeout after {self.shard_timeout}s'})
+                            console.print(f'init {name} timeout', style='red')
+                            progress.advance(task)
+        # a result queued just before its job was given up is released too
+        while not results.empty():
+            name, replication_set, _ = results.get_nowait()
+            if name in given_up and replication_set is not None:
+                replication_set.close()
+        return initialized, failed
+
+    def get_stats_cache(self) -> CollectionStatsCache:
+        if self.stats_cache is None:
+            cache_config = global_config.get('stats_cache', {})
+            self.stats_cache = CollectionStatsCache(cache_config.get('path'), cache_config.get('ttl', 3600),
+                                                    cache_config.get('max_entries', 100000))
+        return self.stats_cache
+
+    def profile_databases(self, max_in_flight: int = 16, verbose: bool = False, incremental: bool = False):
+        """
+        collect stats of all collections with at most max_in_flight requests running at the same time
+        :param verbose: print every profiled collection
+        :param incremental: only collect collections whose cheap signals moved since they were cached
+        """
         self._database_profile.clear()
-        mongo_client = self.basic_connection
-        for database_info in mongo_client.list_databases():
-            target_db_name = database_info.get('name')
-            target_db = self.basic_connection.get_database(target_db_name)
-            all_names = target_db.list_collection_names()
-            collection_of_database = []
-            size_on_disk = 0
-            size_on_shards = {}
-            for collection in track(list(all_names),
-                                    description=f"profiling collection of database:{target_db_name}..."):
-                console.print(f'profiling collection:{collection}')
-                stats = target_db.command("collstats", collection)
-                stats.update({'name': collection})
-                target_collection_info = CollectionInfo(stats)
-                collection_of_database.append(target_collection_info)
-                size_on_disk += target_collection_info.basic_size_info.storage_size
-                for shard_name, storage in target_collection_info.sharding_detail.items():
-                    current_size = size_on_shards.get(shard_name, 0) + storage.storage_size
-                    size_on_shards.update({shard_name: current_size})
-            database = DatabaseInfo(target_db.name, size_on_disk, size_on_shards, collection_of_database)
-            self._database_profile.append(database)
+        collector = CollectionStatsCollector(self.basic_connection, max_in_flight)
+        database_names = [x.get('name') for x in self.basic_connection.list_databases()]
+        if incremental:
+            stats_cache = self.get_stats_cache()
+            namespaces, cached_stats, stale_signals = stats_cache.plan_refresh(collector, database_names)
+            target_namespaces = list(stale_signals)
+            console.print(f'{len(cached_stats)} collections unchanged, {len(target_namespaces)} to profile',
+                          style='bold')
+        else:
+            stats_cache = None
+            namespaces = collector.list_namespaces(database_names)
+            cached_stats = {}
+            stale_signals = {}
+            target_namespaces = namespaces
+        collection_stats = dict(cached_stats)
+        for namespace, stats, error in track(collector.collect_many(target_namespaces), total=len(target_namespaces),
+                                             description="profiling collections..."):
+            database_name, collection_name = namespace
+            if error:
+                console.print(f'profiling collection:{database_name}.{collection_name} failed # {error}', style='red')
+                continue
+            if verbose:
+                console.print(f'profiling collection:{database_name}.{collection_name}')
+            collection_stats.update({namespace: stats})
+            if stats_cache is not None:
+                stats_cache.put(f'{database_name}.{collection_name}', stale_signals.get(namespace), stats)
+        if stats_cache is not None:
+            stats_cache.save()
+        profile_table = ProfileTable()
+        for database_name in database_names:
+            profile_table.add_database(database_name)
+        for namespace in namespaces:
+            if namespace in collection_stats:
+                profile_table.add_collection(namespace[0], collection_stats.pop(namespace))
+        self._profile_table = profile_table
+        self._database_profile.extend(profile_table.databases())
+        snapshot_store = ProfileSnapshotStore.from_config()
+        if snapshot_store is not None:
+            snapshot_path = snapshot_store.save(profile_table, {'shards': list(self.shard_hosts)})
+            console.print(f'profile snapshot saved to {snapshot_path}', style='bold')
         console.print('PROFILE COMPLETE', style='bold')
 
     def init_sharding_cluster(self):
-        # init config server
-        console.print("start init config server", style="bold")
-        self.init_config_server()
-        # init shards
-        console.print("start init shards", style="bold")
-        self.init_sharding()
+        # init config server and shards
+        console.print("start init config server and shards", style="bold")
+        self.init_sharding(with_config_server=True)
         # get statistics info of shard cluster
         console.print("start init databases", style="bold")
         # self.profile_databases()
 
 
 class ReplicationSet:
+    """
+    only connects to the replication set when created, membership comes from the driver's topology,
+    replication status, config and oplog info are queried on first access and cached for their ttl
+    role, heartbeat round trip time and elections of members are kept up to date by driver monitoring events
+    """
+
     def __init__(self, mongo_uri: str):
         if not mongo_uri.startswith('mongodb://'):
             raise MongoURIException()
-        self.basic_connection = MongoClient(mongo_uri)
+        self.basic_connection = client_registry.acquire(mongo_uri)
         is_mongos = self.basic_connection.is_mongos
         if is_mongos:
+            client_registry.release(self.basic_connection)
             raise NotReplicationException()
         self.name = self.basic_connection.topology_description.replica_set_name
-        self.primary_info = self.basic_connection.primary
-        self.secondaries_info = self.basic_connection.secondaries
-        self.arbiters_info = self.basic_connection.arbiters
-        self.replication_status: ReplicationStatus = None
-        self.replication_conf: ReplicationConf = None
-        self.oplog_info: PrimaryOplogInfo = None
-        self.oplog_lag_info: OplogDiffInfo = None
-        self.get_replication_status()
-        self.get_oplog_status()
-        self.replication_member_set = ReplicationMemberSet(self.replication_status, self.replication_conf,
-                                                           self.oplog_info, self.oplog_lag_info)
+        self._extend_cmd = None
+        self._extend_cmd_primary = None
+        self._cached = {
+            'replication_status': CachedValue(lambda: self.extend_cmd.get_replication_status(),
+                                              topology_ttl('replication_status')),
+            'replication_conf': CachedValue(lambda: self.extend_cmd.get_replication_conf(),
+                                            topology_ttl('replication_conf')),
+            'oplog_info': CachedValue(lambda: self.extend_cmd.get_primary_replication_info(),
+                                      topology_ttl('oplog_info')),
+            'oplog_lag_info': CachedValue(lambda: self.extend_cmd.get_slave_replication_info(),
+                                          topology_ttl('oplog_lag_info'))
+        }
+        self._member_set: ReplicationMemberSet = None
+        self._member_set_sources = None
+
+    @property
+    def primary_info(self) -> tuple:
+        return self.basic_connection.primary or self._extend_cmd_primary
+
+    @property
+    def secondaries_info(self) -> Set[tuple]:
+        return self.basic_connection.secondaries
+
+    @property
+    def arbiters_info(self) -> Set[tuple]:
+        return self.basic_connection.arbiters
+
+    @property
+    def members(self) -> List[MemberState]:
+        """
+        live state of the members from driver monitoring events, no query is sent
+        """
+        return topology_model.members_of(self.name)
+
+    @property
+    def elections(self) -> List[Election]:
+        return topology_model.elections(self.name)
+
+    @property
+    def election_count(self) -> int:
+        return topology_model.election_count(self.name)
+
+    def close(self):
+        client_registry.release(self.basic_connection)
+
+    @property
+    def extend_cmd(self):
+        primary_info = self.primary_info
+        if self._extend_cmd is None or primary_info != self._extend_cmd_primary:
+            # shell fallback has to follow a new primary
+            self._extend_cmd = create_extend_cmd(*primary_info, client=self.basic_connection)
+            self._extend_cmd_primary = primary_info
+        return self._extend_cmd
+
+    @property
+    def replication_status(self) -> ReplicationStatus:
+        return self._cached['replication_status'].get()
+
+    @property
+    def replication_conf(self) -> ReplicationConf:
+        return self._cached['replication_conf'].get()
+
+    @property
+    def oplog_info(self) -> PrimaryOplogInfo:
+        return self._cached['oplog_info'].get()
+
+    @property
+    def oplog_lag_info(self) -> OplogDiffInfo:
+        return self._cached['oplog_lag_info'].get()
+
+    @property
+    def replication_member_set(self) -> 'ReplicationMemberSet':
+        """
+        built again only when one of the values it is built from was queried again
+        """
+        sources = (self.replication_status, self.replication_conf, self.oplog_info, self.oplog_lag_info)
+        if self._member_set_sources is None or any(x is not y for x, y in zip(sources, self._member_set_sources)):
+            self._member_set = ReplicationMemberSet(*sources)
+            self._member_set_sources = sources
+        return self._member_set
+
+    def refresh(self, names: List[str] = None):
+        """
+        query cached values again now, all of them if names is not given
+        """
+        for name in names or list(self._cached):
+            self._cached[name].refresh()
+
+    def invalidate(self, names: List[str] = None):
+        """
+        drop cached values so that they are queried again on next access
+        """
+        for name in names or list(self._cached):
+            self._cached[name].invalidate()
 
     def get_oplog_status(self):
-        mongos_host, mongos_port = self.primary_info
-        mongos_cmd = ExtendCmd(mongos_host, mongos_port)
-        self.oplog_info = mongos_cmd.get_primary_replication_info()
-        self.oplog_lag_info = mongos_cmd.get_slave_replication_info()
+        self.refresh(['oplog_info', 'oplog_lag_info'])
 
     def get_replication_status(self):
-        mongos_host, mongos_port = self.primary_info
-        mongos_cmd = ExtendCmd(mongos_host, mongos_port)
-        self.replication_status = mongos_cmd.get_replication_status()
-        self.replication_conf = mongos_cmd.get_replication_conf()
+        self.refresh(['replication_status', 'replication_conf'])
 
 
 class ReplicationMemberSet:
@@ -224,82 +520,5 @@ class Shard(ReplicationSet):
         super(Shard, self).__init__(mongo_uri)
 
 
-class BasicSizeInfo:
-    __slots__ = ['count', 'reuse_size', 'total_index_size', 'index_size_detail', 'storage_size']
-
-    def __init__(self, size_info: dict):
-        for key, value in size_info.items():
-            setattr(self, key, value)
-
-    def __repr__(self):
-        response = {}
-        for x in self.__slots__:
-            response.update({x: getattr(self, x)})
-        return str(response)
-
-
-class CollectionInfo:
-    __slots__ = ["name", "sharded", "capped", "basic_size_info", "sharding_detail"]
-
-    def __init__(self, stats: dict, scale=1024 * 1024):
-        self.name = stats.get('name')
-        self.sharded = stats.get('sharded')
-        self.capped = stats.get('capped')
-        self.basic_size_info = self.parse_size_info(stats, scale)
-        sharding_info = stats.get('shards', {})
-        self.sharding_detail = {}
-        for shard_name, detail in sharding_info.items():
-            sharding_size_info = self.parse_size_info(detail, scale)
-            self.sharding_detail.update({shard_name: sharding_size_info})
-
-    @staticmethod
-    def parse_size_info(stats: dict, scale: int) -> BasicSizeInfo:
-        response = {}
-        response.update({'count': stats.get('count')})
-
-        reuse_bytes = stats.get('wiredTiger').get('block-manager').get('file bytes available for reuse')
-        reuse_mb = reuse_bytes // scale
-        response.update({'reuse_size': reuse_mb})
-
-        total_index_size = stats.get('totalIndexSize')
-        index_mb = total_index_size // scale
-        response.update({'total_index_size': index_mb})
-
-        index_size_detail_origin = stats.get('indexSizes', {})
-        index_size_detail = {}
-        for _index_name, _index_size in index_size_detail_origin.items():
-            index_size_detail.update({_index_name: _index_size // scale})
-        response.update({'index_size_detail': index_size_detail})
-
-        storage_size = stats.get('storageSize')
-        data_mb = storage_size // scale
-        response.update({'storage_size': data_mb})
-
-        return BasicSizeInfo(response)
-
-    def __repr__(self):
-        response = {}
-        for x in self.__slots__:
-            response.update({x: getattr(self, x)})
-        return str(response)
-
-
-class DatabaseInfo:
-    __slots__ = ["database_name", "size_on_disk", "size_on_shards", "collections"]
-
-    def __init__(self, database_name: str, size_on_disk: int, size_on_shards: Dict[str, int],
-                 collections: List[CollectionInfo]):
-        self.database_name = database_name
-        self.size_on_disk = size_on_disk
-        self.size_on_shards = size_on_shards
-        self.collections = collections
-
-    def __repr__(self):
-        response = {}
-        for x in self.__slots__:
-            response.update({x: getattr(self, x)})
-        return str(response)
-
-
 if __name__ == '__main__':
     c = ShardingCluster("mongodb://192.168.20.120:27010,192.168.20.170:27010,192.168.20.183:27010")
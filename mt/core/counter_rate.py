@@ -0,0 +1,195 @@
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from bson import SON
+
+from mt.core.client_registry import client_registry
+from mt.core.common import run_bounded
+
+MONGOS_GROUP = 'mongos'
+CONFIG_GROUP = 'config'
+
+_counter_prefixes = ('opcounters.', 'opcountersRepl.', 'network.bytes', 'network.physicalBytes',
+                     'network.numRequests', 'asserts.', 'metrics.', 'wiredTiger.', 'transactions.total',
+                     'extra_info.page_faults', 'connections.totalCreated')
+# sections below counter prefixes which are gauges
+_gauge_markers = ('currently', 'in the cache', 'configured', 'maximum', 'concurrentTransactions', 'cursor.open')
+
+
+def is_cumulative_counter(name: str) -> bool:
+    return name.startswith(_counter_prefixes) and not any(x in name for x in _gauge_markers)
+
+
+def flatten_counters(document: dict, counter_filter: Callable[[str], bool] = is_cumulative_counter) -> Dict[str, float]:
+    """
+    numeric leaves of serverStatus as {'opcounters.insert': 1.0, ...}
+    """
+    counters = {}
+    stack = [('', document)]
+    while stack:
+        prefix, section = stack.pop()
+        for key, value in section.items():
+            name = f'{prefix}{key}'
+            if isinstance(value, dict):
+                stack.append((f'{name}.', value))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) and counter_filter(name):
+                counters.update({name: float(value)})
+    return counters
+
+
+class CounterSnapshot:
+    """
+    counters of every node at one moment: node -> {'group', 'time', 'uptime', 'counters'}
+    group is the shard id, config or mongos
+    """
+    __slots__ = ['nodes', 'errors']
+
+    def __init__(self, nodes: Dict[str, dict], errors: Dict[str, str] = None):
+        self.nodes = nodes
+        self.errors = errors or {}
+
+    def __repr__(self):
+        return f'CounterSnapshot(nodes={len(self.nodes)}, errors={len(self.errors)})'
+
+
+class CounterRates:
+    """
+    per second rates of every counter of every node present in two snapshots, one row per node
+    """
+
+    def __init__(self, nodes: List[str], groups: List[str], names: List[str], rates: np.ndarray,
+                 elapsed: np.ndarray, resets: np.ndarray):
+        self.nodes = nodes
+        self.groups = groups
+        self.names = names
+        self.rates = rates
+        self.elapsed = elapsed
+        self.resets = resets
+        self._name_index = {x: i for i, x in enumerate(names)}
+
+    def _columns(self, names: Optional[List[str]]) -> List[int]:
+        if names is None:
+            return list(range(len(self.names)))
+        return [self._name_index[x] for x in names if x in self._name_index]
+
+    def node_rates(self, node: str, names: List[str] = None) -> Dict[str, float]:
+        row = self.rates[self.nodes.index(node)]
+        return {self.names[x]: float(row[x]) for x in self._columns(names) if not np.isnan(row[x])}
+
+    def group_rates(self, names: List[str] = None) -> Dict[str, Dict[str, float]]:
+        """
+        :return: {group: {counter: summed rate of its nodes}}
+        """
+        if not self.nodes:
+            return {}
+        columns = self._columns(names)
+        group_names, inverse = np.unique(np.array(self.groups), return_inverse=True)
+        sums = np.zeros((len(group_names), len(columns)))
+        np.add.at(sums, inverse.reshape(-1), np.nan_to_num(self.rates[:, columns]))
+        return {str(group): {self.names[x]: float(sums[i, j]) for j, x in enumerate(columns)}
+                for i, group in enumerate(group_names)}
+
+    def cluster_rates(self, names: List[str] = None) -> Dict[str, float]:
+        """
+        summed rates of all shard members, mongos and config server are left out
+        since the operations they route are counted again on the shards
+        """
+        columns = self._columns(names)
+        mask = np.array([x not in (MONGOS_GROUP, CONFIG_GROUP) for x in self.groups], dtype=bool)
+        if not mask.any():
+            return {self.names[x]: 0.0 for x in columns}
+        sums = np.nansum(self.rates[mask][:, columns], axis=0)
+        return {self.names[x]: float(sums[j]) for j, x in enumerate(columns)}
+
+
+def compute_counter_rates(previous: CounterSnapshot, current: CounterSnapshot) -> CounterRates:
+    """
+    rates of all counters of all nodes in one batch
+    a node restarted between the snapshots (uptime went back) counts from zero over its uptime,
+    a single counter that went back (wrapped or reset) counts from zero as well
+    """
+    nodes = [x for x in current.nodes if x in previous.nodes]
+    names = sorted({y for x in nodes for y in current.nodes[x].get('counters')})
+    name_index = {x: i for i, x in enumerate(names)}
+    before = np.full((len(nodes), len(names)), np.nan)
+    after = np.full((len(nodes), len(names)), np.nan)
+    for row, node in enumerate(nodes):
+        for matrix, snapshot in ((before, previous), (after, current)):
+            counters = snapshot.nodes[node].get('counters')
+            columns = [name_index[x] for x in counters if x in name_index]
+            matrix[row, columns] = [counters[x] for x in counters if x in name_index]
+
+    times = np.array([[previous.nodes[x].get('time'), current.nodes[x].get('time')] for x in nodes],
+                     dtype=float).reshape(-1, 2)
+    uptimes = np.array([[previous.nodes[x].get('uptime') or 0, current.nodes[x].get('uptime') or 0]
+                        for x in nodes], dtype=float).reshape(-1, 2)
+    elapsed = times[:, 1] - times[:, 0]
+    resets = uptimes[:, 1] < uptimes[:, 0]
+    elapsed = np.where(resets, np.minimum(elapsed, uptimes[:, 1]), elapsed)
+
+    delta = after - before
+    counter_resets = (delta < 0) | resets[:, None]
+    delta = np.where(counter_resets, after, delta)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates = np.where(elapsed[:, None] > 0, delta / elapsed[:, None], np.nan)
+    return CounterRates(nodes, [current.nodes[x].get('group') for x in nodes], names, rates, elapsed, resets)
+
+
+class CounterSampler:
+    """
+    take serverStatus counters of mongos and every member of the config server and shards concurrently,
+    clients of the members are kept until close
+    """
+
+    def __init__(self, cluster, timeout: float = 5, max_in_flight: int = 16,
+                 counter_filter: Callable[[str], bool] = is_cumulative_counter):
+        self.cluster = cluster
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.counter_filter = counter_filter
+        self._clients = {}
+
+    def targets(self) -> Dict[str, tuple]:
+        """
+        :return: {'host:port': (host, port, group)}
+        """
+        targets = {f'{x}:{y}': (x, y, MONGOS_GROUP) for x, y in self.cluster.basic_connection.nodes}
+        groups = [(CONFIG_GROUP, self.cluster.config_server)] + list(self.cluster.shards.items())
+        for group, replication in groups:
+            if replication is None:
+                continue
+            for member in replication.replication_member_set.member_set:
+                if member.role == 'ARBITER':
+                    continue
+                host, port = member.address.ip, int(member.address.port)
+                targets.update({f'{host}:{port}': (host, port, group)})
+        return targets
+
+    def _server_status(self, target: tuple) -> dict:
+        host, port, group = target
+        client = self._clients.get((host, port))
+        if client is None:
+            timeout_ms = int(self.timeout * 1000)
+            client = client_registry.acquire_direct(host, port, serverSelectionTimeoutMS=timeout_ms,
+                                                    connectTimeoutMS=timeout_ms, socketTimeoutMS=timeout_ms)
+            self._clients.update({(host, port): client})
+        document = client.admin.command(SON([('serverStatus', 1), ('locks', 0), ('tcmalloc', 0)]))
+        return {'group': group, 'time': time.time(), 'uptime': document.get('uptime'),
+                'counters': flatten_counters(document, self.counter_filter)}
+
+    def snapshot(self) -> CounterSnapshot:
+        targets = self.targets()
+        nodes, errors = {}, {}
+        for name, result, error in run_bounded(lambda x: self._server_status(targets[x]), list(targets),
+                                               self.max_in_flight):
+            if error:
+                errors.update({name: str(error)})
+            else:
+                nodes.update({name: result})
+        return CounterSnapshot(nodes, errors)
+
+    def close(self):
+        for client in self._clients.values():
+            client_registry.release(client)
+        self._clients.clear()
@@ -1,105 +1,111 @@
+import codecs
+import re
 import subprocess
-from datetime import datetime
+from datetime import datetime, timezone
 from json import loads
-from typing import Optional
+from typing import Optional, Union
 
+from bson import Binary, Decimal128, Int64, ObjectId, Timestamp
 from dateutil import parser
+from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo.errors import PyMongoError
+from rich.console import Console
 
-from mt.core.common import convert_timestamp_to_str
+from mt.conf.parser import global_config
+from mt.core.client_registry import client_registry
+from mt.core.common import convert_timestamp_to_str, format_timestamp
 from mt.errors.errors import ExtendCmdException
 
+console = Console()
+
 
 class ShellJsonify:
+    """
+    rewrite the extended json constructors of mongo shell output in a single pass,
+    string literals are matched as a whole so that constructors or parentheses inside them are kept
+    """
     _special = {
-        'ISODate(': 'find_iso_date_value',
-        'NumberLong(': 'find_number_long_value',
-        'Timestamp(': 'find_timestamp_value',
-        'BinData(': 'find_binary_value',
-        'ObjectId(': 'find_object_id_value'
+        'ISODate': 'convert_iso_date_value',
+        'NumberLong': 'convert_number_long_value',
+        'Timestamp': 'convert_timestamp_value',
+        'BinData': 'convert_binary_value',
+        'ObjectId': 'convert_object_id_value'
     }
+    _string_pattern = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+    _token_pattern = re.compile(
+        f'{_string_pattern}|({"|".join(_special)})\\(((?:{_string_pattern}|[^()"])*)\\)')
 
     @staticmethod
-    def extract_target_value(origin_str: str, start_index: int) -> str:
-        target_end_index = origin_str.index(')', start_index)
-        target_special_value = origin_str[start_index: target_end_index + 1]
-        return target_special_value
-
-    def find_iso_date_value(self, origin_str: str, start_index: int):
-        target_special_value = self.extract_target_value(origin_str, start_index)
-        if target_special_value in self._replace_mapper:
-            return
-        time_str = target_special_value.split('"')[1]
+    def convert_iso_date_value(argument: str) -> str:
+        time_str = argument.split('"')[1]
         timestamp = parser.parse(time_str)
-        converted_timestamp_str = convert_timestamp_to_str(timestamp)
-        self._replace_mapper.update({target_special_value: converted_timestamp_str})
+        return convert_timestamp_to_str(timestamp)
 
-    def find_number_long_value(self, origin_str: str, start_index: int):
-        target_special_value = self.extract_target_value(origin_str, start_index)
-        if target_special_value in self._replace_mapper:
-            return
-        target_str = target_special_value[11:-1]
-        self._replace_mapper.update({target_special_value: target_str})
+    @staticmethod
+    def convert_number_long_value(argument: str) -> str:
+        return argument
 
-    def find_timestamp_value(self, origin_str: str, start_index: int):
-        target_special_value = self.extract_target_value(origin_str, start_index)
-        if target_special_value in self._replace_mapper:
-            return
-        last_index = target_special_value.index(',')
-        target_timestamp = target_special_value[10:last_index]
+    @staticmethod
+    def convert_timestamp_value(argument: str) -> str:
+        target_timestamp = argument.split(',')[0]
         timestamp = datetime.utcfromtimestamp(int(target_timestamp))
-        converted_timestamp_str = convert_timestamp_to_str(timestamp)
-        self._replace_mapper.update({target_special_value: converted_timestamp_str})
+        return convert_timestamp_to_str(timestamp)
 
-    def find_binary_value(self, origin_str: str, start_index: int):
-        target_special_value = self.extract_target_value(origin_str, start_index)
-        if target_special_value in self._replace_mapper:
-            return
-        self._replace_mapper.update({target_special_value: '"binary_data"'})
+    @staticmethod
+    def convert_binary_value(argument: str) -> str:
+        return '"binary_data"'
 
-    def find_object_id_value(self, origin_str: str, start_index: int):
-        target_special_value = self.extract_target_value(origin_str, start_index)
-        if target_special_value in self._replace_mapper:
-            return
-        target_str = target_special_value[9:-1]
-        self._replace_mapper.update({target_special_value: target_str})
+    @staticmethod
+    def convert_object_id_value(argument: str) -> str:
+        return argument
 
     def __init__(self, shell_json_str: str):
         self._origin_str = shell_json_str
-        self._special_str_index_bag = {}
-        self._special_str_value_bag = {}
         self._replace_mapper = {}
 
+    def _replace_token(self, match) -> str:
+        special = match.group(1)
+        if special is None:
+            return match.group(0)
+        target_special_value = match.group(0)
+        converted = self._replace_mapper.get(target_special_value)
+        if converted is None:
+            convert_func = getattr(self, self._special.get(special))
+            converted = convert_func(match.group(2))
+            self._replace_mapper.update({target_special_value: converted})
+        return converted
+
     def reconstruct_json_string(self) -> str:
         try:
-            for special in self._special:
-                self._search_special_str_index(special, self._origin_str)
-            self._search_special_str_value()
-            self._replace_special_str()
-            return self._origin_str
+            return self._token_pattern.sub(self._replace_token, self._origin_str)
         except Exception as e:
             print(str(e))
 
-    def _search_special_str_index(self, special_str: str, origin_str: str):
-        start_index = 0
-        while start_index < len(origin_str):
-            try:
-                target_index = origin_str.index(special_str, start_index)
-                target_bag = self._special_str_index_bag.setdefault(special_str, [])
-                target_bag.append(target_index)
-                start_index = target_index + 1
-            except ValueError:
-                break
-
-    def _search_special_str_value(self):
-        for special_str, index_list in self._special_str_index_bag.items():
-            target_convert_func_name = self._special.get(special_str)
-            convert_func = getattr(self, target_convert_func_name)
-            for index in index_list:
-                convert_func(self._origin_str, index)
-
-    def _replace_special_str(self):
-        for origin_str, new_str in self._replace_mapper.items():
-            self._origin_str = self._origin_str.replace(origin_str, new_str)
+    def loads(self) -> dict:
+        return loads(self.reconstruct_json_string())
+
+
+def jsonify_document(document):
+    """
+    convert bson values of a driver response to what ShellJsonify produces from mongo shell output
+    """
+    if isinstance(document, dict):
+        return {key: jsonify_document(value) for key, value in document.items()}
+    if isinstance(document, (list, tuple)):
+        return [jsonify_document(value) for value in document]
+    if isinstance(document, datetime):
+        if document.tzinfo is None:
+            document = document.replace(tzinfo=timezone.utc)
+        return format_timestamp(document)
+    if isinstance(document, Timestamp):
+        return format_timestamp(document.as_datetime())
+    if isinstance(document, Int64):
+        return int(document)
+    if isinstance(document, (ObjectId, Decimal128)):
+        return str(document)
+    if isinstance(document, (Binary, bytes)):
+        return 'binary_data'
+    return document
 
 
 class PrimaryOplogInfo:
@@ -114,7 +120,10 @@ class PrimaryOplogInfo:
 
 class OplogDiffInfo:
 
-    def __init__(self, oplog_info: str):
+    def __init__(self, oplog_info: Union[str, list]):
+        if isinstance(oplog_info, list):
+            self.diff_info = oplog_info
+            return
         lines_of_info = oplog_info.split('\n')
         self.diff_info = []
         line_number = 0
@@ -135,17 +144,91 @@ class OplogDiffInfo:
 
 
 class ReplicationStatus:
-    def __init__(self, status_str):
-        shell_jsonify = ShellJsonify(status_str)
-        converted_status_str = shell_jsonify.reconstruct_json_string()
-        self.replication_status = loads(converted_status_str)
+    def __init__(self, status_str: Union[str, dict]):
+        if isinstance(status_str, dict):
+            self.replication_status = jsonify_document(status_str)
+            return
+        self.replication_status = ShellJsonify(status_str).loads()
 
 
 class ReplicationConf:
-    def __init__(self, status_str):
-        shell_jsonify = ShellJsonify(status_str)
-        converted_status_str = shell_jsonify.reconstruct_json_string()
-        self.replication_conf = loads(converted_status_str)
+    def __init__(self, status_str: Union[str, dict]):
+        if isinstance(status_str, dict):
+            self.replication_conf = jsonify_document(status_str)
+            return
+        self.replication_conf = ShellJsonify(status_str).loads()
+
+
+class DocumentExtractor:
+    """
+    find the last top level {} document of mongo shell output in one forward pass,
+    braces inside string values are skipped and only the document being read is buffered
+    """
+    _document_pattern = re.compile(r'[{}"]')
+    _string_pattern = re.compile(r'["\\]')
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._pieces = []
+        self.document: Optional[str] = None
+
+    def feed(self, chunk: str):
+        index = 0
+        length = len(chunk)
+        document_start = 0 if self._depth else None
+        while index < length:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                    index += 1
+                    continue
+                match = self._string_pattern.search(chunk, index)
+                if match is None:
+                    break
+                index = match.end()
+                if match.group() == '"':
+                    self._in_string = False
+                else:
+                    self._escaped = True
+            elif self._depth == 0:
+                # text outside of documents is never buffered, quotes in it are not json strings
+                index = chunk.find('{', index)
+                if index == -1:
+                    break
+                document_start = index
+                self._depth = 1
+                index += 1
+            else:
+                match = self._document_pattern.search(chunk, index)
+                if match is None:
+                    break
+                index = match.end()
+                current_char = match.group()
+                if current_char == '"':
+                    self._in_string = True
+                elif current_char == '{':
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._pieces.append(chunk[document_start:index])
+                        self.document = ''.join(self._pieces)
+                        self._pieces = []
+                        document_start = None
+        if self._depth and document_start is not None:
+            self._pieces.append(chunk[document_start:])
+
+    def feed_stream(self, stream, chunk_size: int = 64 * 1024) -> Optional[str]:
+        decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            self.feed(decoder.decode(chunk))
+        self.feed(decoder.decode(b'', final=True))
+        return self.document
 
 
 class ExtendCmd:
@@ -153,46 +236,45 @@ class ExtendCmd:
         self.host = host
         self.port = port
 
+    def close(self):
+        """
+        every query runs its own mongo shell, nothing is kept open
+        """
+
     def convert_str_to_dict(self, origin_str: str) -> dict:
         # find the last {} structure
         target_info_str = self.extract_information_from_str(origin_str)
         return loads(target_info_str)
 
-    def extract_information_from_str(self, origin_str):
-        origin_str = origin_str.replace('\n', '').replace('\t', '')
-        bracket_stack = []
-        starts = False
-        end_index = start_index = None
-        for x in range(len(origin_str) - 1, -1, -1):
-            current_char = origin_str[x]
-            if current_char in ['{', '}']:
-                if starts:
-                    if current_char == '{':
-                        bracket_stack.pop()
-                    else:
-                        bracket_stack.append(current_char)
-                    if not bracket_stack:
-                        start_index = x
-                        break
-                else:
-                    end_index = x
-                    bracket_stack.append(current_char)
-                    starts = True
-        target_info_str = origin_str[start_index: end_index + 1]
-        return target_info_str
+    @staticmethod
+    def extract_information_from_str(origin_str: str) -> str:
+        extractor = DocumentExtractor()
+        extractor.feed(origin_str)
+        if extractor.document is None:
+            raise ExtendCmdException('no document found in mongo shell output')
+        return extractor.document
+
+    def _shell_cmd(self, script: str) -> str:
+        return f"mongo --host {self.host} --port {self.port} --eval '{script}'"
+
+    def eval_document(self, script: str) -> str:
+        """
+        run script with mongo shell and read the last document from the pipe chunk by chunk
+        """
+        with subprocess.Popen(self._shell_cmd(script), stdout=subprocess.PIPE, shell=True) as proc:
+            document = DocumentExtractor().feed_stream(proc.stdout)
+        if document is None:
+            raise ExtendCmdException(f'no document found in output of {script}')
+        return document
 
     def get_primary_replication_info(self) -> Optional[PrimaryOplogInfo]:
         """
         related link:https://docs.mongodb.com/manual/reference/method/db.getReplicationInfo/#mongodb-method-db.getReplicationInfo
         :return: getReplicationInfo runs on target mongo instance
         """
-        cmd = f"mongo --host {self.host} --port {self.port} --eval 'db.getReplicationInfo()'"
         try:
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True) as proc:
-                output = proc.stdout.read()
-                output_str = str(output, encoding="utf8")
-                result = self.convert_str_to_dict(output_str)
-                return PrimaryOplogInfo(result)
+            result = loads(self.eval_document('db.getReplicationInfo()'))
+            return PrimaryOplogInfo(result)
         except Exception:
             raise ExtendCmdException()
 
@@ -201,7 +283,7 @@ class ExtendCmd:
         related link:https://docs.mongodb.com/manual/reference/method/db.printSecondaryReplicationInfo/#mongodb-method-db.printSecondaryReplicationInfo
         :return: printSecondaryReplicationInfo() runs on target mongo instance
         """
-        cmd = f"mongo --host {self.host} --port {self.port} --eval 'db.printSlaveReplicationInfo()'"
+        cmd = self._shell_cmd('db.printSlaveReplicationInfo()')
         try:
             with subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True) as proc:
                 output = proc.stdout.read()
@@ -210,36 +292,24 @@ class ExtendCmd:
         except Exception:
             raise ExtendCmdException()
 
-    def get_replication_status(self) -> dict:
+    def get_replication_status(self) -> ReplicationStatus:
         """
         related link:https://docs.mongodb.com/manual/reference/method/rs.status/#mongodb-method-rs.status
         :return: rs.status() runs on target mongo instance
         """
-        cmd = f"mongo --host {self.host} --port {self.port} --eval 'rs.status()'"
         try:
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True) as proc:
-                output = proc.stdout.read()
-                output_str = str(output, encoding="utf8")
-                useful_str = self.extract_information_from_str(output_str)
-                converted_status = ReplicationStatus(useful_str)
-                return converted_status
+            return ReplicationStatus(self.eval_document('rs.status()'))
         except Exception as e:
             print(str(e))
             raise ExtendCmdException()
 
-    def get_replication_conf(self):
+    def get_replication_conf(self) -> ReplicationConf:
         """
         related link:https://docs.mongodb.com/manual/reference/method/rs.conf/
         :return: rs.conf() runs on target mongo instance
         """
-        cmd = f"mongo --host {self.host} --port {self.port} --eval 'rs.conf()'"
         try:
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True) as proc:
-                output = proc.stdout.read()
-                output_str = str(output, encoding="utf8")
-                useful_str = self.extract_information_from_str(output_str)
-                converted_status = ReplicationConf(useful_str)
-                return converted_status
+            return ReplicationConf(self.eval_document('rs.conf()'))
         except Exception as e:
             print(str(e))
             raise ExtendCmdException()
@@ -249,12 +319,139 @@ class ExtendCmd:
         related link: https://docs.mongodb.com/manual/reference/method/db.printShardingStatus/#mongodb-method-db.printShardingStatus
         :return: run db.printShardingStatus() command on target sharding cluster
         """
-        cmd = f"mongo --host {self.host} --port {self.port} --eval 'db.printShardingStatus()'"
         try:
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True) as proc:
-                output = proc.stdout.read()
-                output_str = str(output, encoding="utf8")
-                result = self.convert_str_to_dict(output_str)
-                return result
+            return loads(self.eval_document('db.printShardingStatus()'))
         except Exception:
             raise ExtendCmdException()
+
+
+def fetch_oplog_window(client: MongoClient) -> dict:
+    """
+    same fields as db.getReplicationInfo(), read from the first and last oplog entries in natural order
+    """
+    local_db = client.get_database('local')
+    oplog = local_db.get_collection('oplog.rs')
+    stats = local_db.command('collStats', 'oplog.rs')
+    first = next(oplog.find({}, {'ts': 1}).sort('$natural', ASCENDING).limit(1), None)
+    last = next(oplog.find({}, {'ts': 1}).sort('$natural', DESCENDING).limit(1), None)
+    if not first or not last:
+        raise ExtendCmdException('oplog is empty')
+    oplog_starts = first.get('ts').as_datetime()
+    oplog_ends = last.get('ts').as_datetime()
+    time_diff = int((oplog_ends - oplog_starts).total_seconds())
+    return {
+        'logSizeMB': stats.get('maxSize', 0) / (1024 * 1024),
+        'usedMB': stats.get('size', 0) / (1024 * 1024),
+        'timeDiff': time_diff,
+        'timeDiffHours': round(time_diff / 3600, 2),
+        'tFirst': oplog_starts.isoformat(),
+        'tLast': oplog_ends.isoformat(),
+        # bytes inserted into the oplog since the server started, None if the storage engine does not report it
+        'insertedBytes': stats.get('wiredTiger', {}).get('cursor', {}).get('insert key and value bytes'),
+    }
+
+
+def compute_oplog_diff(status: dict) -> list:
+    """
+    same fields as db.printSecondaryReplicationInfo(), computed from a replSetGetStatus response
+    """
+    members = status.get('members', [])
+    primary_optime = None
+    for member in members:
+        if member.get('stateStr') == 'PRIMARY':
+            primary_optime = member.get('optimeDate')
+    if primary_optime is None:
+        all_optime = [x.get('optimeDate') for x in members if x.get('optimeDate')]
+        primary_optime = max(all_optime) if all_optime else None
+    diff_info = []
+    for member in members:
+        if member.get('stateStr') in ('PRIMARY', 'ARBITER'):
+            continue
+        optime = member.get('optimeDate')
+        if optime is None or primary_optime is None:
+            continue
+        diff_info.append({
+            'source': member.get('name'),
+            'last_sync_time': optime.replace(tzinfo=timezone.utc),
+            'diff_seconds': int((primary_optime - optime).total_seconds())
+        })
+    return diff_info
+
+
+class DriverExtendCmd:
+    """
+    answer the ExtendCmd queries with database commands over a pooled MongoClient
+    instead of spawning a mongo shell for each of them, ExtendCmd stays as the fallback
+    """
+
+    def __init__(self, host: str, port: int, client: MongoClient = None, fallback: bool = True):
+        self.host = host
+        self.port = int(port)
+        self._own_client = client is None
+        self.client = client or client_registry.acquire_direct(host, port)
+        self.fallback = ExtendCmd(host, port) if fallback else None
+
+    def close(self):
+        if self._own_client:
+            client_registry.release(self.client)
+            self._own_client = False
+
+    def _run(self, cmd_name: str, func):
+        try:
+            return func()
+        except (PyMongoError, ExtendCmdException) as e:
+            if self.fallback is None:
+                raise ExtendCmdException(f'{cmd_name} failed: {e}')
+            console.print(f'{cmd_name} failed on {self.host}:{self.port} # {e}, fallback to mongo shell',
+                          style='yellow')
+            return getattr(self.fallback, cmd_name)()
+
+    def get_primary_replication_info(self) -> PrimaryOplogInfo:
+        """
+        first and last entries of local.oplog.rs with collStats of the oplog
+        :return: PrimaryOplogInfo like db.getReplicationInfo()
+        """
+        return self._run('get_primary_replication_info',
+                         lambda: PrimaryOplogInfo(fetch_oplog_window(self.client)))
+
+    def get_slave_replication_info(self) -> OplogDiffInfo:
+        """
+        optimeDate of every member in replSetGetStatus
+        :return: OplogDiffInfo like db.printSecondaryReplicationInfo()
+        """
+        return self._run('get_slave_replication_info',
+                         lambda: OplogDiffInfo(compute_oplog_diff(self.client.admin.command('replSetGetStatus'))))
+
+    def get_replication_status(self) -> ReplicationStatus:
+        """
+        related link:https://docs.mongodb.com/manual/reference/command/replSetGetStatus/
+        :return: replSetGetStatus runs on target replication set
+        """
+        return self._run('get_replication_status',
+                         lambda: ReplicationStatus(self.client.admin.command('replSetGetStatus')))
+
+    def get_replication_conf(self) -> ReplicationConf:
+        """
+        related link:https://docs.mongodb.com/manual/reference/command/replSetGetConfig/
+        :return: replSetGetConfig runs on target replication set
+        """
+        return self._run('get_replication_conf',
+                         lambda: ReplicationConf(self.client.admin.command('replSetGetConfig').get('config')))
+
+
+extend_cmd_backends = {
+    'shell': ExtendCmd,
+    'driver': DriverExtendCmd
+}
+
+
+def create_extend_cmd(host: str, port: int, client: MongoClient = None, backend: str = None):
+    """
+    backend is read from extend_cmd_backend of global config if not given, driver by default
+    """
+    backend = backend or global_config.get('extend_cmd_backend', 'driver')
+    if backend not in extend_cmd_backends:
+        raise ExtendCmdException(f'unknown extend cmd backend:{backend}')
+    if backend == 'driver':
+        return DriverExtendCmd(host, port, client)
+    return ExtendCmd(host, port)
@@ -0,0 +1,241 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from mt.conf.parser import global_config
+from mt.core.profile_table import ProfileTable
+from mt.errors.errors import ProfileSnapshotException
+
+_magic = b'MTPROFSN'
+# magic, format version, header length
+_preamble = struct.Struct('<8sII')
+_alignment = 8
+
+growth_fields = ['storage_size', 'total_index_size', 'reuse_size']
+
+
+def _aligned(offset: int) -> int:
+    return (offset + _alignment - 1) // _alignment * _alignment
+
+
+def write_snapshot(table: ProfileTable, path: str, metadata: Optional[dict] = None):
+    """
+    write the columns of a profile table as one binary file:
+    preamble, json header with the column directory, then every column aligned to 8 bytes
+    the file is written next to path and renamed so that readers never see a partial snapshot
+    """
+    strings = '\0'.join(table.strings.strings).encode('utf-8')
+    sections = [('strings', 'B', strings)]
+    for name, values in table.columns().items():
+        sections.append((name, memoryview(values).format, memoryview(values).cast('B')))
+    directory = {}
+    offset = 0
+    for name, typecode, data in sections:
+        directory.update({name: [typecode, struct.calcsize(typecode), offset, len(data)]})
+        offset = _aligned(offset + len(data))
+    header = json.dumps({
+        'created_at': time.time(),
+        'byteorder': sys.byteorder,
+        'scale': table.scale,
+        'namespaces': len(table),
+        'string_count': len(table.strings),
+        'database_names': table.database_names,
+        'metadata': metadata or {},
+        'columns': directory
+    }).encode('utf-8')
+    data_start = _aligned(_preamble.size + len(header))
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(_preamble.pack(_magic, ProfileSnapshot.version, len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_start - _preamble.size - len(header)))
+        for name, typecode, data in sections:
+            f.write(data)
+            f.write(b'\0' * (_aligned(len(data)) - len(data)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class ProfileSnapshot:
+    """
+    profile table memory mapped from a snapshot file, columns are read in place without parsing or copying
+    """
+    version = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        try:
+            self.table = self._load()
+        except Exception:
+            self.close()
+            raise
+
+    def _load(self) -> ProfileTable:
+        if len(self._view) < _preamble.size:
+            raise ProfileSnapshotException(f'{self.path} is not a profile snapshot')
+        magic, version, header_length = _preamble.unpack_from(self._view)
+        if magic != _magic:
+            raise ProfileSnapshotException(f'{self.path} is not a profile snapshot')
+        if version != self.version:
+            raise ProfileSnapshotException(f'{self.path} has snapshot version {version}, expected {self.version}')
+        self.header = json.loads(bytes(self._view[_preamble.size:_preamble.size + header_length]).decode('utf-8'))
+        if self.header.get('byteorder') != sys.byteorder:
+            raise ProfileSnapshotException(f'{self.path} was written on a {self.header.get("byteorder")} endian host')
+        data_start = _aligned(_preamble.size + header_length)
+        columns = {}
+        for name, (typecode, item_size, offset, length) in self.header.get('columns').items():
+            if struct.calcsize(typecode) != item_size:
+                raise ProfileSnapshotException(f'{self.path} column {name} has item size {item_size}')
+            start = data_start + offset
+            columns.update({name: self._view[start:start + length].cast(typecode)})
+        string_data = columns.pop('strings')
+        strings = bytes(string_data).decode('utf-8').split('\0') if self.header.get('string_count') else []
+        string_data.release()
+        return ProfileTable.from_columns(columns, strings, self.header.get('database_names'), self.header.get('scale'))
+
+    @property
+    def created_at(self) -> datetime:
+        return datetime.fromtimestamp(self.header.get('created_at'))
+
+    @property
+    def metadata(self) -> dict:
+        return self.header.get('metadata')
+
+    def close(self):
+        """
+        numpy arrays taken from the columns keep the file mapped until they are released
+        """
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            pass
+
+
+def diff_snapshots(old: ProfileSnapshot, new: ProfileSnapshot, top_n: Optional[int] = None) -> dict:
+    """
+    size in the new snapshot and growth in bytes of storage, index and reusable size of every collection,
+    collections only in the new snapshot grow from 0, dropped collections shrink to 0
+    :param top_n: only return the top_n collections with the largest storage growth
+    :return: {'elapsed_hours', 'collections', 'added', 'dropped', 'total'}
+    """
+    old_table, new_table = old.table, new.table
+    old_names, new_names = old_table.namespace_names(), new_table.namespace_names()
+    old_ids = {x: i for i, x in enumerate(old_names)}
+    # namespace id in the old table of every namespace of the new table, -1 for new collections
+    matched = np.array([old_ids.pop(x, -1) for x in new_names], dtype=np.int64)
+    dropped = np.array(sorted(old_ids.values()), dtype=np.int64)
+    old_rows = old_table.column(old_table.namespace_first_row)
+    new_rows = new_table.column(new_table.namespace_first_row)
+    old_values, new_values = {}, {}
+    for field in growth_fields:
+        old_column = old_table.column(old_table.sizes[field])
+        values = np.zeros(len(new_names), dtype=np.int64)
+        found = matched >= 0
+        values[found] = old_column[old_rows[matched[found]]]
+        old_values.update({field: np.concatenate([values, old_column[old_rows[dropped]]])})
+        new_values.update({field: np.concatenate([new_table.column(new_table.sizes[field])[new_rows],
+                                                  np.zeros(len(dropped), dtype=np.int64)])})
+    names = new_names + [old_names[x] for x in dropped.tolist()]
+    growth = {x: new_values[x] - old_values[x] for x in growth_fields}
+    order = np.argsort(-growth['storage_size'], kind='stable')
+    if top_n is not None:
+        order = order[:top_n]
+    collections = []
+    for x in order.tolist():
+        collection = {'namespace': names[x]}
+        for field in growth_fields:
+            collection.update({field: int(new_values[field][x]), f'{field}_growth': int(growth[field][x])})
+        collections.append(collection)
+    return {
+        'elapsed_hours': round((new.header.get('created_at') - old.header.get('created_at')) / 3600, 2),
+        'collections': collections,
+        'added': [new_names[x] for x in np.nonzero(matched < 0)[0].tolist()],
+        'dropped': [old_names[x] for x in dropped.tolist()],
+        'total': {x: int(y.sum()) for x, y in growth.items()}
+    }
+
+
+class ProfileSnapshotStore:
+    """
+    one snapshot file per profile run in directory, named by the utc time of the run in microseconds and the pid
+    so that runs close together never overwrite each other, only the latest retention snapshots are kept
+    """
+    suffix = '.mtps'
+
+    def __init__(self, directory: str, retention: Optional[int] = 48):
+        self.directory = directory
+        self.retention = retention
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls) -> Optional['ProfileSnapshotStore']:
+        snapshot_config = global_config.get('profile_snapshot', {})
+        path = snapshot_config.get('path')
+        return cls(path, snapshot_config.get('retention', 48)) if path else None
+
+    def save(self, table: ProfileTable, metadata: Optional[dict] = None) -> str:
+        name = f'profile-{datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")}-{os.getpid()}{self.suffix}'
+        path = os.path.join(self.directory, name)
+        write_snapshot(table, path, metadata)
+        self.prune()
+        return path
+
+    def prune(self) -> List[str]:
+        """
+        remove all but the latest retention snapshots, a removed snapshot still open stays readable until closed
+        :return: removed paths
+        """
+        if not self.retention:
+            return []
+        removed = self.snapshots()[:-self.retention]
+        for path in removed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # pruned by another process sharing the directory
+                pass
+        return removed
+
+    def snapshots(self) -> List[str]:
+        """
+        :return: snapshot paths from the oldest to the latest
+        """
+        return sorted(os.path.join(self.directory, x) for x in os.listdir(self.directory) if x.endswith(self.suffix))
+
+    def open(self, path: str) -> ProfileSnapshot:
+        return ProfileSnapshot(path)
+
+    def latest(self) -> Optional[ProfileSnapshot]:
+        snapshots = self.snapshots()
+        return ProfileSnapshot(snapshots[-1]) if snapshots else None
+
+    def diff_latest(self, top_n: Optional[int] = None) -> Optional[Dict]:
+        """
+        diff of the two latest snapshots
+        """
+        snapshots = self.snapshots()
+        if len(snapshots) < 2:
+            return None
+        old, new = ProfileSnapshot(snapshots[-2]), ProfileSnapshot(snapshots[-1])
+        try:
+            return diff_snapshots(old, new, top_n)
+        finally:
+            old.close()
+            new.close()
+
+
+if __name__ == '__main__':
+    store = ProfileSnapshotStore('./profile_snapshots')
+    print(store.diff_latest(20))
@@ -0,0 +1,347 @@
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+# shard id of the row holding the totals of a collection over all shards
+TOTAL_SHARD = -1
+
+size_columns = ['count', 'storage_size', 'total_index_size', 'reuse_size']
+
+column_names = ['namespace_database', 'namespace_collection', 'namespace_sharded', 'namespace_capped',
+                'namespace_first_row', 'namespace_row_count', 'row_namespace', 'row_shard', 'row_first_index',
+                'row_index_count', 'index_row', 'index_name', 'index_size']
+
+
+class StringTable:
+    """
+    every distinct string is kept once and referenced by its id
+    """
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self._ids: Dict[str, int] = {}
+
+    def intern(self, value: str) -> int:
+        string_id = self._ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self._ids.update({value: string_id})
+            self.strings.append(value)
+        return string_id
+
+    def get_id(self, value: str) -> Optional[int]:
+        return self._ids.get(value)
+
+    def __getitem__(self, string_id: int) -> str:
+        return self.strings[string_id]
+
+    def __len__(self):
+        return len(self.strings)
+
+    @classmethod
+    def from_strings(cls, strings: List[str]) -> 'StringTable':
+        string_table = cls()
+        string_table.strings = strings
+        string_table._ids = {x: i for i, x in enumerate(strings)}
+        return string_table
+
+
+class ProfileTable:
+    """
+    collection stats of the whole cluster as typed columns instead of one object graph per collection
+    namespaces: database and collection string ids, sharded and capped flags, first size row and row count
+    size rows: one row of totals (shard TOTAL_SHARD) and one row per shard for every namespace, sizes in bytes
+    indexes: size row, index name string id and size in bytes of every index, grouped by size row
+    columns are append only arrays while the table is built, numpy views of them are used by the analyses
+    a table loaded from a snapshot is read only, its columns are memoryviews of the snapshot file
+    """
+
+    def __init__(self, scale: int = 1024 * 1024):
+        self.scale = scale
+        self.strings = StringTable()
+        self.namespace_database = array('i')
+        self.namespace_collection = array('i')
+        self.namespace_sharded = array('b')
+        self.namespace_capped = array('b')
+        self.namespace_first_row = array('q')
+        self.namespace_row_count = array('i')
+        self.row_namespace = array('i')
+        self.row_shard = array('i')
+        self.sizes = {x: array('q') for x in size_columns}
+        self.row_first_index = array('q')
+        self.row_index_count = array('i')
+        self.index_row = array('q')
+        self.index_name = array('i')
+        self.index_size = array('q')
+        self.database_names: List[str] = []
+        # database name -> position in database_names
+        self._database_ids: Dict[str, int] = {}
+        self._namespace_ids: Optional[Dict[tuple, int]] = {}
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Sequence[int]], strings: List[str], database_names: List[str],
+                     scale: int = 1024 * 1024) -> 'ProfileTable':
+        """
+        :param columns: every column of column_names and sizes.<size column>, as arrays or typed memoryviews
+        """
+        table = cls(scale)
+        table.strings = StringTable.from_strings(strings)
+        for name in column_names:
+            setattr(table, name, columns[name])
+        table.sizes = {x: columns[f'sizes.{x}'] for x in size_columns}
+        table.database_names = database_names
+        table._database_ids = {x: i for i, x in enumerate(database_names)}
+        # built on first lookup
+        table._namespace_ids = None
+        return table
+
+    def columns(self) -> Dict[str, Sequence[int]]:
+        columns = {x: getattr(self, x) for x in column_names}
+        columns.update({f'sizes.{x}': y for x, y in self.sizes.items()})
+        return columns
+
+    def namespace_names(self) -> List[str]:
+        strings = self.strings.strings
+        return [f'{strings[x]}.{strings[y]}' for x, y in zip(self.namespace_database, self.namespace_collection)]
+
+    def __len__(self):
+        return len(self.namespace_database)
+
+    def _add_size_row(self, namespace_id: int, shard_id: int, stats: dict):
+        row = len(self.row_namespace)
+        self.row_namespace.append(namespace_id)
+        self.row_shard.append(shard_id)
+        self.sizes['count'].append(stats.get('count') or 0)
+        self.sizes['storage_size'].append(stats.get('storageSize') or 0)
+        self.sizes['total_index_size'].append(stats.get('totalIndexSize') or 0)
+        self.sizes['reuse_size'].append(
+            stats.get('wiredTiger', {}).get('block-manager', {}).get('file bytes available for reuse') or 0)
+        index_sizes = stats.get('indexSizes', {})
+        self.row_first_index.append(len(self.index_row))
+        self.row_index_count.append(len(index_sizes))
+        for index_name, index_size in index_sizes.items():
+            self.index_row.append(row)
+            self.index_name.append(self.strings.intern(index_name))
+            self.index_size.append(index_size)
+
+    def add_collection(self, database_name: str, stats: dict) -> int:
+        """
+        :param stats: collstats shape, with a shards section for sharded collections
+        :return: namespace id
+        """
+        self.add_database(database_name)
+        namespace_id = len(self)
+        self._namespace_ids.update({(database_name, stats.get('name')): namespace_id})
+        self.namespace_database.append(self.strings.intern(database_name))
+        self.namespace_collection.append(self.strings.intern(stats.get('name') or ''))
+        self.namespace_sharded.append(1 if stats.get('sharded') else 0)
+        self.namespace_capped.append(1 if stats.get('capped') else 0)
+        self.namespace_first_row.append(len(self.row_namespace))
+        shard_stats = stats.get('shards', {})
+        self.namespace_row_count.append(1 + len(shard_stats))
+        self._add_size_row(namespace_id, TOTAL_SHARD, stats)
+        for shard_name, detail in shard_stats.items():
+            self._add_size_row(namespace_id, self.strings.intern(shard_name), detail)
+        return namespace_id
+
+    def add_database(self, database_name: str):
+        """
+        keep databases without collections in the profile
+        """
+        if database_name not in self._database_ids:
+            self._database_ids.update({database_name: len(self.database_names)})
+            self.database_names.append(database_name)
+
+    def namespace_id(self, database_name: str, collection_name: str) -> Optional[int]:
+        if self._namespace_ids is None:
+            strings = self.strings.strings
+            self._namespace_ids = {(strings[x], strings[y]): i for i, (x, y) in
+                                   enumerate(zip(self.namespace_database, self.namespace_collection))}
+        return self._namespace_ids.get((database_name, collection_name))
+
+    def column(self, values: Sequence[int]) -> np.ndarray:
+        """
+        numpy view of a column without copying
+        """
+        typecode = memoryview(values).format
+        return np.frombuffer(values, dtype=typecode) if len(values) else np.zeros(0, dtype=typecode)
+
+    def shard_rows(self) -> np.ndarray:
+        """
+        :return: indexes of the per shard size rows
+        """
+        return np.nonzero(self.column(self.row_shard) != TOTAL_SHARD)[0]
+
+    def database_size_on_shards(self, field: str = 'storage_size') -> Dict[str, Dict[str, int]]:
+        """
+        per shard sum of field over the collections of every database, in scale units per collection like size_on_shards of DatabaseView
+        """
+        rows = self.shard_rows()
+        database_ids = self.column(self.namespace_database)[self.column(self.row_namespace)[rows]]
+        shard_ids = self.column(self.row_shard)[rows]
+        values = self.column(self.sizes[field])[rows] // self.scale
+        result = {x: {} for x in self.database_names}
+        if not len(rows):
+            return result
+        string_count = len(self.strings)
+        keys, inverse = np.unique(database_ids.astype(np.int64) * string_count + shard_ids, return_inverse=True)
+        sums = np.bincount(inverse.reshape(-1), weights=values, minlength=len(keys))
+        for key, total in zip(keys.tolist(), sums.tolist()):
+            result[self.strings[key // string_count]].update({self.strings[key % string_count]: int(total)})
+        return result
+
+    def database_size_on_disk(self, field: str = 'storage_size') -> Dict[str, int]:
+        rows = np.nonzero(self.column(self.row_shard) == TOTAL_SHARD)[0]
+        database_ids = self.column(self.namespace_database)[self.column(self.row_namespace)[rows]]
+        sums = np.bincount(database_ids, weights=self.column(self.sizes[field])[rows] // self.scale,
+                           minlength=len(self.strings)) if len(rows) else np.zeros(len(self.strings))
+        return {x: int(sums[self.strings.get_id(x)]) if self.strings.get_id(x) is not None else 0
+                for x in self.database_names}
+
+    def collection(self, namespace_id: int) -> 'CollectionView':
+        return CollectionView(self, namespace_id)
+
+    def collections(self, database_name: str = None) -> Iterator['CollectionView']:
+        """
+        collections of database_name, of all databases without it
+        """
+        if database_name is None:
+            for namespace_id in range(len(self)):
+                yield CollectionView(self, namespace_id)
+            return
+        database_id = self.strings.get_id(database_name)
+        if database_id is None:
+            # never seen, not even as another string of the table
+            return
+        for namespace_id in range(len(self)):
+            if self.namespace_database[namespace_id] == database_id:
+                yield CollectionView(self, namespace_id)
+
+    def databases(self) -> List['DatabaseView']:
+        size_on_disk = self.database_size_on_disk()
+        size_on_shards = self.database_size_on_shards()
+        database_namespaces = {x: [] for x in self.database_names}
+        for namespace_id, database_id in enumerate(self.namespace_database):
+            database_namespaces[self.strings[database_id]].append(namespace_id)
+        return [DatabaseView(self, x, size_on_disk.get(x, 0), size_on_shards.get(x, {}), database_namespaces[x])
+                for x in self.database_names]
+
+
+class SizeView:
+    """
+    count, sizes and index sizes read from one size row, sizes in scale units
+    """
+    __slots__ = ['table', 'row']
+
+    def __init__(self, table: ProfileTable, row: int):
+        self.table = table
+        self.row = row
+
+    @property
+    def count(self) -> int:
+        return self.table.sizes['count'][self.row]
+
+    @property
+    def storage_size(self) -> int:
+        return self.table.sizes['storage_size'][self.row] // self.table.scale
+
+    @property
+    def total_index_size(self) -> int:
+        return self.table.sizes['total_index_size'][self.row] // self.table.scale
+
+    @property
+    def reuse_size(self) -> int:
+        return self.table.sizes['reuse_size'][self.row] // self.table.scale
+
+    @property
+    def index_size_detail(self) -> Dict[str, int]:
+        table = self.table
+        first = table.row_first_index[self.row]
+        return {table.strings[table.index_name[x]]: table.index_size[x] // table.scale
+                for x in range(first, first + table.row_index_count[self.row])}
+
+    @property
+    def index_bytes_detail(self) -> Dict[str, int]:
+        """
+        index sizes in bytes, not rounded down to scale units
+        """
+        table = self.table
+        first = table.row_first_index[self.row]
+        return {table.strings[table.index_name[x]]: table.index_size[x]
+                for x in range(first, first + table.row_index_count[self.row])}
+
+    def __repr__(self):
+        response = {}
+        for x in ['count', 'reuse_size', 'total_index_size', 'index_size_detail', 'storage_size']:
+            response.update({x: getattr(self, x)})
+        return str(response)
+
+
+class CollectionView:
+    """
+    name, flags and size views of one namespace read from the columns
+    """
+    __slots__ = ['table', 'namespace_id']
+
+    def __init__(self, table: ProfileTable, namespace_id: int):
+        self.table = table
+        self.namespace_id = namespace_id
+
+    @property
+    def database_name(self) -> str:
+        return self.table.strings[self.table.namespace_database[self.namespace_id]]
+
+    @property
+    def name(self) -> str:
+        return self.table.strings[self.table.namespace_collection[self.namespace_id]]
+
+    @property
+    def sharded(self) -> bool:
+        return bool(self.table.namespace_sharded[self.namespace_id])
+
+    @property
+    def capped(self) -> bool:
+        return bool(self.table.namespace_capped[self.namespace_id])
+
+    @property
+    def basic_size_info(self) -> SizeView:
+        return SizeView(self.table, self.table.namespace_first_row[self.namespace_id])
+
+    @property
+    def sharding_detail(self) -> Dict[str, SizeView]:
+        table = self.table
+        first = table.namespace_first_row[self.namespace_id]
+        return {table.strings[table.row_shard[x]]: SizeView(table, x)
+                for x in range(first + 1, first + table.namespace_row_count[self.namespace_id])}
+
+    def __repr__(self):
+        response = {}
+        for x in ['name', 'sharded', 'capped', 'basic_size_info', 'sharding_detail']:
+            response.update({x: getattr(self, x)})
+        return str(response)
+
+
+class DatabaseView:
+    """
+    sizes and collection views of one database of the table
+    """
+    __slots__ = ['table', 'database_name', 'size_on_disk', 'size_on_shards', 'namespace_ids']
+
+    def __init__(self, table: ProfileTable, database_name: str, size_on_disk: int, size_on_shards: Dict[str, int],
+                 namespace_ids: List[int]):
+        self.table = table
+        self.database_name = database_name
+        self.size_on_disk = size_on_disk
+        self.size_on_shards = size_on_shards
+        self.namespace_ids = namespace_ids
+
+    @property
+    def collections(self) -> List[CollectionView]:
+        return [CollectionView(self.table, x) for x in self.namespace_ids]
+
+    def __repr__(self):
+        response = {}
+        for x in ['database_name', 'size_on_disk', 'size_on_shards', 'collections']:
+            response.update({x: getattr(self, x)})
+        return str(response)
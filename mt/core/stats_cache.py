@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from mt.core.collection_stats import CollectionStatsCollector, Namespace
+from mt.core.common import run_bounded
+
+_database_signal_keys = ['collections', 'objects', 'dataSize', 'storageSize', 'indexes', 'indexSize']
+
+
+class CollectionStatsCache:
+    """
+    collection stats keyed by namespace and collection uuid, with staleness ttl and lru eviction,
+    saved as a json file if path is given so that later runs only collect changed collections
+    """
+    _version = 1
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 3600, max_entries: int = 100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # namespace -> {'signal': [uuid, count], 'stats': collection stats, 'refreshed_at': epoch seconds}
+        self._entries = OrderedDict()
+        # database name -> {'signal': dbStats totals, 'collections': collection names}
+        self._databases = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_fresh(self, entry: dict, now: float) -> bool:
+        return now - entry.get('refreshed_at') < self.ttl
+
+    def get(self, namespace: str, signal: list) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(namespace)
+            if not entry or entry.get('signal') != signal or not self._is_fresh(entry, time.time()):
+                return None
+            self._entries.move_to_end(namespace)
+            return entry.get('stats')
+
+    def put(self, namespace: str, signal: list, stats: dict):
+        with self._lock:
+            self._entries.update({namespace: {'signal': signal, 'stats': stats, 'refreshed_at': time.time()}})
+            self._entries.move_to_end(namespace)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_database(self, database_name: str, signal: list) -> Optional[List[str]]:
+        """
+        :return: collection names of the database if dbStats totals did not move and all its entries are fresh
+        """
+        with self._lock:
+            database = self._databases.get(database_name)
+            if not database or database.get('signal') != signal:
+                return None
+            now = time.time()
+            for collection_name in database.get('collections'):
+                entry = self._entries.get(f'{database_name}.{collection_name}')
+                if not entry or not self._is_fresh(entry, now):
+                    return None
+            return database.get('collections')
+
+    def put_database(self, database_name: str, signal: list, collection_names: List[str]):
+        with self._lock:
+            previous = self._databases.get(database_name, {}).get('collections', [])
+            # forget dropped collections
+            for collection_name in set(previous) - set(collection_names):
+                self._entries.pop(f'{database_name}.{collection_name}', None)
+            self._databases.update({database_name: {'signal': signal, 'collections': collection_names}})
+
+    def plan_refresh(self, collector: CollectionStatsCollector,
+                     database_names: List[str]) -> Tuple[List[Namespace], Dict[Namespace, dict], Dict[Namespace, list]]:
+        """
+        compare cheap signals with the cache: dbStats totals per database,
+        then uuid from listCollections and estimated document count per collection of changed databases
+        :return: all namespaces, cached stats of unchanged namespaces, signals of namespaces to collect again
+        """
+        client = collector.client
+        database_signals = {}
+        for database_name, db_stats, error in run_bounded(
+                lambda x: client.get_database(x).command('dbStats'), database_names, collector.max_in_flight):
+            if error:
+                raise error
+            database_signals.update({database_name: [db_stats.get(x) for x in _database_signal_keys]})
+
+        collection_names = {}
+        changed_databases = []
+        for database_name in database_names:
+            cached_names = self.get_database(database_name, database_signals.get(database_name))
+            if cached_names is None:
+                changed_databases.append(database_name)
+            else:
+                collection_names.update({database_name: cached_names})
+
+        collection_uuids = {}
+        for database_name, collections, error in run_bounded(
+                lambda x: list(client.get_database(x).list_collections()), changed_databases,
+                collector.max_in_flight):
+            if error:
+                raise error
+            names = []
+            for collection in collections:
+                names.append(collection.get('name'))
+                uuid = collection.get('info', {}).get('uuid')
+                collection_uuids.update({(database_name, collection.get('name')): str(uuid) if uuid else None})
+            collection_names.update({database_name: names})
+            self.put_database(database_name, database_signals.get(database_name), names)
+
+        collection_counts = {}
+        for namespace, count, error in run_bounded(
+                lambda x: client.get_database(x[0]).get_collection(x[1]).estimated_document_count(),
+                list(collection_uuids), collector.max_in_flight):
+            collection_counts.update({namespace: None if error else count})
+
+        namespaces = [(x, y) for x in database_names for y in collection_names[x]]
+        cached_stats = {}
+        stale_signals = {}
+        for namespace in namespaces:
+            if namespace in collection_uuids:
+                signal = [collection_uuids.get(namespace), collection_counts.get(namespace)]
+                stats = self.get('.'.join(namespace), signal)
+            else:
+                # database did not change, reuse whatever signal was recorded
+                signal = self._entries.get('.'.join(namespace), {}).get('signal')
+                stats = self.get('.'.join(namespace), signal)
+            if stats is None:
+                stale_signals.update({namespace: signal})
+            else:
+                cached_stats.update({namespace: stats})
+        return namespaces, cached_stats, stale_signals
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            content = json.load(f)
+        if content.get('version') != self._version:
+            return
+        with self._lock:
+            self._databases = content.get('databases', {})
+            self._entries = OrderedDict((x, y) for x, y in content.get('collections', []))
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            content = {'version': self._version, 'databases': self._databases,
+                       'collections': list(self._entries.items())}
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(content, f)
+        os.replace(temp_path, self.path)
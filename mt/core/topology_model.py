@@ -0,0 +1,242 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pymongo import monitoring
+
+# server types of the driver counted as members of a replication set
+replication_roles = ['RSPrimary', 'RSSecondary', 'RSArbiter', 'RSOther', 'RSGhost']
+
+
+def address_of(server_address: tuple) -> str:
+    return f'{server_address[0]}:{server_address[1]}'
+
+
+class MemberState:
+    __slots__ = ['address', 'replication_name', 'role', 'rtt_ms', 'last_heartbeat', 'heartbeat_failures',
+                 'last_error', 'role_changed_at']
+
+    def __init__(self, address: str):
+        self.address = address
+        self.replication_name: Optional[str] = None
+        self.role = 'Unknown'
+        self.rtt_ms: Optional[float] = None
+        self.last_heartbeat: Optional[datetime] = None
+        # failed heartbeats since the last successful one
+        self.heartbeat_failures = 0
+        self.last_error: Optional[str] = None
+        self.role_changed_at: Optional[datetime] = None
+
+    def copy(self) -> 'MemberState':
+        state = MemberState(self.address)
+        for x in self.__slots__:
+            setattr(state, x, getattr(self, x))
+        return state
+
+    def __repr__(self):
+        response = {}
+        for x in self.__slots__:
+            response.update({x: getattr(self, x)})
+        return str(response)
+
+
+class Election:
+    __slots__ = ['replication_name', 'primary', 'previous_primary', 'election_id', 'time']
+
+    def __init__(self, replication_name: str, primary: str, previous_primary: Optional[str],
+                 election_id: Optional[str], time: datetime):
+        self.replication_name = replication_name
+        self.primary = primary
+        self.previous_primary = previous_primary
+        self.election_id = election_id
+        self.time = time
+
+    def __repr__(self):
+        response = {}
+        for x in self.__slots__:
+            response.update({x: getattr(self, x)})
+        return str(response)
+
+
+class TopologyModel:
+    """
+    live state of every server monitored by the clients of the process, kept up to date by driver monitoring
+    events instead of polling: role of every member, heartbeat round trip time and failures,
+    current primary and elections of every replication set, and the latest role changes
+    several clients monitoring the same server update the same member state, members are kept after their clients
+    are closed since the driver does not reliably publish server closed events on close
+    """
+
+    def __init__(self, max_events: int = 1000):
+        self._members: Dict[str, MemberState] = {}
+        # replication name -> address of the current primary
+        self._primaries: Dict[str, str] = {}
+        # replication name -> address of the latest primary, kept while there is no primary
+        self._last_primaries: Dict[str, str] = {}
+        self._election_ids: Dict[str, str] = {}
+        self._elections = deque(maxlen=max_events)
+        # replication name -> elections seen since the process started, never decreases unlike the event history
+        self._election_counts: Dict[str, int] = {}
+        # (time, address, previous role, role)
+        self._role_changes = deque(maxlen=max_events)
+        self._condition = threading.Condition()
+        # increased on every change so that waiters can tell whether something happened
+        self.version = 0
+
+    def _member(self, address: str) -> MemberState:
+        member = self._members.get(address)
+        if member is None:
+            member = MemberState(address)
+            self._members.update({address: member})
+        return member
+
+    def _changed(self):
+        self.version += 1
+        self._condition.notify_all()
+
+    def server_opened(self, address: str):
+        with self._condition:
+            self._member(address)
+            self._changed()
+
+    def description_changed(self, address: str, role: str, replication_name: Optional[str],
+                            rtt: Optional[float] = None, election_id: Optional[str] = None):
+        now = datetime.now()
+        with self._condition:
+            member = self._member(address)
+            if replication_name:
+                member.replication_name = replication_name
+            if rtt is not None:
+                member.rtt_ms = round(rtt * 1000, 3)
+            if role != member.role:
+                self._role_changes.append((now, address, member.role, role))
+                member.role = role
+                member.role_changed_at = now
+            replication_name = member.replication_name
+            if role == 'RSPrimary' and replication_name:
+                self._primary_seen(replication_name, address, election_id, now)
+            elif role != 'RSPrimary' and replication_name and self._primaries.get(replication_name) == address:
+                self._primaries.pop(replication_name)
+            self._changed()
+
+    def _primary_seen(self, replication_name: str, address: str, election_id: Optional[str], now: datetime):
+        previous_primary = self._last_primaries.get(replication_name)
+        known_election_id = self._election_ids.get(replication_name)
+        self._primaries.update({replication_name: address})
+        self._last_primaries.update({replication_name: address})
+        if election_id is not None:
+            self._election_ids.update({replication_name: election_id})
+            is_election = known_election_id is not None and election_id != known_election_id
+        else:
+            is_election = previous_primary is not None and previous_primary != address
+        # the first primary seen of a replication set was elected before monitoring started
+        if is_election:
+            self._elections.append(Election(replication_name, address, previous_primary, election_id, now))
+            self._election_counts.update({replication_name: self._election_counts.get(replication_name, 0) + 1})
+
+    def heartbeat_succeeded(self, address: str, duration: float, awaited: bool = False):
+        with self._condition:
+            member = self._member(address)
+            if not awaited:
+                # awaited heartbeats of streaming monitors wait for a change, their duration is no round trip
+                member.rtt_ms = round(duration * 1000, 3)
+            member.last_heartbeat = datetime.now()
+            member.heartbeat_failures = 0
+            member.last_error = None
+
+    def heartbeat_failed(self, address: str, error: Exception):
+        with self._condition:
+            member = self._member(address)
+            member.heartbeat_failures += 1
+            member.last_error = str(error)
+            self._changed()
+
+    def member(self, address: str) -> Optional[MemberState]:
+        with self._condition:
+            member = self._members.get(address)
+            return member.copy() if member else None
+
+    def members_of(self, replication_name: str) -> List[MemberState]:
+        with self._condition:
+            return [x.copy() for x in self._members.values() if x.replication_name == replication_name]
+
+    def primary_of(self, replication_name: str) -> Optional[str]:
+        with self._condition:
+            return self._primaries.get(replication_name)
+
+    def elections(self, replication_name: Optional[str] = None) -> List[Election]:
+        with self._condition:
+            return [x for x in self._elections if replication_name is None or x.replication_name == replication_name]
+
+    def election_count(self, replication_name: str) -> int:
+        with self._condition:
+            return self._election_counts.get(replication_name, 0)
+
+    def role_changes(self, address: Optional[str] = None) -> List[tuple]:
+        with self._condition:
+            return [x for x in self._role_changes if address is None or x[1] == address]
+
+    def wait_for_change(self, version: int, timeout: float) -> int:
+        """
+        block until the model changed after version or timeout seconds passed
+        :return: current version
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.version == version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self.version
+
+    def describe(self) -> dict:
+        with self._condition:
+            return {
+                'members': {x: {y: getattr(z, y) for y in MemberState.__slots__ if y != 'address'}
+                            for x, z in sorted(self._members.items())},
+                'primaries': dict(self._primaries),
+                'elections': [{x: getattr(y, x) for x in Election.__slots__} for y in self._elections],
+                'election_counts': dict(self._election_counts),
+                'role_changes': [{'time': x[0], 'address': x[1], 'previous_role': x[2], 'role': x[3]}
+                                 for x in self._role_changes]
+            }
+
+
+class TopologyEventListener(monitoring.ServerListener, monitoring.ServerHeartbeatListener):
+    """
+    forward server and heartbeat events of the driver to a topology model, registered on every client of
+    the client registry
+    """
+
+    def __init__(self, model: TopologyModel):
+        self.model = model
+
+    def opened(self, event: monitoring.ServerOpeningEvent):
+        self.model.server_opened(address_of(event.server_address))
+
+    def description_changed(self, event: monitoring.ServerDescriptionChangedEvent):
+        description = event.new_description
+        election_id = description.election_id
+        self.model.description_changed(address_of(event.server_address), description.server_type_name,
+                                       description.replica_set_name, description.round_trip_time,
+                                       str(election_id) if election_id is not None else None)
+
+    def closed(self, event: monitoring.ServerClosedEvent):
+        pass
+
+    def started(self, event: monitoring.ServerHeartbeatStartedEvent):
+        pass
+
+    def succeeded(self, event: monitoring.ServerHeartbeatSucceededEvent):
+        self.model.heartbeat_succeeded(address_of(event.connection_id), event.duration,
+                                       getattr(event, 'awaited', False))
+
+    def failed(self, event: monitoring.ServerHeartbeatFailedEvent):
+        self.model.heartbeat_failed(address_of(event.connection_id), event.reply)
+
+
+topology_model = TopologyModel()
+topology_listener = TopologyEventListener(topology_model)
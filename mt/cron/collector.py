@@ -0,0 +1,179 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from bson import SON
+from rich.console import Console
+
+from mt.conf.parser import global_config
+from mt.core.client_registry import client_registry
+from mt.core.connector import ShardingCluster
+from mt.core.extend_cmd import fetch_oplog_window
+
+console = Console()
+
+SERVER_STATUS = 'server_status'
+REPLICATION_STATUS = 'replication_status'
+OPLOG_WINDOW = 'oplog_window'
+
+
+class CollectTarget:
+    __slots__ = ['name', 'host', 'port', 'replication_name', 'kinds', 'client', 'next_run', 'running',
+                 'last_error', 'skipped_ticks']
+
+    def __init__(self, host: str, port: int, replication_name: Optional[str], kinds: List[str]):
+        self.name = f'{host}:{port}'
+        self.host = host
+        self.port = int(port)
+        # None for mongos
+        self.replication_name = replication_name
+        self.kinds = kinds
+        self.client = None
+        self.next_run = 0.0
+        self.running = False
+        self.last_error = None
+        self.skipped_ticks = 0
+
+
+class MetricsCollector:
+    """
+    poll serverStatus of mongos and every member of the config server and shards,
+    replSetGetStatus and oplog window of every data bearing member, on a fixed interval
+    every target has its own schedule with jitter, a target still being polled skips its tick
+    so a slow node never delays the others
+    at most max_workers targets are polled at the same time, one worker per target by default
+    every sample is passed to on_sample as {'target', 'replication', 'kind', 'time', 'document'}
+    """
+
+    def __init__(self, cluster: ShardingCluster, interval: float = 10, timeout: float = 5, jitter: float = 0.1,
+                 max_workers: int = None, server_status_excludes: List[str] = None,
+                 on_sample: Callable[[dict], None] = None):
+        self.cluster = cluster
+        self.interval = interval
+        self.timeout = timeout
+        self.jitter = jitter
+        self.max_workers = max_workers
+        # large sections of serverStatus not needed by the metrics are not sent at all
+        self.server_status_excludes = ['locks', 'tcmalloc'] if server_status_excludes is None \
+            else server_status_excludes
+        self.on_sample = on_sample
+        self.latest_samples: Dict[tuple, dict] = {}
+        self.targets: List[CollectTarget] = []
+        # replication name -> error of the replication sets whose members could not be discovered
+        self.discovery_errors: Dict[str, str] = {}
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_config(cls, cluster: ShardingCluster, on_sample: Callable[[dict], None] = None) -> 'MetricsCollector':
+        collector_config = global_config.get('collector_config', {})
+        options = {x: collector_config.get(x) for x in
+                   ['interval', 'timeout', 'jitter', 'max_workers', 'server_status_excludes'] if x in collector_config}
+        return cls(cluster, on_sample=on_sample, **options)
+
+    def discover_targets(self) -> List[CollectTarget]:
+        targets = [CollectTarget(host, port, None, [SERVER_STATUS]) for host, port in
+                   sorted(self.cluster.basic_connection.nodes)]
+        replication_sets = [self.cluster.config_server] + list(self.cluster.shards.values())
+        for replication in replication_sets:
+            if replication is None:
+                continue
+            try:
+                member_set = replication.replication_member_set
+            except Exception as e:
+                self.discovery_errors.update({replication.name: str(e)})
+                console.print(f'discover members of replication:{replication.name} failed # {e}', style='bold red')
+                continue
+            self.discovery_errors.pop(replication.name, None)
+            for member in member_set.member_set:
+                kinds = [SERVER_STATUS, REPLICATION_STATUS]
+                if member.role != 'ARBITER':
+                    kinds.append(OPLOG_WINDOW)
+                targets.append(CollectTarget(member.address.ip, member.address.port, replication.name, kinds))
+        return targets
+
+    def _server_status_command(self) -> SON:
+        command = SON([('serverStatus', 1)])
+        for section in self.server_status_excludes:
+            command.update({section: 0})
+        return command
+
+    def poll(self, target: CollectTarget) -> List[dict]:
+        if target.client is None:
+            timeout_ms = int(self.timeout * 1000)
+            target.client = client_registry.acquire_direct(
+                target.host, target.port, serverSelectionTimeoutMS=timeout_ms, connectTimeoutMS=timeout_ms,
+                socketTimeoutMS=timeout_ms)
+        samples = []
+        for kind in target.kinds:
+            if kind == SERVER_STATUS:
+                document = target.client.admin.command(self._server_status_command())
+            elif kind == REPLICATION_STATUS:
+                document = target.client.admin.command('replSetGetStatus')
+            else:
+                document = fetch_oplog_window(target.client)
+            samples.append({'target': target.name, 'replication': target.replication_name, 'kind': kind,
+                            'time': time.time(), 'document': document})
+        return samples
+
+    def _poll_target(self, target: CollectTarget):
+        try:
+            for sample in self.poll(target):
+                self.latest_samples.update({(target.name, sample.get('kind')): sample})
+                if self.on_sample is not None:
+                    self.on_sample(sample)
+            target.last_error = None
+        except Exception as e:
+            target.last_error = str(e)
+        finally:
+            target.running = False
+
+    def _schedule_next(self, target: CollectTarget, now: float):
+        target.next_run += self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+        if target.next_run < now:
+            # fell behind, do not fire the missed ticks in a burst
+            target.next_run = now + self.interval
+
+    def run_forever(self):
+        self._stopped.clear()
+        self.targets = self.discover_targets()
+        if not self.targets:
+            return
+        console.print(f'collecting metrics of {len(self.targets)} targets every {self.interval}s', style='bold')
+        start = time.monotonic()
+        for target in self.targets:
+            # spread first polls over one interval
+            target.next_run = start + random.uniform(0, self.interval)
+        with ThreadPoolExecutor(max_workers=self.max_workers or len(self.targets)) as executor:
+            while not self._stopped.is_set():
+                now = time.monotonic()
+                for target in self.targets:
+                    if target.next_run > now:
+                        continue
+                    self._schedule_next(target, now)
+                    if target.running:
+                        target.skipped_ticks += 1
+                        continue
+                    target.running = True
+                    executor.submit(self._poll_target, target)
+                next_run = min(x.next_run for x in self.targets)
+                self._stopped.wait(max(0.0, next_run - time.monotonic()))
+        for target in self.targets:
+            if target.client is not None:
+                client_registry.release(target.client)
+                target.client = None
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run_forever, name='mt-metrics-collector', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+
+if __name__ == '__main__':
+    c = ShardingCluster("mongodb://192.168.20.120:27010,192.168.20.170:27010,192.168.20.183:27010")
+    collector = MetricsCollector(c, on_sample=lambda x: print(x.get('target'), x.get('kind')))
+    collector.run_forever()
@@ -0,0 +1,291 @@
+import mmap
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+from mt.conf.parser import global_config
+from mt.core.connector import ShardingCluster
+from mt.cron.collector import SERVER_STATUS, REPLICATION_STATUS, OPLOG_WINDOW, MetricsCollector
+
+# metric name -> key path in serverStatus
+server_status_metrics = {
+    'opcounters.insert': ('opcounters', 'insert'),
+    'opcounters.query': ('opcounters', 'query'),
+    'opcounters.update': ('opcounters', 'update'),
+    'opcounters.delete': ('opcounters', 'delete'),
+    'opcounters.getmore': ('opcounters', 'getmore'),
+    'opcounters.command': ('opcounters', 'command'),
+    'connections.current': ('connections', 'current'),
+    'connections.available': ('connections', 'available'),
+    'network.bytes_in': ('network', 'bytesIn'),
+    'network.bytes_out': ('network', 'bytesOut'),
+    'memory.resident_mb': ('mem', 'resident'),
+    'wiredtiger.cache_bytes': ('wiredTiger', 'cache', 'bytes currently in the cache'),
+    'wiredtiger.cache_dirty_bytes': ('wiredTiger', 'cache', 'tracked dirty bytes in the cache'),
+    'wiredtiger.cache_max_bytes': ('wiredTiger', 'cache', 'maximum bytes configured'),
+    'wiredtiger.pages_read': ('wiredTiger', 'cache', 'pages read into cache'),
+    'wiredtiger.pages_written': ('wiredTiger', 'cache', 'pages written from cache'),
+}
+
+oplog_window_metrics = {
+    'oplog.window_hours': ('timeDiffHours',),
+    'oplog.used_mb': ('usedMB',),
+    'oplog.size_mb': ('logSizeMB',),
+    'oplog.inserted_bytes': ('insertedBytes',),
+}
+
+
+def get_by_path(document: dict, path: tuple):
+    for key in path:
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def extract_metrics(kind: str, document: dict) -> Dict[str, float]:
+    """
+    pick the numeric metrics out of a collected document, the document itself is not kept
+    """
+    if kind == SERVER_STATUS:
+        metric_paths = server_status_metrics
+    elif kind == OPLOG_WINDOW:
+        metric_paths = oplog_window_metrics
+    elif kind == REPLICATION_STATUS:
+        members = document.get('members', [])
+        primary_optime = [x.get('optimeDate') for x in members if x.get('stateStr') == 'PRIMARY']
+        self_optime = [x.get('optimeDate') for x in members if x.get('self')]
+        if not primary_optime or not self_optime or not primary_optime[0] or not self_optime[0]:
+            return {}
+        self_state = [x.get('state') for x in members if x.get('self')]
+        return {'replication.lag_seconds': (primary_optime[0] - self_optime[0]).total_seconds(),
+                'replication.state': float(self_state[0])}
+    else:
+        return {}
+    metrics = {}
+    for metric_name, path in metric_paths.items():
+        value = get_by_path(document, path)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics.update({metric_name: float(value)})
+    return metrics
+
+
+class RingBuffer:
+    """
+    fixed size ring of (timestamp, value) doubles in one flat buffer: head, count, timestamps, values
+    the buffer is an array in memory or a memory mapped file
+    """
+    _header_size = 2
+
+    def __init__(self, capacity: int, path: Optional[str] = None):
+        self.capacity = capacity
+        self._mmap = None
+        self._mmap_view = None
+        size = self._header_size + 2 * capacity
+        if path is None:
+            self._buffer = memoryview(array('d', bytes(8 * size)))
+        else:
+            self._buffer = self._map_file(path, size)
+        self._timestamps = self._buffer[self._header_size:self._header_size + capacity]
+        self._values = self._buffer[self._header_size + capacity:]
+
+    def _map_file(self, path: str, size: int) -> memoryview:
+        if not os.path.exists(path) or os.path.getsize(path) != 8 * size:
+            # a file of another capacity can not be reused
+            with open(path, 'wb') as f:
+                f.truncate(8 * size)
+        with open(path, 'r+b') as f:
+            self._mmap = mmap.mmap(f.fileno(), 8 * size)
+        self._mmap_view = memoryview(self._mmap)
+        return self._mmap_view.cast('d')
+
+    @property
+    def head(self) -> int:
+        return int(self._buffer[0])
+
+    def __len__(self):
+        return int(self._buffer[1])
+
+    def append(self, timestamp: float, value: float):
+        head = self.head
+        self._timestamps[head] = timestamp
+        self._values[head] = value
+        self._buffer[0] = (head + 1) % self.capacity
+        self._buffer[1] = min(len(self) + 1, self.capacity)
+
+    def latest(self) -> Optional[Tuple[float, float]]:
+        if not len(self):
+            return None
+        index = (self.head - 1) % self.capacity
+        return self._timestamps[index], self._values[index]
+
+    def segments(self, since: Optional[float] = None) -> List[Tuple[memoryview, memoryview]]:
+        """
+        :param since: only points with timestamp >= since
+        :return: (timestamps, values) slices of the buffer from oldest to newest, without copying
+        """
+        count, head = len(self), self.head
+        if count < self.capacity:
+            ranges = [(0, count)] if count else []
+        elif head == 0:
+            ranges = [(0, count)]
+        else:
+            ranges = [(head, count), (0, head)]
+        segments = []
+        for start, end in ranges:
+            if since is not None:
+                start = bisect_left(self._timestamps, since, start, end)
+            if start < end:
+                segments.append((self._timestamps[start:end], self._values[start:end]))
+        return segments
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+            for view in [self._timestamps, self._values, self._buffer, self._mmap_view]:
+                view.release()
+            try:
+                self._mmap.close()
+            except BufferError:
+                # slices returned by segments are still referenced, the map is closed when they are collected
+                pass
+            self._mmap = None
+
+
+class MetricSeries:
+    """
+    one ring buffer per retention tier, tier of resolution 0 keeps every sample,
+    coarser tiers keep the average of every resolution seconds
+    """
+    __slots__ = ['tiers', 'buffers', '_buckets']
+
+    def __init__(self, tiers: List[Tuple[int, int]], path_prefix: Optional[str] = None):
+        self.tiers = tiers
+        self.buffers = [RingBuffer(capacity, f'{path_prefix}.{resolution}.ring' if path_prefix else None)
+                        for resolution, capacity in tiers]
+        # bucket start, sum and count of the bucket being filled of every tier
+        self._buckets = [[None, 0.0, 0] for _ in tiers]
+
+    def record(self, timestamp: float, value: float):
+        for (resolution, _), buffer, bucket in zip(self.tiers, self.buffers, self._buckets):
+            if not resolution:
+                buffer.append(timestamp, value)
+                continue
+            bucket_start = timestamp - timestamp % resolution
+            if bucket[0] is not None and bucket[0] != bucket_start and bucket[2]:
+                buffer.append(bucket[0], bucket[1] / bucket[2])
+                bucket[1], bucket[2] = 0.0, 0
+            bucket[0] = bucket_start
+            bucket[1] += value
+            bucket[2] += 1
+
+    def close(self):
+        for buffer in self.buffers:
+            buffer.close()
+
+
+class MetricStore:
+    """
+    fixed memory store of sampled metrics, one MetricSeries per (node, metric)
+    tiers are (resolution seconds, capacity), by default 10 hours of raw samples at 10s,
+    1 day of 1 minute averages and 1 week of 10 minutes averages
+    series are memory mapped files under path if it is given, so that history survives a restart
+    """
+    default_tiers = [(0, 3600), (60, 1440), (600, 1008)]
+
+    def __init__(self, tiers: List[Tuple[int, int]] = None, path: Optional[str] = None):
+        self.tiers = tiers or self.default_tiers
+        self.path = path
+        self._series: Dict[Tuple[str, str], MetricSeries] = {}
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._load_series()
+
+    @classmethod
+    def from_config(cls) -> 'MetricStore':
+        metric_store = global_config.get('metric_store', {})
+        tiers = metric_store.get('tiers')
+        return cls([tuple(x) for x in tiers] if tiers else None, metric_store.get('path'))
+
+    @staticmethod
+    def _node_directory(node: str) -> str:
+        return node.replace(':', '_')
+
+    def _load_series(self):
+        for node_directory in os.listdir(self.path):
+            if not os.path.isdir(os.path.join(self.path, node_directory)):
+                continue
+            node = '_'.join(node_directory.split('_')[:-1]) + ':' + node_directory.split('_')[-1]
+            metrics = {x.rsplit('.', 2)[0] for x in os.listdir(os.path.join(self.path, node_directory))
+                       if x.endswith('.ring')}
+            for metric in metrics:
+                self._get_series(node, metric)
+
+    def _get_series(self, node: str, metric: str) -> MetricSeries:
+        series = self._series.get((node, metric))
+        if series is None:
+            path_prefix = None
+            if self.path:
+                node_path = os.path.join(self.path, self._node_directory(node))
+                os.makedirs(node_path, exist_ok=True)
+                path_prefix = os.path.join(node_path, metric)
+            series = MetricSeries(self.tiers, path_prefix)
+            self._series.update({(node, metric): series})
+        return series
+
+    def record(self, node: str, metrics: Dict[str, float], timestamp: float):
+        with self._lock:
+            for metric, value in metrics.items():
+                self._get_series(node, metric).record(timestamp, value)
+
+    def record_sample(self, sample: dict):
+        """
+        on_sample callback of MetricsCollector
+        """
+        metrics = extract_metrics(sample.get('kind'), sample.get('document'))
+        self.record(sample.get('target'), metrics, sample.get('time'))
+
+    def keys(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._series)
+
+    def read(self, node: str, metric: str, tier: int = 0,
+             since: Optional[float] = None) -> List[Tuple[memoryview, memoryview]]:
+        """
+        :param tier: index of the retention tier
+        :return: (timestamps, values) slices from oldest to newest, empty if the series does not exist
+        """
+        with self._lock:
+            series = self._series.get((node, metric))
+            return series.buffers[tier].segments(since) if series else []
+
+    def latest(self, node: str, metric: str) -> Optional[Tuple[float, float]]:
+        with self._lock:
+            series = self._series.get((node, metric))
+            return series.buffers[0].latest() if series else None
+
+    def flush(self):
+        with self._lock:
+            for series in self._series.values():
+                for buffer in series.buffers:
+                    buffer.flush()
+
+    def close(self):
+        with self._lock:
+            for series in self._series.values():
+                series.close()
+            self._series.clear()
+
+
+if __name__ == '__main__':
+    c = ShardingCluster("mongodb://192.168.20.120:27010,192.168.20.170:27010,192.168.20.183:27010")
+    store = MetricStore(path='./metrics')
+    collector = MetricsCollector(c, on_sample=store.record_sample)
+    collector.run_forever()
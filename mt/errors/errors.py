@@ -16,3 +16,13 @@ class NotReplicationException(Exception):
 class ExtendCmdException(Exception):
     def __init__(self, message='Extend cmd failed'):
         super(ExtendCmdException, self).__init__(message)
+
+
+class RebootTimeoutException(Exception):
+    def __init__(self, message='member did not recover in time'):
+        super(RebootTimeoutException, self).__init__(message)
+
+
+class ProfileSnapshotException(Exception):
+    def __init__(self, message='profile snapshot is not readable'):
+        super(ProfileSnapshotException, self).__init__(message)
@@ -1,13 +1,12 @@
 import os
 from json import dump
 
-from rich.progress import track
-
 from mt.conf.parser import global_config
 from mt.core.connector import ShardingCluster
 from mt.operation.reboot import console
 from mt.operation.reboot.common import success_style
-from mt.operation.reboot.replication_set import save_cmd_lines, replication_reboot
+from mt.operation.reboot.replication_set import save_cmd_lines, get_process_tables
+from mt.operation.reboot.scheduler import RollingRebootScheduler
 
 
 def save_cmd_lines_of_shards(cluster: ShardingCluster):
@@ -17,9 +16,14 @@ def save_cmd_lines_of_shards(cluster: ShardingCluster):
         console.print(f'if you want use new config, remove current file:{cmd_save_path}', style='yellow')
         return
     replication_sets_mapper = cluster.shards
+    # every host is listed once for all shards running on it
+    host_ips = set()
+    for _, shard in replication_sets_mapper.items():
+        host_ips.update(x.address.ip for x in shard.replication_member_set.member_set)
+    process_tables = get_process_tables(host_ips)
     all_cmd_lines = {}
     for _, shard in replication_sets_mapper.items():
-        start_cmd = save_cmd_lines(shard)
+        start_cmd = save_cmd_lines(shard, process_tables)
         all_cmd_lines.update({shard.name: start_cmd})
     else:
         # saving info to disk file
@@ -28,10 +32,14 @@ def save_cmd_lines_of_shards(cluster: ShardingCluster):
             console.print('cmd to start sharding has been saved!', style=success_style)
 
 
-def reboot_cluster_shards(cluster: ShardingCluster):
+def reboot_cluster_shards(cluster: ShardingCluster) -> dict:
+    """
+    rolling reboot of all shards, concurrency and availability budget are read from reboot_config
+    :return: {shard name: error} of the shards not rebooted
+    """
     replication_sets_mapper = cluster.shards
-    for shard in track(list(replication_sets_mapper.values()), description=f"REBOOTING SHARD..."):
-        replication_reboot(shard)
+    scheduler = RollingRebootScheduler.from_config()
+    return scheduler.run(list(replication_sets_mapper.values()))
 
 
 if __name__ == '__main__':
@@ -1,6 +1,12 @@
+import atexit
+import threading
+from typing import Dict
+
 from fabric import Connection
 from rich.style import Style
 
+from mt.conf.parser import global_config
+
 connection_container = []
 
 
@@ -18,6 +24,55 @@ def create_ssh_connection(host: str, port: int, user_name: str, password: str) -
         return connection
 
 
+class SshConnectionPool:
+    """
+    one ssh connection per host ip, the ip index is built once from ssh_config of global config
+    connections are kept alive and reused by every reboot operation until close_all
+    """
+
+    def __init__(self, keepalive: int = 30):
+        self.keepalive = keepalive
+        self._host_info: Dict[str, dict] = None
+        self._connections: Dict[str, Connection] = {}
+        self._host_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _get_host_info(self, ip: str) -> dict:
+        with self._lock:
+            if self._host_info is None:
+                self._host_info = {x.get('host'): x for x in global_config.get('ssh_config', {}).values()}
+            return self._host_info.get(ip)
+
+    def _get_host_lock(self, ip: str) -> threading.Lock:
+        with self._lock:
+            return self._host_locks.setdefault(ip, threading.Lock())
+
+    def get(self, ip: str) -> Connection:
+        host_info = self._get_host_info(ip)
+        if not host_info:
+            raise Exception('no ssh info available')
+        # only connections to the same host wait for each other
+        with self._get_host_lock(ip):
+            connection = self._connections.get(ip)
+            if connection is None:
+                connection = create_ssh_from_host_info(host_info)
+                self._connections.update({ip: connection})
+            if not connection.is_connected:
+                connection.open()
+                connection.transport.set_keepalive(self.keepalive)
+            return connection
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+
+ssh_connection_pool = SshConnectionPool()
+atexit.register(ssh_connection_pool.close_all)
+
 danger_style = Style(color="red", blink=True, bold=True)
 success_style = Style(color="green", bold=True)
 
@@ -1,134 +1,316 @@
+import time
+from typing import Dict, Iterable, List
+
 import invoke
-from fabric import Connection
+from pymongo.errors import PyMongoError
 
-from mt.conf.parser import global_config, mongo_cmd_lines
-from mt.core.common import ReplicationRole
+from mt.conf.parser import mongo_cmd_lines
+from mt.core.client_registry import client_registry
+from mt.core.common import ReplicationRole, run_bounded
 from mt.core.connector import ReplicationSet, ReplicationMember, Address
+from mt.core.topology_model import topology_model
+from mt.errors.errors import RebootTimeoutException
 from mt.operation.reboot import console
-from mt.operation.reboot.common import create_ssh_from_host_info, success_style, mongo_start_prefix
+from mt.operation.reboot.common import ssh_connection_pool, success_style, mongo_start_prefix
+from mt.operation.reboot.timing import reboot_timing
 
 
 def get_ssh_connection_of_node(address: 'Address'):
-    # find ssh info of current node
-    ip, port = address.ip, address.port
-    ssh_info = global_config.get('ssh_config', {})
-    target_ssh_info = {}
-    for host, host_info in ssh_info.items():
-        if host_info.get('host') == ip:
-            target_ssh_info = host_info
-            break
-    if not target_ssh_info:
-        raise Exception('no ssh info available')
-    ssh_connection = create_ssh_from_host_info(target_ssh_info)
-    return ssh_connection
-
-
-def save_cmd_lines(replication: ReplicationSet):
+    # find ssh connection of current node
+    return ssh_connection_pool.get(address.ip)
+
+
+def address_of_node(node: ReplicationMember) -> str:
+    return f'{node.address.ip}:{node.address.port}'
+
+
+class HostProcessTable:
+    """
+    mongod start cmd lines of one host, parsed once from a single ps output
+    """
+
+    def __init__(self, ps_output: str):
+        self.cmd_lines = []
+        self.cmd_of_member = {}
+        self.cmd_of_port = {}
+        for line in ps_output.split('\n'):
+            if 'mongod' not in line:
+                continue
+            cmd_line = ' '.join(list(filter(lambda x: x, line.split(' ')))[7:])
+            port, replication_name = self.parse_cmd_line(cmd_line)
+            self.cmd_lines.append(cmd_line)
+            if port:
+                self.cmd_of_port.setdefault(port, cmd_line)
+                if replication_name:
+                    self.cmd_of_member.setdefault((port, replication_name), cmd_line)
+
+    @staticmethod
+    def parse_cmd_line(cmd_line: str) -> tuple:
+        """
+        :return: value of --port and --replSet, None if they are set in a config file
+        """
+        options = {}
+        args = cmd_line.split(' ')
+        for index, arg in enumerate(args):
+            for option in ['--port', '--replSet']:
+                if arg == option and index + 1 < len(args):
+                    options.update({option: args[index + 1]})
+                elif arg.startswith(f'{option}='):
+                    options.update({option: arg[len(option) + 1:]})
+        return options.get('--port'), options.get('--replSet')
+
+    def get_start_cmd(self, port: str, replication_name: str) -> str:
+        target_cmd = self.cmd_of_member.get((str(port), replication_name)) or self.cmd_of_port.get(str(port))
+        if target_cmd:
+            return target_cmd
+        for cmd_line in self.cmd_lines:
+            if replication_name in cmd_line:
+                return cmd_line
+        return ''
+
+
+def get_process_tables(host_ips: Iterable[str], max_workers: int = 16) -> Dict[str, HostProcessTable]:
+    """
+    run one process listing per host, all hosts at the same time
+    """
+    process_tables = {}
+    for ip, result, error in run_bounded(lambda x: ssh_connection_pool.get(x).run('ps -ef', hide=True), host_ips,
+                                         max_workers):
+        if error:
+            raise Exception(f'list process of host:{ip} failed # {error}')
+        process_tables.update({ip: HostProcessTable(result.stdout)})
+    return process_tables
+
+
+def save_cmd_lines(replication: ReplicationSet, process_tables: Dict[str, HostProcessTable] = None):
     replication_members = replication.replication_member_set.member_set
-    # ssh to target host and save target shard start cmd line
-    start_cmd_line_info = {}
     for member in replication_members:
         if member.status != 1:
             raise Exception(f'current replication node:{member.address} is not health, cmd line saving abort!')
-        ssh_connection = get_ssh_connection_of_node(member.address)
-        cmd_result = get_start_cmd_of_target_node(ssh_connection, member.name)
+    if process_tables is None:
+        process_tables = get_process_tables({x.address.ip for x in replication_members})
+    # find start cmd line of every member from process table of its host
+    start_cmd_line_info = {}
+    for member in replication_members:
+        cmd_result = process_tables[member.address.ip].get_start_cmd(member.address.port, member.name)
         start_cmd_line_info.update({member.address.ip: cmd_result})
     return start_cmd_line_info
 
 
-def get_start_cmd_of_target_node(connection: Connection, shard_name: str):
-    with connection as c:
-        result = c.run(f'ps -ef | grep {shard_name}', hide=True)
-        output = result.stdout
-        lines = output.split('\n')
-        target_cmd = ''
-        for line in lines:
-            if 'mongod' in line and shard_name in line:
-                target_cmd = ' '.join(list(filter(lambda x: x, line.split(' ')))[7:])
-                break
-        return target_cmd
+def member_recover_status(client, restarted_at: float, accepted_roles: List[str],
+                          max_lag_seconds: float) -> List[bool]:
+    """
+    replSetGetStatus of the member itself, so that a view of the member from before its shutdown is never used
+    the member only counts as reachable once its uptime shows the process started after restarted_at
+    :return: whether the member is reachable, in one of accepted_roles and caught up
+    """
+    try:
+        status = client.admin.command('replSetGetStatus')
+    except PyMongoError:
+        # still down, starting or in an election
+        return [False, False, False]
+    members = status.get('members', [])
+    self_member = next((x for x in members if x.get('self')), {})
+    uptime = self_member.get('uptime')
+    if uptime is None or uptime > time.time() - restarted_at:
+        return [False, False, False]
+    role = self_member.get('stateStr')
+    if role not in accepted_roles:
+        return [True, False, False]
+    if role == ReplicationRole.PRIMARY.value:
+        return [True, True, True]
+    primary_members = [x for x in members if x.get('stateStr') == ReplicationRole.PRIMARY.value]
+    if not primary_members or not primary_members[0].get('optimeDate') or not self_member.get('optimeDate'):
+        return [True, True, False]
+    lag = primary_members[0].get('optimeDate') - self_member.get('optimeDate')
+    return [True, True, lag.total_seconds() <= max_lag_seconds]
 
 
-def replication_reboot(replication: ReplicationSet):
-    replication_members = replication.replication_member_set.member_set
+def wait_for_member_recovered(replication: ReplicationSet, member: ReplicationMember, restarted_at: float,
+                              max_lag_seconds: float = 10, timeout: float = 600, poll_interval: float = 2,
+                              accepted_roles: List[str] = None):
+    """
+    poll replSetGetStatus of the member until it runs a process started after restarted_at, is in one of
+    accepted_roles (SECONDARY by default) and, as a secondary, at most max_lag_seconds behind the primary,
+    waiting between polls ends early when driver monitoring reports a change of the topology
+    time spent to become reachable, SECONDARY and caught up is recorded as separate phases, reachable counts from
+    restarted_at and every phase ends only when a poll of the restarted process reached it
+    """
+    accepted_roles = accepted_roles or [ReplicationRole.SECONDARY.value]
+    member_name = f'{member.address.ip}:{member.address.port}'
+    recover_phases = ['reachable', 'secondary', 'caught_up']
+    phase_index = 0
+    deadline = time.monotonic() + timeout
+    phase_started_at = restarted_at
+    phase_start = time.monotonic() - max(time.time() - restarted_at, 0)
+    topology_version = topology_model.version
+    timeout_ms = int(poll_interval * 1000)
+    client = client_registry.acquire_direct(member.address.ip, int(member.address.port),
+                                            serverSelectionTimeoutMS=timeout_ms, connectTimeoutMS=timeout_ms)
+    try:
+        while time.monotonic() < deadline:
+            reached = member_recover_status(client, restarted_at, accepted_roles, max_lag_seconds)
+            while phase_index < len(recover_phases) and reached[phase_index]:
+                now = time.monotonic()
+                reboot_timing.record(member, recover_phases[phase_index], phase_started_at, now - phase_start)
+                phase_started_at, phase_start = time.time(), now
+                phase_index += 1
+            if phase_index == len(recover_phases):
+                return
+            topology_version = topology_model.wait_for_change(topology_version, poll_interval)
+    finally:
+        client_registry.release(client)
+    reboot_timing.record(member, recover_phases[phase_index], phase_started_at, time.monotonic() - phase_start,
+                         ok=False)
+    raise RebootTimeoutException(f'member {member_name} of replication:{replication.name} is not caught up '
+                                 f'after {timeout}s')
+
+
+def is_still_primary(replication_name: str, node: ReplicationMember, timeout: float = 5) -> bool:
+    """
+    driver monitoring forgets the primary while a heartbeat to it fails, then the node itself is asked,
+    a node that can not be asked is taken as primary since stepping down a secondary is harmless
+    """
+    live_primary = topology_model.primary_of(replication_name)
+    if live_primary is not None:
+        return live_primary == address_of_node(node)
+    timeout_ms = int(timeout * 1000)
+    client = client_registry.acquire_direct(node.address.ip, int(node.address.port),
+                                            serverSelectionTimeoutMS=timeout_ms, connectTimeoutMS=timeout_ms)
+    try:
+        return bool(client.admin.command('isMaster').get('ismaster'))
+    except PyMongoError:
+        return True
+    finally:
+        client_registry.release(client)
+
+
+def replication_reboot(replication: ReplicationSet, max_unavailable: int = 1, max_lag_seconds: float = 10,
+                       recover_timeout: float = 600, poll_interval: float = 2):
+    """
+    at most max_unavailable members are down at the same time,
+    each step waits for the restarted members to become SECONDARY and catch up before the next one
+    """
+    # the member set is taken once, every member of it is rebooted exactly once even if an election happens meanwhile
+    replication_member_set = replication.replication_member_set
+    replication_members = replication_member_set.member_set
+    # addresses of the members rebooted already
+    rebooted = set()
     # start rebooting current replication set
-    # step1. rebooting secondaries
     replication_name = replication.name
     target_cmd_lines = mongo_cmd_lines.get(replication_name, {})
     if not target_cmd_lines:
         raise Exception('no mongo cmd saved!')
-    secondary_nodes = filter(lambda x: x.role and x.role == ReplicationRole.SECONDARY.value, replication_members)
-    for node in secondary_nodes:
-        node_ip = node.address.ip
-        node_start_cmd = target_cmd_lines.get(node_ip)
-        if not node_start_cmd:
-            raise Exception(
-                f'no start cmd # current replication member:{node.address.ip}:{node.address.port} of '
-                f'replication:{replication_name}')
-        secondary_reboot(node, node_start_cmd)
 
-    unhealthy_nodes = filter(lambda x: x.role and x.role == ReplicationRole.OFFLINE.value, replication_members)
-    for node in unhealthy_nodes:
-        node_ip = node.address.ip
-        node_start_cmd = target_cmd_lines.get(node_ip)
+    def get_start_cmd(node: ReplicationMember) -> str:
+        node_start_cmd = target_cmd_lines.get(node.address.ip)
         if not node_start_cmd:
             raise Exception(
                 f'no start cmd # current replication member:{node.address.ip}:{node.address.port} of '
                 f'replication:{replication_name}')
-        unhealthy_node_reboot(node, node_start_cmd)
+        return node_start_cmd
+
+    def wait_for_recovered(restarted_at: Dict[ReplicationMember, float], accepted_roles: List[str] = None):
+        rebooted.update(address_of_node(x) for x in restarted_at)
+        for node, node_restarted_at in restarted_at.items():
+            wait_for_member_recovered(replication, node, node_restarted_at, max_lag_seconds, recover_timeout,
+                                      poll_interval, accepted_roles)
+
+    # step1. starting unhealthy nodes, they are unavailable already
+    unhealthy_nodes = [x for x in replication_members if x.role and x.role == ReplicationRole.OFFLINE.value]
+    wait_for_recovered({x: unhealthy_node_reboot(x, get_start_cmd(x)) for x in unhealthy_nodes})
+
+    # step2. rebooting secondaries, max_unavailable of them at a time
+    secondary_nodes = [x for x in replication_members if x.role and x.role == ReplicationRole.SECONDARY.value]
+    for index in range(0, len(secondary_nodes), max_unavailable):
+        batch = secondary_nodes[index:index + max_unavailable]
+        restarted_at = {}
+        for node, node_restarted_at, error in run_bounded(lambda x: secondary_reboot(x, get_start_cmd(x)), batch,
+                                                          len(batch)):
+            if error:
+                raise error
+            restarted_at.update({node: node_restarted_at})
+        wait_for_recovered(restarted_at)
 
-    primary_node = replication.replication_member_set.primary_node
-    primary_reboot(primary_node, target_cmd_lines.get(primary_node.address.ip))
+    # step3. rebooting the original primary, after step down if it is still primary
+    # an election during the previous steps is seen by driver monitoring, then the original primary is a secondary
+    primary_node = replication_member_set.primary_node
+    if primary_node is None or address_of_node(primary_node) in rebooted:
+        return
+    if is_still_primary(replication_name, primary_node):
+        restarted_at = primary_reboot(primary_node, get_start_cmd(primary_node))
+    else:
+        restarted_at = secondary_reboot(primary_node, get_start_cmd(primary_node))
+    # the original primary may be elected again after it restarted if it has the highest priority
+    wait_for_recovered({primary_node: restarted_at}, [ReplicationRole.PRIMARY.value, ReplicationRole.SECONDARY.value])
 
 
-def primary_reboot(primary_node: ReplicationMember, start_cmd: str):
+def primary_reboot(primary_node: ReplicationMember, start_cmd: str) -> float:
+    """
+    :return: epoch seconds right before the start cmd ran
+    """
     ssh_connection = get_ssh_connection_of_node(primary_node.address)
     mongo_port = primary_node.address.port
-    with ssh_connection as c:
-        # step down
-        step_down_cmd = f"mongo --port {mongo_port} --eval 'rs.stepDown()'"
+    # step down
+    step_down_cmd = f"mongo --port {mongo_port} --eval 'rs.stepDown()'"
+    with reboot_timing.span(primary_node, 'step_down'):
         try:
-            c.run(step_down_cmd, hide=True)
+            ssh_connection.run(step_down_cmd, hide=True)
         except invoke.exceptions.UnexpectedExit as ie:
             console.print('rs stepdown!', style='bold')
         except Exception as e:
             raise e
-        # shutdown mongod
-        cmd = f"mongo --port {mongo_port} admin --eval 'db.shutdownServer()'"
-        c.run(cmd, hide=True)
-        # restart mongod with cmd line
-        c.run(' && '.join(mongo_start_prefix + [start_cmd]), hide=True, replace_env=True)
+    # shutdown mongod
+    cmd = f"mongo --port {mongo_port} admin --eval 'db.shutdownServer()'"
+    with reboot_timing.span(primary_node, 'shutdown'):
+        ssh_connection.run(cmd, hide=True)
+    # restart mongod with cmd line
+    restarted_at = time.time()
+    with reboot_timing.span(primary_node, 'start'):
+        ssh_connection.run(' && '.join(mongo_start_prefix + [start_cmd]), hide=True, replace_env=True)
     console.print(f'rebooted # {primary_node.role} member {primary_node.address.ip}:{primary_node.address.port} of'
                   f' replication:{primary_node.name}', style=success_style)
+    return restarted_at
 
 
-def secondary_reboot(secondary_node: ReplicationMember, start_cmd: str):
+def secondary_reboot(secondary_node: ReplicationMember, start_cmd: str) -> float:
+    """
+    :return: epoch seconds right before the start cmd ran
+    """
     ssh_connection = get_ssh_connection_of_node(secondary_node.address)
     mongo_port = secondary_node.address.port
-    with ssh_connection as c:
-        # shutdown mongod
-        # if secondary node is not running, just start it
-        cmd = f"mongo --port {mongo_port} admin --eval 'db.shutdownServer()'"
-        c.run(cmd, hide=True)
-        # restart mongod with cmd line
-        c.run(' && '.join(mongo_start_prefix + [start_cmd]), hide=True, replace_env=True)
+    # shutdown mongod
+    # if secondary node is not running, just start it
+    cmd = f"mongo --port {mongo_port} admin --eval 'db.shutdownServer()'"
+    with reboot_timing.span(secondary_node, 'shutdown'):
+        ssh_connection.run(cmd, hide=True)
+    # restart mongod with cmd line
+    restarted_at = time.time()
+    with reboot_timing.span(secondary_node, 'start'):
+        ssh_connection.run(' && '.join(mongo_start_prefix + [start_cmd]), hide=True, replace_env=True)
 
     console.print(
         f'rebooted # {secondary_node.role} member {secondary_node.address.ip}:{secondary_node.address.port} of'
         f' replication:{secondary_node.name}', style=success_style)
+    return restarted_at
 
 
-def unhealthy_node_reboot(node: ReplicationMember, start_cmd: str):
+def unhealthy_node_reboot(node: ReplicationMember, start_cmd: str) -> float:
+    """
+    :return: epoch seconds right before the start cmd ran
+    """
     console.print(f'current node:{node.address.ip}:{node.address.port} is not running', style='yellow')
     ssh_connection = get_ssh_connection_of_node(node.address)
-    with ssh_connection as c:
-        # just start this node
-        console.print(f'just start this node', style='yellow bold')
-        c.run(' && '.join(mongo_start_prefix + [start_cmd]), hide=True, replace_env=True)
+    # just start this node
+    console.print(f'just start this node', style='yellow bold')
+    restarted_at = time.time()
+    with reboot_timing.span(node, 'start'):
+        ssh_connection.run(' && '.join(mongo_start_prefix + [start_cmd]), hide=True, replace_env=True)
 
     console.print(
         f'started # {node.role} member {node.address.ip}:{node.address.port} of replication:{node.name}',
         style=success_style)
+    return restarted_at
 
 
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+import threading
+from typing import Dict, List
+
+from rich.progress import Progress
+
+from mt.conf.parser import global_config
+from mt.core.common import run_bounded
+from mt.core.connector import ReplicationSet
+from mt.operation.reboot import console
+from mt.operation.reboot.common import danger_style, success_style
+from mt.operation.reboot.replication_set import replication_reboot
+from mt.operation.reboot.timing import reboot_timing
+
+
+class RollingRebootScheduler:
+    """
+    rolling reboot of many replication sets at the same time
+    at most max_sets_in_flight sets are rebooting and at most max_unavailable_per_set members of one set are down,
+    no new set is started once a set failed
+    """
+
+    def __init__(self, max_sets_in_flight: int = 4, max_unavailable_per_set: int = 1, max_lag_seconds: float = 10,
+                 recover_timeout: float = 600, poll_interval: float = 2):
+        self.max_sets_in_flight = max_sets_in_flight
+        self.max_unavailable_per_set = max_unavailable_per_set
+        self.max_lag_seconds = max_lag_seconds
+        self.recover_timeout = recover_timeout
+        self.poll_interval = poll_interval
+        self._aborted = threading.Event()
+
+    @classmethod
+    def from_config(cls) -> 'RollingRebootScheduler':
+        reboot_config = global_config.get('reboot_config', {})
+        return cls(**{x: reboot_config.get(x) for x in ['max_sets_in_flight', 'max_unavailable_per_set',
+                                                         'max_lag_seconds', 'recover_timeout', 'poll_interval']
+                      if x in reboot_config})
+
+    def reboot_replication_set(self, replication: ReplicationSet):
+        if self._aborted.is_set():
+            raise Exception('skipped since another replication set failed')
+        try:
+            replication_reboot(replication, self.max_unavailable_per_set, self.max_lag_seconds,
+                               self.recover_timeout, self.poll_interval)
+        except Exception:
+            self._aborted.set()
+            raise
+
+    def run(self, replication_sets: List[ReplicationSet]) -> Dict[str, str]:
+        """
+        :return: {replication name: error} of the sets not rebooted
+        """
+        self._aborted.clear()
+        failed = {}
+        with Progress(console=console) as progress:
+            task = progress.add_task("REBOOTING SHARD...", total=len(replication_sets))
+            for replication, _, error in run_bounded(self.reboot_replication_set, replication_sets,
+                                                     self.max_sets_in_flight):
+                if error:
+                    failed.update({replication.name: str(error)})
+                    console.print(f'reboot replication:{replication.name} failed # {error}', style=danger_style)
+                else:
+                    console.print(f'replication:{replication.name} rebooted', style=success_style)
+                progress.advance(task)
+        reboot_timing.print_summary()
+        return failed
@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List
+
+from rich.table import Table
+
+from mt.conf.parser import global_config
+from mt.core.connector import ReplicationMember
+from mt.operation.reboot import console
+
+
+class RebootTimingRecorder:
+    """
+    time spans of every reboot phase of every member:
+    step_down, shutdown, start, reachable, secondary and caught_up
+    each span is appended to the json lines report at timing_report_path of reboot_config
+    """
+    phases = ['step_down', 'shutdown', 'start', 'reachable', 'secondary', 'caught_up']
+
+    def __init__(self):
+        self.spans: List[dict] = []
+        self._lock = threading.Lock()
+
+    @property
+    def report_path(self) -> str:
+        return global_config.get('reboot_config', {}).get('timing_report_path', './reboot_timing.jsonl')
+
+    def record(self, member: ReplicationMember, phase: str, started_at: float, seconds: float, ok: bool = True):
+        """
+        :param started_at: epoch seconds when the phase started
+        """
+        span = {
+            'replication': member.name,
+            'member': f'{member.address.ip}:{member.address.port}',
+            'role': member.role,
+            'phase': phase,
+            'started_at': datetime.fromtimestamp(started_at).isoformat(),
+            'seconds': round(seconds, 3),
+            'ok': ok
+        }
+        with self._lock:
+            self.spans.append(span)
+            with open(self.report_path, 'a') as f:
+                f.write(json.dumps(span) + '\n')
+
+    @contextmanager
+    def span(self, member: ReplicationMember, phase: str):
+        started_at = time.time()
+        start = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record(member, phase, started_at, time.monotonic() - start, ok)
+
+    def print_summary(self, top_n: int = 10):
+        """
+        slowest members by total reboot time and every phase by its slowest span
+        """
+        with self._lock:
+            spans = list(self.spans)
+        if not spans:
+            return
+        member_spans = {}
+        for span in spans:
+            member_spans.setdefault((span.get('replication'), span.get('member')), []).append(span)
+
+        member_table = Table(title=f'slowest {top_n} members')
+        for column in ['replication', 'member', 'total seconds', 'slowest phase', 'phase seconds']:
+            member_table.add_column(column)
+        member_totals = sorted(member_spans.items(), key=lambda x: -sum(y.get('seconds') for y in x[1]))
+        for (replication_name, member_name), target_spans in member_totals[:top_n]:
+            slowest_span = max(target_spans, key=lambda x: x.get('seconds'))
+            member_table.add_row(replication_name, member_name,
+                                 f'{sum(x.get("seconds") for x in target_spans):.1f}',
+                                 slowest_span.get('phase'), f'{slowest_span.get("seconds"):.1f}')
+        console.print(member_table)
+
+        phase_table = Table(title='reboot phases')
+        for column in ['phase', 'count', 'average seconds', 'max seconds', 'slowest member']:
+            phase_table.add_column(column)
+        for phase in self.phases:
+            target_spans = [x for x in spans if x.get('phase') == phase]
+            if not target_spans:
+                continue
+            slowest_span = max(target_spans, key=lambda x: x.get('seconds'))
+            average = sum(x.get('seconds') for x in target_spans) / len(target_spans)
+            phase_table.add_row(phase, str(len(target_spans)), f'{average:.1f}', f'{slowest_span.get("seconds"):.1f}',
+                                f'{slowest_span.get("replication")} {slowest_span.get("member")}')
+        console.print(phase_table)
+
+
+reboot_timing = RebootTimingRecorder()
@@ -0,0 +1,174 @@
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from dateutil import parser
+from rich.console import Console
+from rich.table import Table
+
+from mt.conf.parser import global_config
+from mt.core.common import run_bounded
+from mt.core.connector import ShardingCluster, ReplicationSet
+from mt.core.extend_cmd import fetch_oplog_window
+
+console = Console()
+
+_mb = 1024 * 1024
+_gb = 1024 * 1024 * 1024
+
+
+class OplogSample:
+    __slots__ = ['time', 'first', 'last', 'max_bytes', 'used_bytes', 'inserted_bytes']
+
+    def __init__(self, sample_time: float, window: dict):
+        self.time = sample_time
+        self.first = parser.parse(window.get('tFirst')).timestamp()
+        self.last = parser.parse(window.get('tLast')).timestamp()
+        self.max_bytes = window.get('logSizeMB') * _mb
+        self.used_bytes = window.get('usedMB') * _mb
+        self.inserted_bytes = window.get('insertedBytes')
+
+    @property
+    def window_seconds(self) -> float:
+        return self.last - self.first
+
+    def __repr__(self):
+        response = {}
+        for x in self.__slots__:
+            response.update({x: getattr(self, x)})
+        return str(response)
+
+
+def oplog_write_rate(previous: OplogSample, current: OplogSample) -> Optional[float]:
+    """
+    bytes written to the oplog per second between two samples
+    the insert counter of the oplog table is used when it did not go back (restart),
+    growth of the used size while the oplog is not full otherwise,
+    and once it is full the bytes evicted from its head, assuming the evicted entries had the average density
+    """
+    elapsed = current.time - previous.time
+    if elapsed <= 0:
+        return None
+    if previous.inserted_bytes is not None and current.inserted_bytes is not None \
+            and current.inserted_bytes >= previous.inserted_bytes:
+        return (current.inserted_bytes - previous.inserted_bytes) / elapsed
+    if current.used_bytes < current.max_bytes * 0.99:
+        return max(current.used_bytes - previous.used_bytes, 0) / elapsed
+    if previous.window_seconds <= 0:
+        return None
+    evicted_seconds = max(current.first - previous.first, 0)
+    return previous.used_bytes * evicted_seconds / previous.window_seconds / elapsed
+
+
+def hours_until_window_below(sample: OplogSample, write_rate: float, safe_seconds: float) -> Optional[float]:
+    """
+    time until the window falls below safe_seconds if writes continue at write_rate,
+    entries still in the oplog are assumed to have their average density
+    :return: 0 if the window is already too small, None if it never falls below safe_seconds
+    """
+    window = sample.window_seconds
+    if window < safe_seconds:
+        return 0.0
+    if write_rate <= 0 or window <= 0 or sample.max_bytes / write_rate >= safe_seconds:
+        return None
+    fill_seconds = max(sample.max_bytes - sample.used_bytes, 0) / write_rate
+    window += fill_seconds
+    old_rate = sample.max_bytes / window
+    if write_rate <= old_rate:
+        return None
+    # window after t more seconds: t + (max_bytes - write_rate * t) / old_rate
+    return (fill_seconds + (window - safe_seconds) / (write_rate / old_rate - 1)) / 3600
+
+
+class OplogEstimator:
+    """
+    oplog window and growth rate of every shard primary from a short sampling history
+    every sample reads the first and last oplog entries in natural order and collStats of the oplog,
+    so its cost does not depend on the oplog size
+    a shard whose projected window is below safe_window_hours, the time needed to rebuild a secondary, is at risk
+    """
+
+    def __init__(self, cluster: ShardingCluster, history_size: int = 30, safe_window_hours: float = 24,
+                 max_in_flight: int = 8):
+        self.cluster = cluster
+        self.safe_window_hours = safe_window_hours
+        self.max_in_flight = max_in_flight
+        self.history: Dict[str, Deque[OplogSample]] = {}
+        self.history_size = history_size
+        self.errors: Dict[str, str] = {}
+
+    @classmethod
+    def from_config(cls, cluster: ShardingCluster) -> 'OplogEstimator':
+        estimator_config = global_config.get('oplog_estimator', {})
+        return cls(cluster, **{x: estimator_config.get(x) for x in ['history_size', 'safe_window_hours']
+                               if x in estimator_config})
+
+    def record(self, name: str, window: dict, sample_time: float = None):
+        samples = self.history.setdefault(name, deque(maxlen=self.history_size))
+        samples.append(OplogSample(time.time() if sample_time is None else sample_time, window))
+
+    def sample(self):
+        shards: List[ReplicationSet] = [x for x in self.cluster.shards.values() if x is not None]
+        for shard, window, error in run_bounded(lambda x: fetch_oplog_window(x.basic_connection), shards,
+                                                self.max_in_flight):
+            if error:
+                self.errors.update({shard.name: str(error)})
+                continue
+            self.errors.pop(shard.name, None)
+            self.record(shard.name, window)
+
+    def estimate(self, name: str) -> dict:
+        """
+        :return: current window, write rate of the last interval and of the whole history in GB/hour,
+        projected window at the recent rate and hours until it falls below safe_window_hours
+        """
+        samples = self.history.get(name)
+        if not samples:
+            return {}
+        current = samples[-1]
+        recent_rate = oplog_write_rate(samples[-2], current) if len(samples) > 1 else None
+        average_rate = oplog_write_rate(samples[0], current) if len(samples) > 2 else recent_rate
+        rate = recent_rate if recent_rate is not None else average_rate
+        projected_hours = current.max_bytes / rate / 3600 if rate else None
+        safe_seconds = self.safe_window_hours * 3600
+        if current.window_seconds < safe_seconds:
+            # too small already, whatever the rate is or even without a rate from a second sample
+            until_unsafe = 0.0
+        else:
+            until_unsafe = hours_until_window_below(current, rate, safe_seconds) if rate else None
+        return {
+            'window_hours': round(current.window_seconds / 3600, 2),
+            'max_gb': round(current.max_bytes / _gb, 2),
+            'used_gb': round(current.used_bytes / _gb, 2),
+            'recent_gb_per_hour': round(recent_rate * 3600 / _gb, 3) if recent_rate is not None else None,
+            'average_gb_per_hour': round(average_rate * 3600 / _gb, 3) if average_rate is not None else None,
+            'projected_window_hours': round(projected_hours, 2) if projected_hours is not None else None,
+            'hours_until_unsafe': round(until_unsafe, 2) if until_unsafe is not None else None,
+            'at_risk': until_unsafe is not None,
+            'samples': len(samples)
+        }
+
+    def estimate_all(self) -> Dict[str, dict]:
+        return {x: self.estimate(x) for x in self.history}
+
+    def print_report(self):
+        table = Table(title=f'oplog window, safe window {self.safe_window_hours} hours')
+        for column in ['shard', 'window hours', 'used/max GB', 'GB/hour', 'projected window hours',
+                       'hours until unsafe']:
+            table.add_column(column)
+        for name, estimate in self.estimate_all().items():
+            table.add_row(name, str(estimate.get('window_hours')),
+                          f'{estimate.get("used_gb")}/{estimate.get("max_gb")}',
+                          str(estimate.get('recent_gb_per_hour')), str(estimate.get('projected_window_hours')),
+                          str(estimate.get('hours_until_unsafe')),
+                          style='bold red' if estimate.get('at_risk') else None)
+        console.print(table)
+
+
+if __name__ == '__main__':
+    c = ShardingCluster("mongodb://192.168.20.120:27010,192.168.20.170:27010,192.168.20.183:27010")
+    estimator = OplogEstimator(c)
+    for _ in range(3):
+        estimator.sample()
+        time.sleep(10)
+    estimator.print_report()
@@ -0,0 +1,162 @@
+from typing import Dict, List, Tuple
+
+from pymongo import MongoClient
+
+from mt.conf.parser import global_config
+from mt.core.client_registry import client_registry
+from mt.core.common import run_bounded
+
+# comment of the analyzer's own aggregations, they are left out of the results
+analyzer_comment = 'mt active operation analyzer'
+_own_operation = {'command.comment': {'$ne': analyzer_comment}}
+
+# host of the client address, without the port
+_client_host = {'$arrayElemAt': [{'$split': [{'$ifNull': ['$client', 'internal']}, ':']}, 0]}
+
+
+def shard_operation_pipeline(top_n: int, min_running_secs: float) -> List[dict]:
+    """
+    active operations of all shards through mongos, grouped and ranked on the server,
+    only top_n groups and top_n long running operations are sent back
+    """
+    return [
+        {'$currentOp': {'allUsers': True, 'idleConnections': False, 'localOps': False}},
+        {'$match': {'active': True, **_own_operation}},
+        {'$facet': {
+            'workloads': [
+                {'$group': {
+                    '_id': {'ns': '$ns', 'op': '$op', 'app_name': '$appName', 'plan_summary': '$planSummary'},
+                    'operations': {'$sum': 1},
+                    'total_secs': {'$sum': {'$ifNull': ['$secs_running', 0]}},
+                    'max_secs': {'$max': {'$ifNull': ['$secs_running', 0]}},
+                    'waiting_for_lock': {'$sum': {'$cond': [{'$eq': ['$waitingForLock', True]}, 1, 0]}},
+                    'shards': {'$addToSet': '$shard'}
+                }},
+                {'$sort': {'operations': -1, 'total_secs': -1}},
+                {'$limit': top_n}
+            ],
+            'long_running': [
+                {'$match': {'secs_running': {'$gte': min_running_secs}}},
+                {'$sort': {'secs_running': -1}},
+                {'$limit': top_n},
+                {'$project': {'_id': 0, 'shard': 1, 'opid': 1, 'ns': 1, 'op': 1, 'secs_running': 1, 'desc': 1,
+                              'app_name': '$appName', 'plan_summary': '$planSummary',
+                              'waiting_for_lock': '$waitingForLock', 'client': {'$ifNull': ['$client_s', '$client']}}}
+            ],
+            'total': [
+                {'$group': {'_id': None, 'operations': {'$sum': 1},
+                            'waiting_for_lock': {'$sum': {'$cond': [{'$eq': ['$waitingForLock', True]}, 1, 0]}}}}
+            ]
+        }}
+    ]
+
+
+def client_connection_pipeline(max_clients: int) -> List[dict]:
+    """
+    connections of one mongos grouped by client host and app name on the server
+    """
+    return [
+        {'$currentOp': {'allUsers': True, 'idleConnections': True, 'localOps': True}},
+        {'$match': {'client': {'$exists': True}, **_own_operation}},
+        {'$group': {
+            '_id': {'host': _client_host, 'app_name': '$appName'},
+            'connections': {'$sum': 1},
+            'active': {'$sum': {'$cond': [{'$eq': ['$active', True]}, 1, 0]}}
+        }},
+        {'$facet': {
+            'clients': [{'$sort': {'connections': -1}}, {'$limit': max_clients}],
+            'total': [{'$group': {'_id': None, 'connections': {'$sum': '$connections'}, 'active': {'$sum': '$active'}}}]
+        }}
+    ]
+
+
+class ActiveOperationAnalyzer:
+    """
+    which workloads load the cluster, from $currentOp aggregations grouped on the server:
+    active operations of all shards grouped by namespace, op type, client app name and plan summary,
+    the longest running operations, and connections of every mongos grouped by client host and app name
+    only grouped documents are sent back so that sampling stays cheap with tens of thousands of connections
+    connection counts are merged from the max_clients largest groups of every mongos
+    """
+
+    def __init__(self, client: MongoClient, top_n: int = 20, min_running_secs: float = 1, max_time_ms: int = 5000,
+                 max_clients: int = 1000, max_in_flight: int = 8):
+        self.client = client
+        self.top_n = top_n
+        self.min_running_secs = min_running_secs
+        self.max_time_ms = max_time_ms
+        self.max_clients = max_clients
+        self.max_in_flight = max_in_flight
+        self._clients: Dict[Tuple[str, int], MongoClient] = {}
+
+    @classmethod
+    def from_config(cls, client: MongoClient) -> 'ActiveOperationAnalyzer':
+        analyzer_config = global_config.get('active_operation', {})
+        return cls(client, **{x: analyzer_config.get(x) for x in ['top_n', 'min_running_secs', 'max_time_ms',
+                                                                   'max_clients', 'max_in_flight']
+                              if x in analyzer_config})
+
+    def shard_operations(self) -> dict:
+        result = next(self.client.admin.aggregate(shard_operation_pipeline(self.top_n, self.min_running_secs),
+                                                  maxTimeMS=self.max_time_ms, comment=analyzer_comment), {})
+        workloads = []
+        for group in result.get('workloads', []):
+            workload = dict(group.pop('_id'))
+            workload.update(group)
+            workload.update({'shards': sorted(x for x in workload.get('shards') if x)})
+            workloads.append(workload)
+        total = (result.get('total') or [{}])[0]
+        return {
+            'operations': total.get('operations', 0),
+            'waiting_for_lock': total.get('waiting_for_lock', 0),
+            'workloads': workloads,
+            'long_running': result.get('long_running', [])
+        }
+
+    def _mongos_connections(self, node: Tuple[str, int]) -> dict:
+        client = self._clients.get(node)
+        if client is None:
+            client = client_registry.acquire_direct(*node, serverSelectionTimeoutMS=self.max_time_ms)
+            self._clients.update({node: client})
+        return next(client.admin.aggregate(client_connection_pipeline(self.max_clients),
+                                           maxTimeMS=self.max_time_ms, comment=analyzer_comment), {})
+
+    def client_connections(self) -> dict:
+        clients, errors = {}, {}
+        connections, active = 0, 0
+        for node, result, error in run_bounded(self._mongos_connections, sorted(self.client.nodes),
+                                               self.max_in_flight):
+            if error:
+                errors.update({'{}:{}'.format(*node): str(error)})
+                continue
+            total = (result.get('total') or [{}])[0]
+            connections += total.get('connections', 0)
+            active += total.get('active', 0)
+            for group in result.get('clients', []):
+                key = (group.get('_id').get('host'), group.get('_id').get('app_name'))
+                merged = clients.setdefault(key, {'host': key[0], 'app_name': key[1], 'connections': 0, 'active': 0})
+                merged.update({'connections': merged.get('connections') + group.get('connections'),
+                               'active': merged.get('active') + group.get('active')})
+        top_clients = sorted(clients.values(), key=lambda x: x.get('connections'), reverse=True)[:self.top_n]
+        return {'connections': connections, 'active': active, 'clients': top_clients, 'errors': errors}
+
+    def analyze(self) -> dict:
+        """
+        :return: {'operations', 'waiting_for_lock', 'workloads', 'long_running', 'connections'}
+        """
+        analysis = self.shard_operations()
+        analysis.update({'connections': self.client_connections()})
+        return analysis
+
+    def close(self):
+        for client in self._clients.values():
+            client_registry.release(client)
+        self._clients.clear()
+
+
+if __name__ == '__main__':
+    mongos = client_registry.acquire("mongodb://192.168.20.120:27010,192.168.20.170:27010,192.168.20.183:27010")
+    analyzer = ActiveOperationAnalyzer(mongos)
+    print(analyzer.analyze())
+    analyzer.close()
+    client_registry.release(mongos)
@@ -0,0 +1,180 @@
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from bson.binary import UuidRepresentation
+from bson.codec_options import CodecOptions
+from pymongo import ASCENDING, DESCENDING, MongoClient
+
+# changelog events that change chunk counts of a namespace
+chunk_change_events = ['split', 'multi-split', 'merge', 'moveChunk.commit', 'moveChunk.from', 'moveChunk.to',
+                       'shardCollection.end', 'dropCollection', 'refineCollectionShardKey.end',
+                       'renameCollection.end', 'reshardCollection.end']
+
+
+def migration_threshold(chunk_count: int) -> int:
+    """
+    chunk count difference between the most and least loaded shard the balancer tolerates
+    """
+    if chunk_count < 20:
+        return 2
+    if chunk_count < 80:
+        return 4
+    return 8
+
+
+def score_distribution(chunks: Dict[str, int], jumbo: Dict[str, int], shard_names: List[str]) -> dict:
+    counts = [chunks.get(x, 0) for x in shard_names] or [0]
+    total = sum(counts)
+    mean = total / len(counts)
+    threshold = migration_threshold(total)
+    return {
+        'chunks': total,
+        'shards': {x: chunks.get(x, 0) for x in shard_names},
+        'jumbo': {x: y for x, y in jumbo.items() if y},
+        'max_min_diff': max(counts) - min(counts),
+        'threshold': threshold,
+        'balanced': max(counts) - min(counts) < threshold,
+        # how far the most loaded shard is above an even share
+        'imbalance': round((max(counts) - mean) / mean, 4) if mean else 0.0
+    }
+
+
+class ChunkDistribution:
+    """
+    chunk count and jumbo chunk count of every sharded collection on every shard,
+    grouped by an aggregation on the config server so that no chunk document is sent to the client
+    results are cached, later refreshes read config.changelog and only group namespaces with split,
+    merge or migration events since the last refresh
+    everything is grouped again after full_refresh_interval seconds or when the capped changelog lost entries
+    """
+
+    def __init__(self, client: MongoClient, full_refresh_interval: float = 3600):
+        self.client = client
+        self.full_refresh_interval = full_refresh_interval
+        # namespace -> {'chunks': {shard: count}, 'jumbo': {shard: count}}
+        self._distribution: Dict[str, dict] = {}
+        self._shard_names: List[str] = []
+        self._last_change: Optional[datetime] = None
+        # _id of the changelog entries at _last_change, entries are read again from _last_change on since several
+        # of them can share one time and some of them may have been written after the last read
+        self._seen_changes: Set = set()
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def config_database(self):
+        # collection uuids have to be sent back as they were read to match chunks of 5.0+
+        return self.client.get_database('config',
+                                        codec_options=CodecOptions(uuid_representation=UuidRepresentation.STANDARD))
+
+    def sharded_collections(self) -> Dict[str, Optional[str]]:
+        """
+        :return: {namespace: uuid} of sharded collections, uuid is None before 3.6
+        """
+        collections = {}
+        for collection in self.config_database.get_collection('collections').find({}, {'uuid': 1, 'dropped': 1}):
+            if collection.get('dropped'):
+                continue
+            collections.update({collection.get('_id'): collection.get('uuid')})
+        return collections
+
+    def group_chunks(self, namespaces: Optional[Set[str]] = None) -> Dict[str, dict]:
+        """
+        group config.chunks by namespace and shard, chunks of 5.0+ only have the collection uuid
+        """
+        collections = self.sharded_collections()
+        uuid_namespaces = {y: x for x, y in collections.items() if y is not None}
+        pipeline = []
+        if namespaces is not None:
+            uuids = [collections.get(x) for x in namespaces if collections.get(x) is not None]
+            pipeline.append({'$match': {'$or': [{'ns': {'$in': list(namespaces)}}, {'uuid': {'$in': uuids}}]}})
+        pipeline.append({'$group': {
+            '_id': {'ns': '$ns', 'uuid': '$uuid', 'shard': '$shard'},
+            'chunks': {'$sum': 1},
+            'jumbo': {'$sum': {'$cond': [{'$eq': ['$jumbo', True]}, 1, 0]}}
+        }})
+        distribution = {x: {'chunks': {}, 'jumbo': {}} for x in (namespaces or collections) if x in collections}
+        for group in self.config_database.get_collection('chunks').aggregate(pipeline, allowDiskUse=True):
+            group_id = group.get('_id')
+            namespace = group_id.get('ns') or uuid_namespaces.get(group_id.get('uuid'))
+            if namespace is None or namespace not in collections:
+                continue
+            shard_distribution = distribution.setdefault(namespace, {'chunks': {}, 'jumbo': {}})
+            shard_name = group_id.get('shard')
+            shard_distribution['chunks'].update({shard_name: shard_distribution['chunks'].get(shard_name, 0) +
+                                                 group.get('chunks')})
+            shard_distribution['jumbo'].update({shard_name: shard_distribution['jumbo'].get(shard_name, 0) +
+                                                group.get('jumbo')})
+        return distribution
+
+    def changed_namespaces(self) -> Optional[Set[str]]:
+        """
+        :return: namespaces with chunk events since the last refresh, None if the changelog does not reach back
+        """
+        changelog = self.config_database.get_collection('changelog')
+        oldest = next(changelog.find({}, {'time': 1}).sort('$natural', ASCENDING).limit(1), None)
+        if oldest is None:
+            return set()
+        if oldest.get('time') > self._last_change:
+            return None
+        namespaces = set()
+        for entry in changelog.find({'time': {'$gte': self._last_change}, 'what': {'$in': chunk_change_events}},
+                                    {'ns': 1, 'time': 1, 'what': 1, 'details': 1}).sort('time', ASCENDING):
+            if entry.get('_id') in self._seen_changes:
+                continue
+            namespaces.add(entry.get('ns'))
+            if entry.get('what') == 'renameCollection.end':
+                # the target namespace of the rename has the chunks now
+                details = entry.get('details') or {}
+                target = details.get('to') or details.get('destination')
+                if target:
+                    namespaces.add(target)
+            if entry.get('time') > self._last_change:
+                self._last_change = entry.get('time')
+                self._seen_changes = set()
+            if entry.get('time') == self._last_change:
+                self._seen_changes.add(entry.get('_id'))
+        return namespaces
+
+    def _latest_change(self) -> datetime:
+        changelog = self.config_database.get_collection('changelog')
+        latest = next(changelog.find({}, {'time': 1}).sort('$natural', DESCENDING).limit(1), None)
+        if latest is None:
+            self._seen_changes = set()
+            return datetime.utcfromtimestamp(0)
+        self._seen_changes = {x.get('_id') for x in changelog.find({'time': latest.get('time')}, {'_id': 1})}
+        return latest.get('time')
+
+    def refresh(self) -> Set[str]:
+        """
+        :return: namespaces grouped again
+        """
+        with self._lock:
+            self._shard_names = sorted(x.get('_id') for x in self.config_database.get_collection('shards').find(
+                {}, {'_id': 1}))
+            now = time.time()
+            changed = None
+            if self._last_change is not None and now - self._refreshed_at < self.full_refresh_interval:
+                changed = self.changed_namespaces()
+            if changed is None:
+                self._last_change = self._latest_change()
+                self._distribution = self.group_chunks()
+                self._refreshed_at = now
+                return set(self._distribution)
+            if changed:
+                regrouped = self.group_chunks(changed)
+                for namespace in changed:
+                    # dropped collections have no group any more
+                    self._distribution.pop(namespace, None)
+                self._distribution.update(regrouped)
+            return changed
+
+    def analyze(self) -> Dict[str, dict]:
+        """
+        :return: {namespace: chunk counts per shard, jumbo chunks and imbalance of the collection}
+        """
+        with self._lock:
+            return {x: score_distribution(y.get('chunks'), y.get('jumbo'), self._shard_names)
+                    for x, y in sorted(self._distribution.items())}
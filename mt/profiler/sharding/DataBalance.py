@@ -0,0 +1,134 @@
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+from mt.core.profile_table import ProfileTable
+
+balance_fields = ['storage_size', 'count', 'total_index_size']
+
+
+def skew_metrics(values: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    skew of every row of a (rows, shards) matrix
+    :return: total, coefficient of variation, max/mean ratio, share and index of the largest shard,
+    and excess of the largest shard over an even share
+    """
+    total = values.sum(axis=1)
+    mean = total / values.shape[1] if values.shape[1] else total
+    largest = values.max(axis=1) if values.shape[1] else np.zeros(len(values))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cv = np.where(mean > 0, values.std(axis=1) / mean, 0.0)
+        max_mean = np.where(mean > 0, largest / mean, 0.0)
+        largest_share = np.where(total > 0, largest / total, 0.0)
+    return {
+        'total': total,
+        'cv': cv,
+        'max_mean': max_mean,
+        'largest_share': largest_share,
+        'largest_shard': values.argmax(axis=1) if values.shape[1] else np.zeros(len(values), dtype=int),
+        'excess': largest - mean
+    }
+
+
+class DataBalance:
+    """
+    per shard storage size, document count and index size of every sharded collection as (collections, shards)
+    matrices, skew of collections and databases is computed for all of them at once
+    """
+
+    def __init__(self, namespaces: List[str], database_ids: np.ndarray, database_names: List[str],
+                 shard_names: List[str], matrices: Dict[str, np.ndarray]):
+        self.namespaces = namespaces
+        self.database_ids = database_ids
+        self.database_names = database_names
+        self.shard_names = shard_names
+        self.matrices = matrices
+        self._collection_metrics = {}
+        self._database_metrics = {}
+
+    @classmethod
+    def from_profile_table(cls, table: ProfileTable, shard_names: List[str]) -> 'DataBalance':
+        """
+        scatter the per shard size rows of sharded namespaces straight from the columns
+        """
+        sharded = np.nonzero(table.column(table.namespace_sharded))[0]
+        namespace_database = table.column(table.namespace_database)
+        database_string_ids, database_ids = np.unique(namespace_database[sharded], return_inverse=True)
+        namespace_rows = np.full(len(table), -1, dtype=np.int64)
+        namespace_rows[sharded] = np.arange(len(sharded))
+        # string id of a shard -> column of the matrices
+        shard_columns = np.full(len(table.strings) + 1, -1, dtype=np.int64)
+        for column, shard_name in enumerate(shard_names):
+            string_id = table.strings.get_id(shard_name)
+            if string_id is not None:
+                shard_columns[string_id] = column
+        rows = table.shard_rows()
+        matrix_rows = namespace_rows[table.column(table.row_namespace)[rows]]
+        matrix_columns = shard_columns[table.column(table.row_shard)[rows]]
+        keep = (matrix_rows >= 0) & (matrix_columns >= 0)
+        rows, matrix_rows, matrix_columns = rows[keep], matrix_rows[keep], matrix_columns[keep]
+        matrices = {}
+        for field in balance_fields:
+            values = table.column(table.sizes[field])[rows]
+            if field != 'count':
+                values = values // table.scale
+            matrix = np.zeros((len(sharded), len(shard_names)))
+            matrix[matrix_rows, matrix_columns] = values
+            matrices.update({field: matrix})
+        strings = table.strings
+        namespaces = [f'{strings[namespace_database[x]]}.{strings[table.namespace_collection[x]]}'
+                      for x in sharded.tolist()]
+        return cls(namespaces, database_ids.reshape(-1), [strings[x] for x in database_string_ids.tolist()],
+                   shard_names, matrices)
+
+    def collection_metrics(self, field: str = 'storage_size') -> Dict[str, np.ndarray]:
+        if field not in self._collection_metrics:
+            self._collection_metrics.update({field: skew_metrics(self.matrices[field])})
+        return self._collection_metrics[field]
+
+    def database_metrics(self, field: str = 'storage_size') -> Dict[str, np.ndarray]:
+        if field not in self._database_metrics:
+            database_values = np.zeros((len(self.database_names), len(self.shard_names)))
+            np.add.at(database_values, self.database_ids, self.matrices[field])
+            self._database_metrics.update({field: skew_metrics(database_values)})
+        return self._database_metrics[field]
+
+    def _describe(self, names: List[str], metrics: Dict[str, np.ndarray], rows: Iterable[int]) -> List[dict]:
+        return [{
+            'name': names[x],
+            'total': float(metrics['total'][x]),
+            'cv': round(float(metrics['cv'][x]), 4),
+            'max_mean': round(float(metrics['max_mean'][x]), 4),
+            'largest_share': round(float(metrics['largest_share'][x]), 4),
+            'largest_shard': self.shard_names[int(metrics['largest_shard'][x])] if self.shard_names else None,
+            'excess': float(metrics['excess'][x])
+        } for x in rows]
+
+    def worst_collections(self, field: str = 'storage_size', order_by: str = 'excess', top_n: int = 20,
+                          min_total: float = 0) -> List[dict]:
+        """
+        :param order_by: excess ranks by how much the largest shard holds above an even share,
+        cv, max_mean or largest_share rank by relative skew of collections holding at least min_total
+        """
+        metrics = self.collection_metrics(field)
+        key = np.where(metrics['total'] >= min_total, metrics[order_by], -np.inf)
+        top_n = min(top_n, len(key))
+        if not top_n:
+            return []
+        rows = np.argpartition(-key, top_n - 1)[:top_n]
+        rows = rows[np.argsort(-key[rows], kind='stable')]
+        return self._describe(self.namespaces, metrics, [x for x in rows.tolist() if key[x] > -np.inf])
+
+    def databases(self, field: str = 'storage_size') -> List[dict]:
+        metrics = self.database_metrics(field)
+        rows = np.argsort(-metrics['excess'], kind='stable')
+        return self._describe(self.database_names, metrics, rows.tolist())
+
+    def analyze(self, top_n: int = 20, min_total: float = 0) -> dict:
+        return {
+            'shards': self.shard_names,
+            'collections': len(self.namespaces),
+            'worst_collections': {x: self.worst_collections(x, top_n=top_n, min_total=min_total)
+                                  for x in balance_fields},
+            'databases': self.databases()
+        }
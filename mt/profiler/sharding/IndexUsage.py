@@ -0,0 +1,154 @@
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import MongoClient
+
+from mt.core.collection_stats import Namespace
+from mt.core.common import run_bounded
+from mt.core.profile_table import DatabaseView
+
+_mb = 1024 * 1024
+
+
+class IndexUsage:
+    __slots__ = ['name', 'key', 'unique', 'sparse', 'partial', 'ops', 'since', 'shards', 'size']
+
+    def __init__(self, name: str, key: dict):
+        self.name = name
+        self.key = key
+        self.unique = False
+        self.sparse = False
+        self.partial = False
+        self.ops = 0
+        self.since: Optional[datetime] = None
+        self.shards = []
+        # bytes, from collection stats
+        self.size = 0
+
+    def merge(self, index_stats: dict):
+        """
+        add the access counters of one shard
+        """
+        spec = index_stats.get('spec', {})
+        self.unique = self.unique or bool(spec.get('unique'))
+        self.sparse = self.sparse or bool(spec.get('sparse'))
+        self.partial = self.partial or 'partialFilterExpression' in spec
+        accesses = index_stats.get('accesses', {})
+        self.ops += int(accesses.get('ops', 0))
+        since = accesses.get('since')
+        if since is not None and (self.since is None or since > self.since):
+            # counters of the shard restarted last cover the shortest time
+            self.since = since
+        if index_stats.get('shard'):
+            self.shards.append(index_stats.get('shard'))
+
+    @property
+    def is_plain(self) -> bool:
+        """
+        only ascending or descending fields, no text, hashed or geo keys
+        """
+        return all(isinstance(x, (int, float)) for x in self.key.values())
+
+    def is_prefix_of(self, other: 'IndexUsage') -> bool:
+        if not self.is_plain or not other.is_plain or len(self.key) >= len(other.key):
+            return False
+        if self.unique or self.sparse or self.partial or other.sparse or other.partial:
+            return False
+        return list(self.key.items()) == list(other.key.items())[:len(self.key)]
+
+    def __repr__(self):
+        response = {}
+        for x in self.__slots__:
+            response.update({x: getattr(self, x)})
+        return str(response)
+
+
+class IndexUsageAnalyzer:
+    """
+    $indexStats of every collection through mongos, which returns the counters of every shard holding the collection,
+    run with at most max_in_flight aggregations at the same time, each limited to max_time_ms
+    collections not started within time_budget seconds are reported as skipped, None sweeps all of them
+    an index counts as unused only if no shard used it and its counters cover at least min_observed_hours
+    """
+
+    def __init__(self, client: MongoClient, max_in_flight: int = 16, max_time_ms: int = 10000,
+                 time_budget: Optional[float] = 60, min_observed_hours: float = 24):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.max_time_ms = max_time_ms
+        self.time_budget = time_budget
+        self.min_observed_hours = min_observed_hours
+
+    def index_stats(self, namespace: Namespace, deadline: Optional[float]) -> Optional[Dict[str, IndexUsage]]:
+        if deadline is not None and time.monotonic() > deadline:
+            return None
+        database_name, collection_name = namespace
+        collection = self.client.get_database(database_name).get_collection(collection_name)
+        indexes = {}
+        for index_stats in collection.aggregate([{'$indexStats': {}}], maxTimeMS=self.max_time_ms):
+            name = index_stats.get('name')
+            if name not in indexes:
+                indexes.update({name: IndexUsage(name, dict(index_stats.get('key', {})))})
+            indexes[name].merge(index_stats)
+        return indexes
+
+    def sweep(self, namespaces: List[Namespace]) -> Tuple[Dict[Namespace, Dict[str, IndexUsage]], dict]:
+        """
+        :return: index usage of every collection, errors and skipped collections
+        """
+        deadline = time.monotonic() + self.time_budget if self.time_budget else None
+        usage, errors, skipped = {}, {}, []
+        for namespace, indexes, error in run_bounded(lambda x: self.index_stats(x, deadline), namespaces,
+                                                     self.max_in_flight):
+            if error:
+                errors.update({'.'.join(namespace): str(error)})
+            elif indexes is None:
+                skipped.append('.'.join(namespace))
+            else:
+                usage.update({namespace: indexes})
+        return usage, {'errors': errors, 'skipped': sorted(skipped)}
+
+    def analyze(self, database_profile: Iterable[DatabaseView]) -> dict:
+        """
+        :return: unused and prefix redundant indexes with their size and the total reclaimable size,
+        summed in bytes and rounded to MB only for output
+        """
+        index_sizes = {}
+        for database in database_profile:
+            for collection in database.collections:
+                if collection.name and not collection.name.startswith('system.'):
+                    index_sizes.update({(database.database_name, collection.name):
+                                        collection.basic_size_info.index_bytes_detail})
+        usage, sweep_info = self.sweep(list(index_sizes))
+
+        observed_before = datetime.utcnow() - timedelta(hours=self.min_observed_hours)
+        unused, redundant, reclaimable = [], [], {}
+        for namespace, indexes in sorted(usage.items()):
+            ns = '.'.join(namespace)
+            sizes = index_sizes.get(namespace) or {}
+            for index in indexes.values():
+                index.size = sizes.get(index.name, 0)
+            for index in indexes.values():
+                if index.name == '_id_':
+                    continue
+                if index.ops == 0 and index.since is not None and index.since <= observed_before:
+                    unused.append({'namespace': ns, 'index': index.name, 'key': index.key,
+                                   'size_bytes': index.size, 'size_mb': round(index.size / _mb, 2),
+                                   'since': index.since, 'shards': sorted(index.shards)})
+                    reclaimable.update({(ns, index.name): index.size})
+                covering = [x.name for x in indexes.values() if index.is_prefix_of(x)]
+                if covering:
+                    redundant.append({'namespace': ns, 'index': index.name, 'key': index.key,
+                                      'size_bytes': index.size, 'size_mb': round(index.size / _mb, 2),
+                                      'ops': index.ops, 'covered_by': sorted(covering)})
+                    reclaimable.update({(ns, index.name): index.size})
+        return {
+            'collections': len(usage),
+            'unused': unused,
+            'redundant': redundant,
+            'reclaimable_bytes': sum(reclaimable.values()),
+            'reclaimable_mb': round(sum(reclaimable.values()) / _mb, 2),
+            'errors': sweep_info.get('errors'),
+            'skipped': sweep_info.get('skipped')
+        }
@@ -1,4 +1,16 @@
+import time
+from typing import Optional
+
 from mt.core.connector import ShardingCluster
+from mt.core.counter_rate import CounterSampler, CounterRates, compute_counter_rates
+from mt.profiler.sharding.ActiveOperation import ActiveOperationAnalyzer
+from mt.profiler.sharding.ChunkDistribution import ChunkDistribution
+from mt.profiler.sharding.DataBalance import DataBalance
+from mt.profiler.sharding.IndexUsage import IndexUsageAnalyzer
+
+load_counters = ['opcounters.insert', 'opcounters.query', 'opcounters.update', 'opcounters.delete',
+                 'opcounters.getmore', 'opcounters.command', 'network.bytesIn', 'network.bytesOut',
+                 'wiredTiger.cache.pages read into cache', 'wiredTiger.cache.pages written from cache']
 
 
 class ShardProfile:
@@ -16,33 +28,111 @@ class ShardProfile:
 
     def __init__(self, shard_cluster: ShardingCluster):
         self.shard_cluster = shard_cluster
-        self.shard_cluster.profile_databases()
         self.server_status = None
+        self.counter_sampler = CounterSampler(shard_cluster)
+        self.counter_snapshot = None
+        self.chunk_distribution = None
+        self.active_operation_analyzer = None
 
-    def shard_status(self):
+    def ensure_profiled(self):
         """
-        当前分片集群每个分片的运行基本状态，能否正常读写
+        数据表统计在第一次需要时进行，只查询mongos状态的分析不需要统计
         :return:
         """
-        pass
+        if self.shard_cluster.profile_table is None:
+            self.shard_cluster.profile_databases()
+
+    def refresh_profile(self):
+        """
+        只重新统计cheap signal发生变化的数据表，其余数据表使用缓存
+        :return:
+        """
+        self.shard_cluster.profile_databases(incremental=True)
+
+    def refresh_counter_rates(self, sample_interval: float = 1) -> CounterRates:
+        """
+        与上一次采样的serverStatus计数器比较计算每秒速率，首次调用时间隔sample_interval秒采样两次
+        :return:
+        """
+        previous = self.counter_snapshot
+        if previous is None:
+            previous = self.counter_sampler.snapshot()
+            time.sleep(sample_interval)
+        self.counter_snapshot = self.counter_sampler.snapshot()
+        return compute_counter_rates(previous, self.counter_snapshot)
+
+    def shard_status(self, sample_interval: float = 1, rates: Optional[CounterRates] = None) -> dict:
+        """
+        当前分片集群每个分片的运行基本状态，能否正常读写
+        :param rates: 本轮已经采样计算的计数器速率，为空时重新采样
+        :return: {shard: {'primary', 'members', 'unreachable', 'writable', 'readable', 'load'}}
+        """
+        if rates is None:
+            rates = self.refresh_counter_rates(sample_interval)
+        errors = self.counter_snapshot.errors
+        group_rates = rates.group_rates(load_counters)
+        status = {}
+        for shard_name, shard in self.shard_cluster.shards.items():
+            if shard is None:
+                status.update({shard_name: {'primary': None, 'members': {}, 'unreachable': [], 'writable': False,
+                                            'readable': False, 'load': {}}})
+                continue
+            try:
+                member_set = shard.replication_member_set
+            except Exception as e:
+                status.update({shard_name: {'primary': None, 'members': {}, 'unreachable': [], 'writable': False,
+                                            'readable': False, 'load': group_rates.get(shard_name, {}),
+                                            'error': str(e)}})
+                continue
+            members = {f'{x.address.ip}:{x.address.port}': x.role for x in member_set.member_set}
+            primary = [x for x, y in members.items() if y == 'PRIMARY']
+            unreachable = [x for x in members if x in errors]
+            status.update({shard_name: {
+                'primary': primary[0] if primary else None,
+                'members': members,
+                'unreachable': unreachable,
+                'writable': bool(primary) and primary[0] not in errors,
+                'readable': any(y in ('PRIMARY', 'SECONDARY') and x not in errors for x, y in members.items()),
+                'load': group_rates.get(shard_name, {})
+            }})
+        return status
+
+    def analyze_cluster_load(self, sample_interval: float = 1, rates: Optional[CounterRates] = None) -> dict:
+        """
+        集群负载，每秒操作数、网络流量和WiredTiger缓存读写页数
+        :param rates: 本轮已经采样计算的计数器速率，为空时重新采样
+        :return: {'cluster': 所有分片合计, 'mongos': mongos合计, 'shards': {shard: 分片合计}, 'restarted': 采样期间重启的节点}
+        """
+        if rates is None:
+            rates = self.refresh_counter_rates(sample_interval)
+        group_rates = rates.group_rates(load_counters)
+        return {
+            'cluster': rates.cluster_rates(load_counters),
+            'mongos': group_rates.pop('mongos', {}),
+            'shards': {x: group_rates.get(x, {}) for x in self.shard_cluster.shards},
+            'restarted': [x for x, y in zip(rates.nodes, rates.resets) if y]
+        }
 
     def analyze_database_of_shard(self) -> dict:
         """
         分析集群中所有数据库在集群分片的分布状态，提供分片状态
         :return:
         """
-        database_profile = self.shard_cluster.database_profile
-        database_on_shard_info = {}
-        for info in database_profile:
-            database_on_shard_info.update({info.database_name: info.size_on_shards})
-        return database_on_shard_info
+        self.ensure_profiled()
+        return self.shard_cluster.profile_table.database_size_on_shards()
 
-    def analyze_collection_of_shard(self):
+    def analyze_collection_of_shard(self) -> dict:
         """
         分析集群中所有与数据库表的分布状态，提供分片建议
-        :return:
+        chunk数量在config server上聚合，之后只重新聚合config.changelog中有split/merge/moveChunk事件的数据表
+        :return: {namespace: {'chunks', 'shards', 'jumbo', 'max_min_diff', 'threshold', 'balanced', 'imbalance'}}
         """
-        pass
+        if self.chunk_distribution is None:
+            config_server = self.shard_cluster.config_server
+            client = config_server.basic_connection if config_server else self.shard_cluster.basic_connection
+            self.chunk_distribution = ChunkDistribution(client)
+        self.chunk_distribution.refresh()
+        return self.chunk_distribution.analyze()
 
     def analyze_storage_of_shard(self):
         """
@@ -57,23 +147,42 @@ class ShardProfile:
         主要分析已经分片的表是否在分片中分布均匀
         :return:
         """
-        database_profile = self.shard_cluster.database_profile
+        self.ensure_profiled()
+        table = self.shard_cluster.profile_table
+        rows = table.shard_rows()
+        namespace_ids = table.column(table.row_namespace)[rows]
+        storage_sizes = table.column(table.sizes['storage_size'])[rows] // table.scale
+        keep = (table.column(table.namespace_sharded)[namespace_ids] > 0) & (storage_sizes > 0)
+        strings = table.strings
         database_on_shard_info = {}
-        for info in database_profile:
-            database_name = info.database_name
-            collection_of_database = info.collections
-            for collection in collection_of_database:
-                if collection.sharded:
-                    sharding_detail = collection.sharding_detail
-                    storage_distribution = {}
-                    for sharding_name, storage_info in sharding_detail.items():
-                        storage_size = storage_info.storage_size
-                        if storage_size:
-                            storage_distribution.update({sharding_name: storage_size})
-                    if storage_distribution:
-                        database_on_shard_info.update({f'{database_name}.{collection.name}': storage_distribution})
+        for namespace_id, shard_id, storage_size in zip(namespace_ids[keep].tolist(),
+                                                        table.column(table.row_shard)[rows][keep].tolist(),
+                                                        storage_sizes[keep].tolist()):
+            namespace = f'{strings[table.namespace_database[namespace_id]]}.' \
+                        f'{strings[table.namespace_collection[namespace_id]]}'
+            database_on_shard_info.setdefault(namespace, {}).update({strings[shard_id]: storage_size})
         return database_on_shard_info
 
+    def analyze_balance_skew(self, top_n: int = 20, min_total: float = 0) -> dict:
+        """
+        分析已分片数据表在各分片的存储、文档数量和索引大小的偏斜程度（变异系数、最大值/平均值、最大分片占比），
+        给出偏斜最严重的数据表和各数据库的偏斜程度
+        :return:
+        """
+        self.ensure_profiled()
+        balance = DataBalance.from_profile_table(self.shard_cluster.profile_table, list(self.shard_cluster.shard_hosts))
+        return balance.analyze(top_n, min_total)
+
+    def analyze_index_usage(self, max_in_flight: int = 16, time_budget: Optional[float] = 60) -> dict:
+        """
+        并发统计所有数据表在各分片的$indexStats，给出未使用的索引、被其他索引前缀覆盖的索引和可回收的索引大小
+        :param time_budget: 统计耗时上限（秒），超时后未开始统计的数据表记录在skipped中，为None时统计所有数据表
+        :return:
+        """
+        self.ensure_profiled()
+        analyzer = IndexUsageAnalyzer(self.shard_cluster.basic_connection, max_in_flight, time_budget=time_budget)
+        return analyzer.analyze(self.shard_cluster.database_profile)
+
     def analyze_active_session_of_shard(self) -> int:
         """
         分析集群active session
@@ -88,6 +197,25 @@ class ShardProfile:
         except Exception:
             return -1
 
+    def analyze_active_operations(self) -> dict:
+        """
+        通过mongos执行$currentOp聚合，在服务端按数据表、操作类型、客户端appName和执行计划分组，
+        给出负载最高的业务、运行时间最长的操作和各客户端连接数
+        :return: {'operations', 'waiting_for_lock', 'workloads', 'long_running', 'connections'}
+        """
+        if self.active_operation_analyzer is None:
+            self.active_operation_analyzer = ActiveOperationAnalyzer.from_config(self.shard_cluster.basic_connection)
+        return self.active_operation_analyzer.analyze()
+
+    def close(self):
+        """
+        释放采样serverStatus和分析活跃操作时直连各节点的连接
+        """
+        self.counter_sampler.close()
+        if self.active_operation_analyzer is not None:
+            self.active_operation_analyzer.close()
+            self.active_operation_analyzer = None
+
 
 if __name__ == '__main__':
     c = ShardingCluster("mongodb://192.168.20.120:27010,192.168.20.170:27010,192.168.20.183:27010")
@@ -95,3 +223,7 @@ if __name__ == '__main__':
     database_on_shard_info = p.analyze_database_of_shard()
     data_on_shard_info = p.analyze_data_balance_of_shard()
     session_info_on_shard = p.analyze_active_session_of_shard()
+    active_operations = p.analyze_active_operations()
+    cluster_load = p.analyze_cluster_load()
+    collection_on_shard_info = p.analyze_collection_of_shard()
+    p.close()
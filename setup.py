@@ -9,7 +9,8 @@ from setuptools import setup, find_packages
 
 entry_points = {
     "console_scripts": [
-        "mt_reboot = mt.cli.mt_cluster_reboot:cluster_reboot"
+        "mt_reboot = mt.cli.mt_cluster_reboot:cluster_reboot",
+        "mt_api = mt.cli.mt_api:cluster_api"
     ]
 }
 